@@ -0,0 +1,978 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Framework neutral core of the kube-control interface.
+
+Both the reactive endpoints and the ops package are thin adapters over the
+encoding, decoding, merging, diffing, creds lookups, size accounting,
+snapshots, request digests, the signing queue, node patches and hook
+profiling here, which only work on plain dict databags. Nothing here
+depends on pydantic, charmhelpers or the ops framework, so it's cheap to
+import from every hook and can be exercised without any Juju framework
+installed.
+
+The ops package links this module in as ops.interface_kube_control.core.
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import math
+import os
+import re
+import time
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+)
+
+log = logging.getLogger("KubeControlCore")
+
+PAYLOAD_V2_KEY = "kube-control-v2"
+PAYLOAD_VERSION_KEY = "payload-version"
+
+# Fields published as bare strings rather than JSON when sent as single keys
+TEXT_KEYS = frozenset(("cluster-tag", "domain", "registry-location", "sdn-ip"))
+
+# Fields kept serialized inside a kube-control-v2 document, as they are in
+# their single key, so one user's creds can be read without decoding them all
+SERIALIZED_KEYS = frozenset(("creds",))
+
+
+def encode_payload(data: Dict) -> str:
+    """Encode the kube-control-v2 document."""
+    data = {
+        key: encode_field(key, value) if key in SERIALIZED_KEYS else value
+        for key, value in data.items()
+    }
+    return json.dumps({"version": 2, "data": data}, sort_keys=True)
+
+
+def decode_payload(raw: Optional[str]) -> Dict:
+    """Decode the fields from a kube-control-v2 document.
+
+    Fields in SERIALIZED_KEYS are left serialized. Raises ValueError if the
+    document isn't a version 2 payload.
+    """
+    if not raw:
+        return {}
+    doc = json.loads(raw)
+    if not isinstance(doc, dict) or doc.get("version") != 2:
+        raise ValueError("Not a kube-control-v2 payload")
+    data = doc.get("data")
+    if not isinstance(data, dict):
+        raise ValueError("kube-control-v2 payload has no data")
+    return data
+
+
+def encode_field(key: str, value: Any) -> str:
+    """Encode a field's native value as it's sent in a single key.
+
+    None encodes as "", which removes the key from the databag.
+    """
+    if value is None:
+        return ""
+    if key == "enable-kube-dns":
+        return str(bool(value))
+    if key in TEXT_KEYS | SERIALIZED_KEYS and isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def decode_field(key: str, raw: str) -> Any:
+    """Decode a single key's value back to what encode_field was given."""
+    if key == "enable-kube-dns":
+        return raw == "True"
+    if key in TEXT_KEYS:
+        return raw
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+
+def encode_fields(fields: Mapping[str, Any]) -> Dict[str, str]:
+    """Encode native field values, such as a v2 payload, as single keys."""
+    return {key: encode_field(key, value) for key, value in fields.items()}
+
+
+def decode_unit(databag: Mapping[str, str]) -> Tuple[Dict[str, Any], bool]:
+    """A unit's fields and whether they came from a kube-control-v2 payload.
+
+    Fields from a v2 payload have native values, otherwise they're the
+    databag's strings. Raises ValueError for an invalid v2 payload.
+    """
+    payload = decode_payload(databag.get(PAYLOAD_V2_KEY))
+    return (payload, True) if payload else (dict(databag), False)
+
+
+# Juju sets these in every unit's databag, they always differ between units
+UNIT_KEYS = frozenset(("egress-subnets", "ingress-address", "private-address"))
+
+
+def _unit_rank(name: str, data: Mapping[str, Any]) -> Tuple[bool, int, int, str]:
+    has_creds = bool(data.get("creds"))
+    generation = 0
+    if has_creds:
+        try:
+            generation = int(data.get("creds-generation") or 0)
+        except (TypeError, ValueError) as e:
+            log.warning(f"Ignoring creds-generation from {name}: {e}")
+    number = name.rpartition("/")[2]
+    return (not has_creds, -generation, int(number) if number.isdigit() else 0, name)
+
+
+def merge_units(
+    units: Mapping[str, Mapping[str, Any]],
+) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """Deterministically merge the data published by several units.
+
+    Each key takes its value from the highest ranked unit publishing it: the
+    units publishing creds, which is only the leader once handoff completes,
+    by newest creds generation, and then the lowest unit number.
+
+    Returns the merged data, and the conflicts as a map of each key units
+    disagree on to every unit's value.
+    """
+    merged, published = {}, {}
+    for name in sorted(units, key=lambda name: _unit_rank(name, units[name])):
+        for key, value in units[name].items():
+            if value is None:
+                continue
+            merged.setdefault(key, value)
+            published.setdefault(key, {})[name] = value
+    conflicts = {
+        key: values
+        for key, values in published.items()
+        if key not in UNIT_KEYS and any(v != merged[key] for v in values.values())
+    }
+    return merged, conflicts
+
+
+def _decode_all(
+    databags: Mapping[str, Mapping[str, str]],
+) -> Dict[str, Tuple[Dict[str, Any], bool]]:
+    decoded = {}
+    for name, databag in databags.items():
+        try:
+            decoded[name] = decode_unit(databag)
+        except ValueError as e:
+            log.warning(f"Ignoring {PAYLOAD_V2_KEY} from {name}: {e}")
+    return decoded
+
+
+def merge_databags(
+    databags: Mapping[str, Mapping[str, str]],
+    app_databags: Optional[Mapping[str, Mapping[str, str]]] = None,
+) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]], bool]:
+    """Decode and merge the databags of several units.
+
+    When any unit publishes a kube-control-v2 payload only the v2 units are
+    merged, since the rest are older units yet to be upgraded. Units with an
+    invalid v2 payload are left out.
+
+    Fields in app_databags, a map of application name to its databag where
+    a leader publishes the shared fields once, take precedence and the unit
+    databags only fill in what's missing. The application databags decide
+    whether v2 payloads are used when they have any fields.
+
+    Returns the merged fields, the conflicts between units as described for
+    merge_units, and whether the fields came from v2 payloads.
+    """
+    units = _decode_all(databags)
+    apps = {
+        name: decoded
+        for name, decoded in _decode_all(app_databags or {}).items()
+        if decoded[0]
+    }
+    v2 = any(is_v2 for _, is_v2 in (apps or units).values())
+    merged, conflicts = merge_units(
+        {name: fields for name, (fields, is_v2) in units.items() if is_v2 == v2}
+    )
+    shared, _ = merge_units(
+        {name: fields for name, (fields, is_v2) in apps.items() if is_v2 == v2}
+    )
+    merged.update(shared)
+    return merged, conflicts, v2
+
+
+def changed_keys(old: Mapping[str, Any], new: Mapping[str, Any]) -> Set[str]:
+    """Keys of new whose value differs from old, where missing keys are None."""
+    return {key for key, value in new.items() if old.get(key) != value}
+
+
+def changed_cohorts(
+    cohort_keys: Mapping[str, str],
+    revisions: Mapping[str, int],
+    seen: Mapping[str, Any],
+) -> Tuple[Dict[str, str], Dict[str, List]]:
+    """Cohort keys of snaps which changed since seen, and what to keep as seen.
+
+    A snap changed when its key or its revision did. Each control-plane unit
+    counts revisions itself, so after a leader change the same revision can
+    come with a different key.
+    """
+    current = {snap: [revisions.get(snap), key] for snap, key in cohort_keys.items()}
+    changed = {
+        snap: key
+        for snap, (revision, key) in current.items()
+        if seen.get(snap) != [revision, key]
+    }
+    return changed, current
+
+
+def extract_creds(raw: str, user: str) -> Optional[Dict[str, str]]:
+    """Decode one user's entry from a serialized creds map.
+
+    Only the requested entry is decoded. The whole map is decoded only if
+    the value can't be scanned, and a map which isn't valid JSON has no
+    entries.
+    """
+    decoder = json.JSONDecoder()
+    for needle in {json.dumps(user), json.dumps(user, ensure_ascii=False)}:
+        start = 0
+        while (idx := raw.find(needle, start)) >= 0:
+            start = idx + len(needle)
+            before = raw[:idx].rstrip()[-1:]
+            after = raw[start:].lstrip()
+            if before not in ("{", ",") or not after.startswith(":"):
+                continue
+            value_at = len(raw) - len(after[1:].lstrip())
+            try:
+                value, _ = decoder.raw_decode(raw, value_at)
+            except ValueError:
+                try:
+                    entries = json.loads(raw)
+                except ValueError as e:
+                    log.error(f"creds for {user} not valid. ({e})")
+                    return None
+                entry = entries.get(user) if isinstance(entries, dict) else None
+                return entry if isinstance(entry, dict) else None
+            if isinstance(value, dict):
+                return value
+    return None
+
+
+def carry_creds(
+    known: Dict[str, Dict[str, Any]], user: str, entry: Optional[Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    """A user's creds entry, or the last known one while the creds lack it.
+
+    A new leader's creds can lack users it hasn't signed yet, such as while
+    it signs them in batches, and those users keep their last known entry
+    until it does. known maps users to their last entry, and is updated.
+    """
+    if entry is None:
+        if user in known:
+            log.info(f"No creds for {user} yet, keeping the last known")
+        return known.get(user)
+    known[user] = entry
+    return entry
+
+
+class _FrozenDict(dict):
+    """A dict which can't be changed once built."""
+
+    __slots__ = ()
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(f"{type(self).__name__} is read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict.__repr__(self)})"
+
+
+def _item(key: str) -> property:
+    return property(lambda self: self.get(key), doc=f"The {key} value.")
+
+
+class DnsInfo(_FrozenDict):
+    """DNS settings sent by the control-plane, as a read-only dict."""
+
+    __slots__ = ()
+
+    port = _item("port")
+    domain = _item("domain")
+    sdn_ip = _item("sdn-ip")
+    enable_kube_dns = _item("enable-kube-dns")
+
+
+class Credentials(_FrozenDict):
+    """A user's tokens sent by the control-plane, as a read-only dict."""
+
+    __slots__ = ()
+
+    user = _item("user")
+    kubelet_token = _item("kubelet_token")
+    proxy_token = _item("proxy_token")
+    client_token = _item("client_token")
+    issued_at = _item("issued_at")
+    expires_at = _item("expires_at")
+
+
+class EndpointSet(list):
+    """Sorted, distinct API endpoint URLs, as a read-only list."""
+
+    __slots__ = ()
+
+    def __init__(self, endpoints: Iterable[Any] = ()):
+        super().__init__(sorted(set(map(str, endpoints))))
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError(f"{type(self).__name__} is read-only")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = clear = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __reduce__(self):
+        return type(self), (list(self),)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({list.__repr__(self)})"
+
+
+def refresh_at(
+    creds: Mapping[str, Any], unit_name: str, lead: float = 1 / 3, spread: float = 1 / 6
+) -> Optional[float]:
+    """When a unit should ask for its creds to be replaced, or None if never.
+
+    @params creds     - the unit's creds, with optional issued_at/expires_at
+    @params unit_name - spreads units' refreshes apart
+    @params lead      - fraction of the creds' lifetime left when the last
+                        units refresh
+    @params spread    - fraction of the lifetime over which units refresh
+
+    Each unit picks a point from a digest of its name, so units holding creds
+    issued together don't all ask for new ones at once.
+    """
+    expires_at = creds.get("expires_at")
+    if expires_at is None:
+        return None
+    issued_at = creds.get("issued_at")
+    lifetime = expires_at - issued_at if issued_at is not None else 0
+    digest = hashlib.sha256(unit_name.encode()).digest()
+    offset = int.from_bytes(digest[:8], "big") / 2**64
+    return expires_at - lifetime * (lead + spread * offset)
+
+
+def refresh_requested(
+    creds: Optional[Mapping[str, Any]], refresh: Optional[str]
+) -> bool:
+    """Whether a unit asked to replace creds expiring at or before refresh."""
+    expires_at = (creds or {}).get("expires_at")
+    if not refresh or expires_at is None:
+        return False
+    try:
+        return expires_at <= float(refresh)
+    except ValueError:
+        return False
+
+
+class PayloadBudgetError(ValueError):
+    """Publishing would take a databag over its size budget."""
+
+
+def databag_sizes(databag: Mapping[str, Any]) -> Dict[str, int]:
+    """Bytes each key takes in a databag, counting the key and its value."""
+    return {
+        key: len(key.encode("utf-8")) + len(value.encode("utf-8"))
+        for key, value in databag.items()
+        if isinstance(value, str) and value
+    }
+
+
+def size_stats(
+    sizes: Iterable[Mapping[str, int]], previous: Optional[Mapping[str, int]] = None
+) -> Dict[str, Dict[str, int]]:
+    """Per key figures across several databags.
+
+    Each key maps to its total bytes, the bytes in the largest databag, and
+    the growth of the total since previous, a map of key to earlier totals.
+    """
+    previous = previous or {}
+    stats: Dict[str, Dict[str, int]] = {}
+    for databag in sizes:
+        for key, size in databag.items():
+            entry = stats.setdefault(key, {"total": 0, "max": 0})
+            entry["total"] += size
+            entry["max"] = max(entry["max"], size)
+    for key in set(previous) - set(stats):
+        stats[key] = {"total": 0, "max": 0}
+    for key, entry in stats.items():
+        entry["growth"] = entry["total"] - previous.get(key, 0)
+    return stats
+
+
+class PayloadMeter:
+    """Account for the bytes published to each databag, against a budget.
+
+    @params budget - bytes allowed in one databag, or None for no limit
+    @params refuse - raise PayloadBudgetError rather than log a warning when
+                     a write would exceed the budget
+
+    Growth is measured from each databag's size before its first write.
+    """
+
+    def __init__(self, budget: Optional[int] = None, refuse: bool = False):
+        self.budget = budget
+        self.refuse = refuse
+        self.sizes: Dict[str, Dict[str, int]] = {}
+        self._initial: Dict[str, Dict[str, int]] = {}
+
+    def publish(
+        self, name: str, databag: Mapping[str, Any], updates: Mapping[str, str]
+    ) -> None:
+        """Measure databag once updates are written to it, before they are.
+
+        Values of "" in updates remove the key.
+        """
+        current = self.sizes.get(name)
+        if current is None:
+            current = self._initial[name] = databag_sizes(databag)
+        sizes = {key: size for key, size in current.items() if key not in updates}
+        sizes.update(databag_sizes(updates))
+        total = sum(sizes.values())
+        if self.budget is not None and total > self.budget:
+            grown = sorted(k for k, v in sizes.items() if v > current.get(k, 0))
+            msg = f"{name} would hold {total} bytes, over the {self.budget} budget"
+            msg += f" after writing {', '.join(grown) or 'no larger keys'}"
+            if self.refuse:
+                raise PayloadBudgetError(msg)
+            log.warning(msg)
+        self.sizes[name] = sizes
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Per key figures as described for size_stats, across all databags."""
+        initial: Dict[str, int] = {}
+        for sizes in self._initial.values():
+            for key, size in sizes.items():
+                initial[key] = initial.get(key, 0) + size
+        return size_stats(self.sizes.values(), initial)
+
+
+def _digest(data: Mapping[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def write_snapshot(path: "os.PathLike[str]", data: Mapping[str, Any]) -> None:
+    """Save data to path along with its sha256 digest.
+
+    The file is replaced atomically and only readable by its owner, since
+    the data can hold creds.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"sha256": _digest(data), "data": data}, f, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def read_snapshot(path: "os.PathLike[str]") -> Optional[Dict[str, Any]]:
+    """Data saved by write_snapshot, or None if it's missing or corrupt."""
+    try:
+        doc = json.loads(Path(path).read_text())
+        data, digest = doc["data"], doc["sha256"]
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError, KeyError) as e:
+        log.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return None
+    if not isinstance(data, dict) or _digest(data) != digest:
+        log.warning(f"Ignoring snapshot {path} which failed its integrity check")
+        return None
+    return data
+
+
+def request_digest(*fields: Optional[str]) -> str:
+    """Digest identifying an auth request by its fields."""
+    joined = "\0".join("" if field is None else field for field in fields)
+    return hashlib.sha256(joined.encode("utf-8")).hexdigest()
+
+
+def databags_digest(*groups: Mapping[str, Mapping[str, str]]) -> str:
+    """Digest of the raw contents of groups of databags, keyed by name.
+
+    This tells whether any databag changed without decoding them.
+    """
+    digest = hashlib.sha256()
+    for group in groups:
+        for name in sorted(group):
+            for key, value in sorted(group[name].items()):
+                entry = "\0".join(map(str, (name, key, value, "")))
+                digest.update(entry.encode("utf-8"))
+        digest.update(b"\1")
+    return digest.hexdigest()
+
+
+def diff_digests(
+    old: Mapping[str, str], new: Mapping[str, str]
+) -> Dict[str, List[str]]:
+    """Names added to, changed in and removed from a map of name to digest."""
+    return {
+        "added": sorted(set(new) - set(old)),
+        "changed": sorted(n for n in set(new) & set(old) if new[n] != old[n]),
+        "removed": sorted(set(old) - set(new)),
+    }
+
+
+Request = Tuple[str, ...]
+
+
+class SigningQueue:
+    """Pending auth requests, worked through a bounded batch per hook.
+
+    @params state       - what dump() returned in an earlier hook
+    @params max_items   - most requests handed out per batch, or None
+    @params time_budget - seconds after which a batch stops, or None
+    @params clock       - monotonic clock used to time each request
+
+    Requests are tuples, such as (unit, user, group), and are handed out in
+    the order they were first seen. A running average of the time taken to
+    handle each one estimates how long the queue takes to drain.
+    """
+
+    def __init__(
+        self,
+        state: Optional[Mapping[str, Any]] = None,
+        max_items: Optional[int] = None,
+        time_budget: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        state = state or {}
+        self.pending: List[Request] = [tuple(r) for r in state.get("pending", [])]
+        self.seconds_per_item: Optional[float] = state.get("seconds_per_item")
+        self.max_items = max_items
+        self.time_budget = time_budget
+        self.clock = clock
+
+    def dump(self) -> Dict[str, Any]:
+        """Plain data to persist and pass back as state in the next hook."""
+        return {
+            "pending": [list(r) for r in self.pending],
+            "seconds_per_item": self.seconds_per_item,
+        }
+
+    def sync(
+        self,
+        requests: Iterable[Request],
+        done: Callable[[Request], bool],
+        expiry: Optional[Callable[[Request], Optional[float]]] = None,
+    ):
+        """Queue new requests which aren't done, and drop withdrawn ones and
+        those done since they were queued, such as by another leader.
+
+        expiry gives when the creds a request replaces expire, if it does.
+        Those requests move to the front, soonest to expire first.
+        """
+        current = {tuple(r) for r in requests}
+        queued = [r for r in self.pending if r in current and not done(r)]
+        known = set(self.pending)
+        queued.extend(sorted(r for r in current - known if not done(r)))
+        if expiry is not None:
+            expires = {r: expiry(r) for r in queued}
+            queued.sort(key=lambda r: (expires[r] is None, expires[r] or 0))
+        self.pending = queued
+
+    def batch(self, done: Callable[[Request], bool]) -> Iterator[Request]:
+        """Hand out pending requests until a limit is reached.
+
+        done is checked once the caller has handled each request. Requests
+        which are done leave the queue, others move to the back of it.
+        """
+        start = self.clock()
+        for handled, request in enumerate(list(self.pending)):
+            if self.max_items is not None and handled >= self.max_items:
+                break
+            if (
+                self.time_budget is not None
+                and self.clock() - start >= self.time_budget
+            ):
+                break
+            began = self.clock()
+            yield request
+            elapsed = self.clock() - began
+            self.pending.remove(request)
+            if not done(request):
+                self.pending.append(request)
+                continue
+            if self.seconds_per_item is None:
+                self.seconds_per_item = elapsed
+            else:
+                self.seconds_per_item += 0.2 * (elapsed - self.seconds_per_item)
+
+    @property
+    def depth(self) -> int:
+        """Number of pending requests."""
+        return len(self.pending)
+
+    @property
+    def drain_seconds(self) -> Optional[float]:
+        """Estimated handling time left, or None until a request is timed."""
+        if self.seconds_per_item is None:
+            return None if self.pending else 0.0
+        return self.depth * self.seconds_per_item
+
+    @property
+    def drain_hooks(self) -> Optional[int]:
+        """Estimated hooks until the queue drains, or None if unknown."""
+        if not self.pending:
+            return 0
+        per_hook = math.inf if self.max_items is None else self.max_items
+        if self.time_budget is not None:
+            if self.seconds_per_item is None:
+                return None
+            if self.seconds_per_item > 0:
+                per_hook = min(per_hook, self.time_budget / self.seconds_per_item)
+        return max(1, math.ceil(self.depth / max(per_hook, 1)))
+
+
+TOKEN_KINDS = ("client_token", "kubelet_token", "proxy_token")
+
+
+def token_hash(token: str) -> str:
+    """The sha256 a token is recorded under."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenIssuer:
+    """Generates auth tokens in bulk, recording only their hashes.
+
+    @params state - what dump() returned in an earlier hook
+
+    Requests are (unit, user, group) tuples, and each is issued a client,
+    kubelet and proxy token of the form "<user>::<secret>", with 32 bytes
+    from the secrets module as the secret. Only a sha256 of each token is
+    kept, with the group, scope, issue and expiry time, for auditing and
+    verify().
+    """
+
+    def __init__(self, state: Optional[Mapping[str, Any]] = None):
+        self.issued: Dict[str, Dict[str, Any]] = {
+            user: dict(record) for user, record in (state or {}).items()
+        }
+
+    def dump(self) -> Dict[str, Any]:
+        """Plain data to persist and pass back as state in the next hook."""
+        return {user: dict(record) for user, record in self.issued.items()}
+
+    def merge(self, state: Optional[Mapping[str, Any]]) -> None:
+        """Add the records from another dump, such as a previous leader's.
+
+        Where both have a record for a user, the later issued one is kept.
+        """
+        for user, record in (state or {}).items():
+            ours = self.issued.get(user)
+            if not ours or record["issued_at"] > ours["issued_at"]:
+                self.issued[user] = dict(record)
+
+    def issue(self, requests: Iterable[Request]) -> Dict[Request, Dict[str, str]]:
+        """New tokens for each request, from a single read of the RNG."""
+        import secrets
+
+        requests = list(dict.fromkeys(tuple(r) for r in requests))
+        pool = secrets.token_bytes(32 * len(TOKEN_KINDS) * len(requests)).hex()
+        offsets = range(0, len(pool) + 64, 64)
+        secret = (pool[start:end] for start, end in zip(offsets, offsets[1:]))
+        return {
+            request: {kind: f"{request[1]}::{next(secret)}" for kind in TOKEN_KINDS}
+            for request in requests
+        }
+
+    def record(
+        self,
+        request: Request,
+        tokens: Mapping[str, str],
+        issued_at: Optional[int] = None,
+        expires_at: Optional[int] = None,
+    ) -> None:
+        """Keep the hashes of the tokens issued for a request."""
+        unit, user, group = request
+        self.issued[user] = {
+            "scope": unit,
+            "group": group,
+            "issued_at": int(time.time()) if issued_at is None else issued_at,
+            "hashes": {kind: token_hash(tokens[kind]) for kind in TOKEN_KINDS},
+        }
+        if expires_at is not None:
+            self.issued[user]["expires_at"] = expires_at
+
+    def stale(self, request: Request) -> bool:
+        """Whether the user was issued tokens for another scope or group.
+
+        Users with no record, such as those signed before tokens were issued
+        here, are left alone.
+        """
+        unit, user, group = request
+        record = self.issued.get(user)
+        return bool(record) and (record["scope"], record["group"]) != (unit, group)
+
+    def verify(self, token: str) -> Optional[str]:
+        """The user a token was issued to, or None."""
+        user, _, _ = token.partition("::")
+        record = self.issued.get(user)
+        digest = token_hash(token)
+        if record and digest in record["hashes"].values():
+            return user
+        return None
+
+    def forget(self, user: str) -> None:
+        """Drop the record of a user's tokens."""
+        self.issued.pop(user, None)
+
+
+def _label_item(label: str) -> Tuple[str, str]:
+    key, _, value = label.partition("=")
+    return key, value
+
+
+def _taint_item(taint: str) -> Dict[str, str]:
+    key_value, _, effect = taint.rpartition(":")
+    key, _, value = key_value.partition("=")
+    item = {"key": key, "effect": effect}
+    if value:
+        item["value"] = value
+    return item
+
+
+def node_patch(
+    node: Mapping[str, Any],
+    taints: Iterable[Any],
+    labels: Iterable[Any],
+    applied_taints: Iterable[Any] = (),
+    applied_labels: Iterable[Any] = (),
+) -> Optional[Dict[str, Any]]:
+    """Minimal JSON merge patch applying the controller taints and labels.
+
+    @params node           - the node's current object, as returned by the API
+    @params taints         - desired taints, each as "key[=value]:effect"
+    @params labels         - desired labels, each as "key=value"
+    @params applied_taints - taints applied before, removed if no longer desired
+    @params applied_labels - labels applied before, removed if no longer desired
+
+    Taints are matched on key and effect, labels on key, and anything else on
+    the node is left alone. Returns None when the node is already up to date,
+    so a hook makes at most one patch call to the API server.
+
+    A merge patch replaces lists whole, so the patched taints include the
+    node's other taints as they were when it was read.
+    """
+    patch: Dict[str, Any] = {}
+
+    current_labels = (node.get("metadata") or {}).get("labels") or {}
+    desired_labels = dict(_label_item(str(label)) for label in labels)
+    label_patch = {
+        key: value
+        for key, value in desired_labels.items()
+        if current_labels.get(key) != value
+    }
+    for key, _ in (_label_item(str(label)) for label in applied_labels):
+        if key not in desired_labels and key in current_labels:
+            label_patch[key] = None
+    if label_patch:
+        patch["metadata"] = {"labels": label_patch}
+
+    current_taints = (node.get("spec") or {}).get("taints") or []
+    desired = {}
+    for taint in (_taint_item(str(taint)) for taint in taints):
+        desired[(taint["key"], taint["effect"])] = taint
+    stale = {
+        (taint["key"], taint["effect"])
+        for taint in (_taint_item(str(taint)) for taint in applied_taints)
+    } - desired.keys()
+    patched: List[Dict[str, Any]] = []
+    for taint in current_taints:
+        matched = (taint.get("key"), taint.get("effect"))
+        if matched in stale:
+            continue
+        wanted = desired.pop(matched, None)
+        if wanted and (taint.get("value") or "") != wanted.get("value", ""):
+            taint = wanted
+        patched.append(taint)
+    patched.extend(desired[matched] for matched in sorted(desired))
+    if patched != current_taints:
+        patch["spec"] = {"taints": patched}
+
+    return patch or None
+
+
+PROFILE_ENV = "KUBE_CONTROL_PROFILE"
+
+
+def hook_name() -> str:
+    """Name of the running hook, safe to use in a file name."""
+    name = os.environ.get("JUJU_HOOK_NAME") or os.path.basename(
+        os.environ.get("JUJU_DISPATCH_PATH", "")
+    )
+    return re.sub(r"[^\w.-]", "_", name) or "unknown"
+
+
+class HookProfiler:
+    """Opt in cProfile capture of interface method calls during a hook.
+
+    @params directory - where profiles are written, otherwise the directory
+                        named by $KUBE_CONTROL_PROFILE, and when neither is
+                        set profiling is off
+    @params label     - which class is profiled, part of each file name
+    @params keep      - most profiles kept in the directory
+
+    Calls made through methods of a @profiled class are collected into one
+    profile per hook, which dump() writes out as
+    <time>-<hook>-<label>-<units>units.prof, removing the oldest profiles
+    beyond keep. Read them with pstats, or summarise them with
+    `python core.py <directory>`.
+    """
+
+    def __init__(
+        self,
+        directory: Optional["os.PathLike[str]"] = None,
+        label: str = "kube-control",
+        keep: int = 20,
+    ):
+        directory = directory or os.environ.get(PROFILE_ENV)
+        self.directory = Path(directory) if directory else None
+        self.label = label
+        self.keep = keep
+        self.calls = 0
+        self._profile = None
+        self._depth = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether calls are profiled."""
+        return self.directory is not None
+
+    def call(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Call func, profiling it unless already inside a profiled call."""
+        if not self.enabled or self._depth:
+            return func(*args, **kwargs)
+        if self._profile is None:
+            import cProfile
+
+            self._profile = cProfile.Profile()
+        self.calls += 1
+        self._depth += 1
+        self._profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._profile.disable()
+            self._depth -= 1
+
+    def dump(self, units: int = 0) -> Optional[Path]:
+        """Write this hook's profile, if any calls were profiled."""
+        if self._profile is None or self.directory is None:
+            return None
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = f"{time.time_ns()}-{hook_name()}-{self.label}-{units}units.prof"
+        path = self.directory / name
+        self._profile.dump_stats(str(path))
+        self._profile = None
+        self.calls = 0
+        for old in sorted(self.directory.glob("*.prof"))[: -self.keep or None]:
+            old.unlink()
+        return path
+
+
+def _profiled_method(func: Callable) -> Callable:
+    if inspect.isgeneratorfunction(func):
+
+        @functools.wraps(func)
+        def generator(self, *args, **kwargs):
+            steps = func(self, *args, **kwargs)
+            while True:
+                try:
+                    item = self.profiler.call(next, steps)
+                except StopIteration:
+                    return
+                yield item
+
+        return generator
+
+    @functools.wraps(func)
+    def method(self, *args, **kwargs):
+        return self.profiler.call(func, self, *args, **kwargs)
+
+    return method
+
+
+def profiled(cls: type) -> type:
+    """Profile the public methods, properties and event handlers of cls.
+
+    Instances must have a profiler attribute holding a HookProfiler.
+    """
+    for name, attr in list(vars(cls).items()):
+        if name == "profiler" or (name.startswith("_") and not name.startswith("_on_")):
+            continue
+        if inspect.isfunction(attr):
+            setattr(cls, name, _profiled_method(attr))
+        elif isinstance(attr, property) and attr.fget:
+            setattr(cls, name, attr.getter(_profiled_method(attr.fget)))
+    return cls
+
+
+def profile_summary(
+    directory: "os.PathLike[str]", top: int = 15, sort: str = "tottime"
+) -> Tuple[int, List[Tuple[str, int, float, float]]]:
+    """The top hotspots across every profile captured in directory.
+
+    Returns the number of profiles read and up to top rows of
+    (function, calls, tottime, cumtime), sorted by sort.
+    """
+    import pstats
+
+    paths = sorted(str(path) for path in Path(directory).glob("*.prof"))
+    if not paths:
+        return 0, []
+    stats = pstats.Stats(*paths)
+    rows = [
+        (f"{file}:{line}({func})", calls, tottime, cumtime)
+        for (file, line, func), (_, calls, tottime, cumtime, _) in (
+            stats.stats.items()  # type: ignore[attr-defined]
+        )
+    ]
+    column = {"calls": 1, "tottime": 2, "cumtime": 3}[sort]
+    rows.sort(key=lambda row: row[column], reverse=True)
+    return len(paths), rows[:top]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Print the hotspots across captured hook profiles."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("directory", nargs="?", default=os.environ.get(PROFILE_ENV))
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--sort", choices=("calls", "tottime", "cumtime"), default="tottime"
+    )
+    args = parser.parse_args(argv)
+    if not args.directory:
+        parser.error(f"give a directory or set ${PROFILE_ENV}")
+    hooks, rows = profile_summary(args.directory, args.top, args.sort)
+    print(f"{hooks} hook profiles in {args.directory}")
+    print(f"{'calls':>8} {'tottime':>9} {'cumtime':>9}  function")
+    for function, calls, tottime, cumtime in rows:
+        print(f"{calls:>8} {tottime:>9.4f} {cumtime:>9.4f}  {function}")
+
+
+if __name__ == "__main__":
+    main()
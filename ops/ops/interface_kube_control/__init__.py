@@ -1,4 +1,32 @@
-from .provides import KubeControlProvides
-from .requires import KubeControlRequirer
+"""Implementation of the kube-control interface for ops charms.
 
-__all__ = ["KubeControlProvides", "KubeControlRequirer"]
+Submodules are imported when their names are first used, so hooks which
+never touch kube-control don't pay for loading them.
+"""
+
+import importlib
+
+_EXPORTS = {
+    "AuthRequestEvent": ".provides",
+    "Credentials": ".core",
+    "CredentialsChangedEvent": ".requires",
+    "DnsInfo": ".core",
+    "EndpointProber": ".endpoints",
+    "EndpointSet": ".core",
+    "KubeControlChangedEvent": ".requires",
+    "KubeControlProvides": ".provides",
+    "KubeControlRequirer": ".requires",
+    "PayloadBudgetError": ".core",
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
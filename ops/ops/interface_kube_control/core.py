@@ -0,0 +1 @@
+../../../core.py
\ No newline at end of file
@@ -0,0 +1,134 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Latency-aware ranking of kube-control API endpoints.
+
+Endpoints are probed with a plain TCP connect and the timings are cached
+for a short time so repeated hooks don't re-probe every control-plane.
+"""
+
+import json
+import logging
+import socket
+import time
+from os import PathLike
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+log = logging.getLogger("KubeControlEndpoints")
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+class EndpointProber:
+    """Probe and rank API endpoints by TCP connect latency.
+
+    The endpoint in use keeps its place unless another is faster by more
+    than margin, so endpoints with near-equal latency don't swap each time
+    the probes expire.
+
+    @params ttl        - seconds a probe result is reused before re-probing
+    @params timeout    - seconds to wait for a TCP connection
+    @params cache_path - optional file to persist probe results across hooks
+    @params clock      - wall clock used for cache expiry
+    @params margin     - seconds faster another endpoint must be to replace
+                         the one in use
+    @params budget     - total seconds spent probing in one rank; endpoints
+                         left unprobed count as unreachable
+    """
+
+    def __init__(
+        self,
+        ttl: float = 60.0,
+        timeout: float = 1.0,
+        cache_path: Optional[PathLike] = None,
+        clock: Callable[[], float] = time.time,
+        margin: float = 0.005,
+        budget: float = 2.0,
+    ):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.clock = clock
+        self.margin = margin
+        self.budget = budget
+        self._cache: Optional[Dict[str, Tuple[float, Optional[float]]]] = None
+
+    @property
+    def cache(self) -> Dict[str, Tuple[float, Optional[float]]]:
+        """Probe results keyed by url as (probed_at, latency or None)."""
+        if self._cache is None:
+            self._cache = {}
+            if self.cache_path and self.cache_path.exists():
+                try:
+                    loaded = json.loads(self.cache_path.read_text())
+                    self._cache = {url: tuple(entry) for url, entry in loaded.items()}
+                except (ValueError, TypeError, AttributeError):
+                    log.warning(f"Ignoring unreadable probe cache {self.cache_path}")
+        return self._cache
+
+    def _save(self) -> None:
+        if self.cache_path:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            self.cache_path.write_text(json.dumps(self.cache, sort_keys=True))
+
+    def _connect(self, url: str, timeout: float) -> Optional[float]:
+        parts = urlsplit(url)
+        try:
+            port = parts.port or DEFAULT_PORTS.get(parts.scheme)
+        except ValueError:
+            port = None
+        if not parts.hostname or not port:
+            return None
+        start = time.perf_counter()
+        try:
+            with socket.create_connection((parts.hostname, port), timeout):
+                pass
+        except OSError as e:
+            log.info(f"Endpoint {url} failed probe: {e}")
+            return None
+        return time.perf_counter() - start
+
+    def _fresh(self, url: str) -> bool:
+        cached = self.cache.get(url)
+        return bool(cached) and self.clock() - cached[0] < self.ttl
+
+    def probe(self, url: str, timeout: Optional[float] = None) -> Optional[float]:
+        """Connect latency to url in seconds, or None if unreachable."""
+        if self._fresh(url):
+            return self.cache[url][1]
+        now = self.clock()
+        latency = self._connect(url, self.timeout if timeout is None else timeout)
+        self.cache[url] = (now, latency)
+        return latency
+
+    def rank(self, urls: Iterable[str], current: Optional[str] = None) -> List[str]:
+        """Order urls fastest first; unreachable urls follow in sorted order.
+
+        current is the endpoint in use, which stays first while it's
+        reachable and no other is faster by more than margin.
+        """
+        urls = sorted(set(urls))
+        deadline = time.perf_counter() + self.budget
+        latencies = {}
+        # cached results cost nothing, and the endpoint in use goes next
+        for url in sorted(urls, key=lambda u: (not self._fresh(u), u != current)):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 and not self._fresh(url):
+                log.info(f"Endpoint {url} not probed, out of time")
+                latencies[url] = None
+            else:
+                latencies[url] = self.probe(url, min(self.timeout, remaining))
+        if urls:
+            self._save()
+
+        def _key(url):
+            latency = latencies[url]
+            return (latency is None, latency or 0.0, url)
+
+        ranked = sorted(urls, key=_key)
+        if latencies.get(current) is not None:
+            if latencies[current] - latencies[ranked[0]] <= self.margin:
+                ranked.remove(current)
+                ranked.insert(0, current)
+        return ranked
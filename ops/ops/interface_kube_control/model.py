@@ -1,7 +1,10 @@
-from pydantic import Field, AnyHttpUrl, BaseModel, Json
-from typing import List, Dict, Optional
+from pydantic import Field, AnyHttpUrl, BaseModel, Json, parse_obj_as
+from typing import Any, Iterator, List, Dict, Mapping, Optional, Union
+import json
 import re
 
+from .core import extract_creds
+
 
 class _ValidatedStr:
     def __init__(self, value, *groups) -> None:
@@ -24,6 +27,9 @@ class _ValidatedStr:
     def __repr__(self) -> str:
         return f"{type(self).__name__}({self._str},*{self.groups})"
 
+    def __str__(self) -> str:
+        return self._str
+
     @property
     def key(self) -> str:
         return self.groups[0]
@@ -50,13 +56,89 @@ class Creds(BaseModel):
     kubelet_token: str
     proxy_token: str
     scope: str
+    issued_at: Optional[int] = None
+    expires_at: Optional[int] = None
+
+
+class CredsRef(BaseModel):
+    """Creds kept in a Juju secret, which only the scope unit can read."""
+
+    scope: str
+    secret_id: str
+
+
+class LazyCreds(Mapping[str, Union[Creds, CredsRef]]):
+    """Map of user to Creds, decoding entries from the creds value on demand."""
+
+    def __init__(self, source: Union[str, Dict[str, Any]]) -> None:
+        self._raw = source if isinstance(source, str) else None
+        self._entries = None if isinstance(source, str) else source
+        self._creds: Dict[str, Union[Creds, CredsRef]] = {}
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, v):
+        if isinstance(v, cls):
+            return v
+        if isinstance(v, str):
+            if not v.lstrip().startswith("{"):
+                raise ValueError("creds must be a JSON object")
+            return cls(v)
+        if isinstance(v, dict):
+            return cls(v)
+        raise TypeError("JSON object required")
+
+    @property
+    def raw(self) -> str:
+        """The serialized creds map."""
+        if self._raw is None:
+            self._raw = json.dumps(_plain(self._entries), sort_keys=True)
+        return self._raw
+
+    def _all(self) -> Dict[str, Any]:
+        if self._entries is None:
+            try:
+                self._entries = json.loads(self._raw)
+            except ValueError:
+                # as with extract_creds, a malformed map has no entries
+                self._entries = {}
+        return self._entries
+
+    def __getitem__(self, user: str) -> Union[Creds, CredsRef]:
+        if user not in self._creds:
+            if self._entries is None:
+                entry = extract_creds(self._raw, user)
+            else:
+                entry = self._entries.get(user)
+            if entry is None:
+                raise KeyError(user)
+            if isinstance(entry, (Creds, CredsRef)):
+                self._creds[user] = entry
+            elif "secret_id" in entry:
+                self._creds[user] = CredsRef.parse_obj(entry)
+            else:
+                self._creds[user] = Creds.parse_obj(entry)
+        return self._creds[user]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._all())
+
+    def __len__(self) -> int:
+        return len(self._all())
 
 
 class Data(BaseModel):
     api_endpoints: Json[List[AnyHttpUrl]] = Field(alias="api-endpoints")
     cluster_tag: str = Field(alias="cluster-tag")
     cohort_keys: Optional[Json[Dict[str, str]]] = Field(alias="cohort-keys")
-    creds: Json[Dict[str, Creds]] = Field(alias="creds")
+    cohort_revisions: Optional[Json[Dict[str, int]]] = Field(
+        default=None, alias="cohort-revisions"
+    )
+    creds: LazyCreds = Field(alias="creds")
+    creds_generation: int = Field(default=0, alias="creds-generation")
     default_cni: Json[str] = Field(alias="default-cni")
     domain: str = Field(alias="domain")
     enable_kube_dns: bool = Field(alias="enable-kube-dns")
@@ -66,3 +148,57 @@ class Data(BaseModel):
     registry_location: str = Field(alias="registry-location")
     taints: Optional[Json[List[Taint]]] = Field(alias="taints")
     labels: Optional[Json[List[Label]]] = Field(alias="labels")
+
+    def to_snapshot(self) -> Dict[str, Any]:
+        """Plain JSON-serializable copy of the validated fields."""
+        return {name: _plain(getattr(self, name)) for name in self.__fields__}
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Dict[str, Any]) -> "Data":
+        """Rebuild from to_snapshot() output without revalidating every field.
+
+        The creds map is kept serialized and only decoded per user on
+        demand, which is where nearly all of the time goes on large clusters.
+        """
+        values = dict(snapshot)
+        values["api_endpoints"] = parse_obj_as(
+            List[AnyHttpUrl], snapshot["api_endpoints"]
+        )
+        values["creds"] = LazyCreds(snapshot["creds"])
+        for name, kind in (("taints", Taint), ("labels", Label)):
+            if snapshot.get(name) is not None:
+                values[name] = [kind.validate(_) for _ in snapshot[name]]
+        return cls.construct(**values)
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, LazyCreds):
+        return value.raw
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_plain(_) for _ in value]
+    if isinstance(value, (_ValidatedStr, AnyHttpUrl)):
+        return str(value)
+    return value
+
+
+class DataV2(Data):
+    """Data decoded from a single versioned kube-control-v2 document.
+
+    Values in the document are already native JSON types, so none of the
+    fields are individually JSON decoded.
+    """
+
+    api_endpoints: List[AnyHttpUrl] = Field(alias="api-endpoints")
+    cohort_keys: Optional[Dict[str, str]] = Field(alias="cohort-keys")
+    cohort_revisions: Optional[Dict[str, int]] = Field(
+        default=None, alias="cohort-revisions"
+    )
+    default_cni: str = Field(alias="default-cni")
+    has_xcp: bool = Field(alias="has-xcp")
+    port: int = Field(alias="port")
+    taints: Optional[List[Taint]] = Field(alias="taints")
+    labels: Optional[List[Label]] = Field(alias="labels")
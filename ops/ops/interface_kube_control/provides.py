@@ -1,19 +1,382 @@
 import json
+import logging
+import time
 from collections import namedtuple
+from os import PathLike
 
-from ops import CharmBase, Relation, Unit
-from .model import Creds
-from typing import List
+from ops import (
+    CharmBase,
+    ModelError,
+    Relation,
+    RelationDataContent,
+    Secret,
+    SecretNotFoundError,
+    Unit,
+)
+from ops.framework import EventBase, EventSource, Object, ObjectEvents, StoredState
+from .core import (
+    PAYLOAD_V2_KEY,
+    PAYLOAD_VERSION_KEY,
+    SERIALIZED_KEYS,
+    UNIT_KEYS,
+    HookProfiler,
+    PayloadMeter,
+    SigningQueue,
+    TokenIssuer,
+    decode_field,
+    decode_payload,
+    encode_fields,
+    encode_payload,
+    profiled,
+    refresh_requested,
+    request_digest,
+)
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+log = logging.getLogger("KubeControlProvides")
 
 AuthRequest = namedtuple("KubeControlAuthRequest", ["unit", "user", "group"])
 
 
-class KubeControlProvides:
-    """Implements the Provides side of the kube-control interface."""
+class AuthRequestEvent(EventBase):
+    """A unit's auth request was added, changed or withdrawn.
+
+    request is the current AuthRequest, or None when withdrawn.
+    previous is the last seen AuthRequest, or None when newly requested.
+    """
+
+    def __init__(
+        self,
+        handle,
+        request: Optional[AuthRequest] = None,
+        previous: Optional[AuthRequest] = None,
+    ):
+        super().__init__(handle)
+        self.request = request
+        self.previous = previous
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Save event information."""
+        return {
+            "request": self.request and list(self.request),
+            "previous": self.previous and list(self.previous),
+        }
+
+    def restore(self, snapshot: Dict[str, Any]) -> None:
+        """Restore event information."""
+        self.request = snapshot["request"] and AuthRequest(*snapshot["request"])
+        self.previous = snapshot["previous"] and AuthRequest(*snapshot["previous"])
+
+
+class KubeControlProvidesEvents(ObjectEvents):
+    """Events emitted for changes to auth requests."""
+
+    auth_requested = EventSource(AuthRequestEvent)
+    auth_request_changed = EventSource(AuthRequestEvent)
+    auth_request_withdrawn = EventSource(AuthRequestEvent)
+
+
+@profiled
+class KubeControlProvides(Object):
+    """Implements the Provides side of the kube-control interface.
+
+    With payload_version=2 every field is published in a single
+    kube-control-v2 document to relations where all remote units advertise
+    support for it, and as individual keys everywhere else.
+
+    A digest of each unit's auth request is kept in charm state, so relation
+    hooks only look at the unit which changed and emit events on `on` for
+    requests which were added, changed or withdrawn. A unit asking for its
+    expiring creds to be refreshed changes its request. On upgrade-charm,
+    and the first relation hook where nothing was kept yet, every unit's
+    request is looked at, so requests made before the charm used these
+    events are emitted too.
+
+    With app_databag, the leader publishes the shared fields once in the
+    application databag rather than every unit publishing them in its own,
+    and the other units publish nothing.
+
+    Writes are buffered for the rest of the hook and flushed as one bulk
+    update per relation when the framework commits, or by calling flush().
+    backend_calls counts those updates.
 
-    def __init__(self, charm: CharmBase, endpoint: str):
+    Auth requests waiting to be signed are kept in a queue in charm state.
+    pending_auth_requests() hands out at most sign_batch_size of them, or as
+    many as fit in sign_time_budget seconds, per hook, and the rest wait for
+    later hooks. See queue_depth and drain_estimate. issue_tokens() signs
+    them with tokens it generates, keeping only their hashes.
+
+    With creds_secrets, each unit's tokens are kept in a Juju secret granted
+    only to that unit, and the creds in relation data only refer to it. So
+    new tokens for one unit only wake that unit, through secret-changed.
+    The secrets are owned by the app, so only the leader can sign requests.
+
+    The bytes written to each relation are measured as they're published,
+    see payload_stats. Writes which take a relation's databag over
+    payload_budget bytes log a warning, or raise PayloadBudgetError when
+    refuse_over_budget is set.
+
+    With a profile_dir, or $KUBE_CONTROL_PROFILE set, calls into the
+    provider are profiled and each hook's profile is saved there.
+    """
+
+    _stored = StoredState()
+    on = KubeControlProvidesEvents()
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        endpoint: str,
+        payload_version: int = 1,
+        payload_budget: Optional[int] = None,
+        refuse_over_budget: bool = False,
+        app_databag: bool = False,
+        sign_batch_size: Optional[int] = None,
+        sign_time_budget: Optional[float] = None,
+        profile_dir: Optional[PathLike] = None,
+        creds_secrets: bool = False,
+    ):
+        super().__init__(charm, f"relation-{endpoint}")
         self.charm = charm
         self.endpoint = endpoint
+        self.payload_version = payload_version
+        self.app_databag = app_databag
+        self.creds_secrets = creds_secrets
+        self.sign_batch_size = sign_batch_size
+        self.sign_time_budget = sign_time_budget
+        self._signing_queue: Optional[SigningQueue] = None
+        self._signed = set()
+        self._writes: Dict[int, Tuple[Relation, Dict[str, str]]] = {}
+        self.backend_calls = 0
+        self.payload_meter = PayloadMeter(payload_budget, refuse_over_budget)
+        self.profiler = HookProfiler(profile_dir, f"{endpoint}-provides")
+        self._token_issuer: Optional[TokenIssuer] = None
+        self._stored.set_default(
+            requests="{}",
+            creds_generation=0,
+            sign_queue="{}",
+            tokens="{}",
+            requests_seeded=False,
+        )
+        events = charm.on[endpoint]
+        self.framework.observe(events.relation_changed, self._on_relation_changed)
+        self.framework.observe(events.relation_departed, self._on_relation_departed)
+        self.framework.observe(events.relation_broken, self._on_relation_broken)
+        self.framework.observe(charm.on.upgrade_charm, self._on_upgrade_charm)
+        self.framework.observe(charm.on.secret_remove, self._on_secret_remove)
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
+        if self.profiler.enabled:
+            self.framework.observe(self.framework.on.commit, self._dump_profile)
+
+    def _dump_profile(self, _event) -> None:
+        self.profiler.dump(sum(len(r.units) for r in self.relations))
+
+    def _update_request(
+        self,
+        unit_name: str,
+        request: Optional[AuthRequest],
+        refresh: Optional[str] = None,
+    ) -> None:
+        """Record a unit's current request and emit what changed."""
+        seen = json.loads(self._stored.requests)
+        previous = seen.get(unit_name)
+        digest = request and request_digest(*request, *filter(None, [refresh]))
+        if previous and previous["digest"] == digest:
+            return
+        if request:
+            seen[unit_name] = {"digest": digest, "request": list(request)}
+        else:
+            seen.pop(unit_name, None)
+        self._stored.requests = json.dumps(seen, sort_keys=True)
+
+        previous = previous and AuthRequest(*previous["request"])
+        if not previous and request:
+            self.on.auth_requested.emit(request, None)
+        elif previous and request:
+            self.on.auth_request_changed.emit(request, previous)
+        elif previous:
+            self.on.auth_request_withdrawn.emit(None, previous)
+
+    def _update_unit(self, relation: Relation, unit: Unit) -> None:
+        data = relation.data[unit]
+        user, group = data.get("kubelet_user"), data.get("auth_group")
+        request = AuthRequest(unit.name, user, group) if user and group else None
+        self._update_request(unit.name, request, data.get("auth_refresh"))
+
+    def _update_all(self) -> None:
+        """Record every unit's current request."""
+        for relation in self.relations:
+            for unit in sorted(relation.units, key=lambda unit: unit.name):
+                self._update_unit(relation, unit)
+        self._stored.requests_seeded = True
+
+    def _on_upgrade_charm(self, _event) -> None:
+        self._update_all()
+
+    def _on_secret_remove(self, event) -> None:
+        label = event.secret.label or ""
+        if label == self._tokens_label or label.startswith(f"{self.endpoint}-creds-"):
+            # revisions no longer read by anyone
+            event.remove_revision()
+
+    def _on_relation_changed(self, event) -> None:
+        if not event.unit or event.unit.app is self.charm.app:
+            return
+        if not self._stored.requests_seeded:
+            self._update_all()
+            return
+        self._update_unit(event.relation, event.unit)
+
+    def _on_relation_departed(self, event) -> None:
+        unit = event.departing_unit or event.unit
+        if unit:
+            self._update_request(unit.name, None)
+        if unit and self.creds_secrets and self.unit.is_leader():
+            # the departed unit's tokens go with it
+            try:
+                secret = self.model.get_secret(label=self._secret_label(unit.name))
+            except SecretNotFoundError:
+                return
+            secret.remove_all_revisions()
+
+    def _on_relation_broken(self, event) -> None:
+        remaining = {
+            unit.name
+            for relation in self.relations
+            if relation.id != event.relation.id
+            for unit in relation.units
+        }
+        for unit_name in json.loads(self._stored.requests):
+            if unit_name not in remaining:
+                self._update_request(unit_name, None)
+
+    def _relation_version(self, relation: Relation) -> int:
+        """Payload version negotiated with the remote units of a relation."""
+        if self.payload_version < 2 or not relation.units:
+            return 1
+        remote = min(
+            int(relation.data[unit].get(PAYLOAD_VERSION_KEY) or 1)
+            for unit in relation.units
+        )
+        return min(remote, self.payload_version)
+
+    def _databag(self, relation: Relation) -> Optional[RelationDataContent]:
+        """Where this unit publishes to a relation, or None if it doesn't."""
+        if not self.app_databag:
+            return relation.data[self.unit]
+        if self.unit.is_leader():
+            return relation.data[self.charm.app]
+        return None
+
+    def _published(self, relation: Relation, key: str, default: Any = None) -> Any:
+        """Decoded value of a key this unit published to a relation."""
+        data = self._databag(relation)
+        if data is None:
+            return default
+        return self._fields(relation, data).get(key, default)
+
+    def _read(
+        self, relation: Relation, data: RelationDataContent, key: str
+    ) -> Optional[str]:
+        """A key's value in a databag, including writes not yet flushed."""
+        pending = self._writes.get(relation.id)
+        if pending and key in pending[1]:
+            return pending[1][key] or None
+        return data.get(key)
+
+    def _keys(self, relation: Relation, data: RelationDataContent) -> List[str]:
+        """Keys this unit publishes in a databag, including unflushed writes."""
+        pending = self._writes.get(relation.id, (relation, {}))[1]
+        keys = (set(data) | set(pending)) - UNIT_KEYS
+        return sorted(key for key in keys if self._read(relation, data, key))
+
+    def _fields(self, relation: Relation, data: RelationDataContent) -> Dict[str, Any]:
+        """Every field this unit publishes to a relation, as native values."""
+        fields = {
+            key: decode_field(key, value) if key in SERIALIZED_KEYS else value
+            for key, value in decode_payload(
+                self._read(relation, data, PAYLOAD_V2_KEY)
+            ).items()
+        }
+        # only one encoding is kept at a time, but single keys left beside a
+        # v2 document by earlier versions hold the newer values
+        for key in self._keys(relation, data):
+            if key != PAYLOAD_V2_KEY:
+                fields[key] = decode_field(key, self._read(relation, data, key))
+        return fields
+
+    def _publish(self, key: str, value: Any) -> None:
+        """Publish a field's native value to every relation.
+
+        None removes the field. Each relation gets every field in the
+        encoding its remote units support, and the other encoding is
+        removed, so a relation moving between v1 and v2 carries the same
+        fields in either.
+        """
+        for relation in self.relations:
+            data = self._databag(relation)
+            if data is None:
+                continue
+            fields = self._fields(relation, data)
+            if value is None:
+                fields.pop(key, None)
+            else:
+                fields[key] = value
+            keys = self._keys(relation, data)
+            if self._relation_version(relation) >= 2:
+                encoded = {PAYLOAD_V2_KEY: encode_payload(fields)} if fields else {}
+            else:
+                encoded = encode_fields(fields)
+                # single keys already published keep their exact value
+                for k in keys:
+                    if k not in (key, PAYLOAD_V2_KEY):
+                        encoded[k] = self._read(relation, data, k)
+            encoded.update({k: "" for k in keys if k not in encoded})
+            updates = {
+                k: v
+                for k, v in encoded.items()
+                if (self._read(relation, data, k) or "") != v
+            }
+            if not updates:
+                continue
+            name = f"{relation.name}:{relation.id}"
+            if self.app_databag:
+                name += f"/{self.charm.app.name}"
+            self.payload_meter.publish(name, data, updates)
+            self._writes.setdefault(relation.id, (relation, {}))[1].update(updates)
+
+    def flush(self) -> None:
+        """Write the buffered updates, with one bulk update per relation.
+
+        This runs when the framework commits at the end of each hook, and
+        only keys whose value changed are written.
+        """
+        for relation, updates in self._writes.values():
+            data = self._databag(relation)
+            if data is None:
+                continue
+            changed = {k: v for k, v in updates.items() if data.get(k, "") != v}
+            if changed:
+                data.update(changed)
+                self.backend_calls += 1
+        self._writes.clear()
+
+    def _on_pre_commit(self, _event) -> None:
+        self.flush()
+        # state read for this hook mustn't leak into the next one when the
+        # charm outlives it, as it does under Harness
+        self._signing_queue = None
+        self._token_issuer = None
+        self._signed.clear()
+
+    @property
+    def payload_stats(self) -> Dict[str, Dict[str, int]]:
+        """Bytes published by this unit in this hook, per databag key.
+
+        Each key maps to its total across relations, the most in any one
+        relation, and its growth in this hook.
+        """
+        return self.payload_meter.stats
 
     @property
     def auth_requests(self) -> List[AuthRequest]:
@@ -28,13 +391,154 @@ class KubeControlProvides:
         requests.sort()
         return requests
 
+    @property
+    def signing_queue(self) -> SigningQueue:
+        """Auth requests which haven't been signed, oldest first.
+
+        Requests to refresh creds come first, the soonest to expire first.
+        """
+        if self._signing_queue is None:
+            creds, refresh = {}, {}
+            for relation in self.relations:
+                creds.update(self._published(relation, "creds", {}))
+                for unit in relation.units:
+                    refresh[unit.name] = relation.data[unit].get("auth_refresh")
+
+            def entry(r):
+                # a previous leader's creds, and the expiry of creds kept in
+                # secrets, are known from the issuer records
+                return {**issuer.issued.get(r[1], {}), **creds.get(r[1], {})}
+
+            def refreshing(r):
+                if entry(r) and refresh_requested(entry(r), refresh.get(r[0])):
+                    return entry(r)["expires_at"]
+                return None
+
+            def done(r):
+                signed = (entry(r) or {}).get("scope") == r[0]
+                return signed and refreshing(r) is None and not issuer.stale(r)
+
+            issuer = self.token_issuer
+
+            self._signing_queue = SigningQueue(
+                json.loads(self._stored.sign_queue),
+                self.sign_batch_size,
+                self.sign_time_budget,
+            )
+            self._signing_queue.sync(self.auth_requests, done, refreshing)
+        return self._signing_queue
+
+    def pending_auth_requests(self) -> Iterator[AuthRequest]:
+        """The auth requests to sign in this hook.
+
+        Each should be signed with sign_auth_request before asking for the
+        next. Requests left unsigned go to the back of the queue.
+        """
+        queue = self.signing_queue
+        try:
+            for request in queue.batch(lambda r: (r[0], r[1]) in self._signed):
+                yield AuthRequest(*request)
+        finally:
+            self._stored.sign_queue = json.dumps(queue.dump())
+
+    @property
+    def token_issuer(self) -> TokenIssuer:
+        """Hashes of the tokens issued by issue_tokens, kept in charm state.
+
+        The leader keeps them in an app-owned secret too, so the next leader
+        knows which requests were signed before it and doesn't sign them
+        again.
+        """
+        if self._token_issuer is None:
+            self._token_issuer = TokenIssuer(json.loads(self._stored.tokens))
+            secret = self._tokens_secret()
+            if secret:
+                shared = secret.get_content(refresh=True).get("tokens")
+                self._token_issuer.merge(json.loads(shared or "{}"))
+        return self._token_issuer
+
+    @property
+    def _tokens_label(self) -> str:
+        return f"{self.endpoint}-tokens"
+
+    def _tokens_secret(self) -> Optional[Secret]:
+        """The app's secret holding the issuer records, if this is the leader."""
+        if not self.unit.is_leader():
+            return None
+        try:
+            return self.model.get_secret(label=self._tokens_label)
+        except SecretNotFoundError:
+            return None
+        except ModelError as e:
+            log.warning(f"Issued tokens can't be shared with the next leader: {e}")
+            return None
+
+    def _share_tokens(self, issuer: TokenIssuer) -> None:
+        """Keep the issuer records where the next leader finds them."""
+        if not self.unit.is_leader():
+            return
+        content = {"tokens": json.dumps(issuer.dump(), sort_keys=True)}
+        secret = self._tokens_secret()
+        try:
+            if secret is None:
+                self.charm.app.add_secret(content, label=self._tokens_label)
+            elif secret.get_content(refresh=True) != content:
+                secret.set_content(content)
+        except ModelError as e:
+            log.warning(f"Issued tokens can't be shared with the next leader: {e}")
+
+    def issue_tokens(self, ttl: Optional[int] = None) -> List[AuthRequest]:
+        """Generate and send tokens for this hook's pending auth requests.
+
+        Tokens for the whole batch come from one read of the RNG, and only
+        their hashes are kept, see token_issuer. Signed requests leave the
+        queue, so later hooks, and later leaders, don't generate new tokens
+        for the same user, group and scope. ttl is how many seconds the
+        tokens are valid for.
+
+        Returns the requests signed.
+        """
+        issuer = self.token_issuer
+        batch = self.signing_queue.pending[: self.sign_batch_size]
+        tokens = issuer.issue(batch)
+        signed = []
+        for request in self.pending_auth_requests():
+            fresh = tokens.get(tuple(request)) or issuer.issue([request])[request]
+            issued_at = int(time.time())
+            expires_at = None if ttl is None else issued_at + ttl
+            self.sign_auth_request(request, **fresh, expires_at=expires_at)
+            issuer.record(request, fresh, issued_at, expires_at)
+            signed.append(request)
+        self._stored.tokens = json.dumps(issuer.dump())
+        if signed:
+            self._share_tokens(issuer)
+        return signed
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of auth requests waiting to be signed."""
+        return self.signing_queue.depth
+
+    @property
+    def drain_estimate(self) -> Dict[str, Optional[float]]:
+        """Estimated seconds of signing and hooks until the queue is empty.
+
+        Either is None until enough requests have been timed to tell.
+        """
+        queue = self.signing_queue
+        return {"seconds": queue.drain_seconds, "hooks": queue.drain_hooks}
+
     def clear_creds(self) -> None:
         """Clear creds from the relation. This is used by non-leader units to
         stop advertising creds so that the leader can assume full control of
         them.
+
+        The creds generation is cleared too, the next unit to sign requests
+        starts a new one.
         """
-        for relation in self.relations:
-            relation.data[self.unit]["creds"] = ""
+        self._stored.creds_generation = 0
+        self._publish("creds", None)
+        self._publish("creds-generation", None)
 
     @property
     def ingress_addresses(self) -> List[str]:
@@ -56,89 +560,136 @@ class KubeControlProvides:
 
     def set_api_endpoints(self, endpoints) -> None:
         """Send the list of API endpoint URLs to which workers should connect."""
-        endpoints = json.dumps(endpoints)
-        for relation in self.relations:
-            relation.data[self.unit]["api-endpoints"] = endpoints
+        self._publish("api-endpoints", endpoints)
 
     def set_cluster_name(self, cluster_name) -> None:
         """Send the cluster name to the remote units."""
-        for relation in self.relations:
-            relation.data[self.unit]["cluster-tag"] = cluster_name
+        self._publish("cluster-tag", cluster_name)
 
     def set_default_cni(self, default_cni) -> None:
         """Send the default CNI. The default_cni value should be a string
         containing the name of a related CNI application to use as the default
         CNI. For example: "flannel" or "calico". If no default has been chosen
         then "" can be sent instead."""
-        value = json.dumps(default_cni)
-        for relation in self.relations:
-            relation.data[self.unit]["default-cni"] = value
+        self._publish("default-cni", default_cni)
 
     def set_dns_address(self, address) -> None:
         """Send DNS address to the remote units for use in Kubelet configuration.
         This will typically be the cluster IP of the kube-dns service belonging
         to CoreDNS."""
-        for relation in self.relations:
-            relation.data[self.unit]["sdn-ip"] = address
+        self._publish("sdn-ip", address)
 
     def set_dns_domain(self, domain) -> None:
         """Send DNS domain to the remote units for use in Kubelet configuration."""
-        for relation in self.relations:
-            relation.data[self.unit]["domain"] = domain
+        self._publish("domain", domain)
 
     def set_dns_enabled(self, enabled) -> None:
         """Send DNS enabled status. This indicates to remote units if they should
         wait for DNS info or not."""
-        value = str(enabled)
-        for relation in self.relations:
-            relation.data[self.unit]["enable-kube-dns"] = value
+        self._publish("enable-kube-dns", bool(enabled))
 
     def set_dns_port(self, port) -> None:
         """Send DNS port to the remote units for use in Kubelet configuration."""
-        value = str(port)
-        for relation in self.relations:
-            relation.data[self.unit]["port"] = value
+        self._publish("port", int(port))
 
     def set_has_external_cloud_provider(self, has_xcp) -> None:
         """Send indicator to remote units that an external cloud provider is in use."""
-        value = str(has_xcp).lower()
-        for relation in self.relations:
-            relation.data[self.unit]["has-xcp"] = value
+        self._publish("has-xcp", bool(has_xcp))
 
     def set_image_registry(self, image_registry) -> None:
         """Send the image registry location to the remote units."""
-        for relation in self.relations:
-            relation.data[self.unit]["registry-location"] = image_registry
+        self._publish("registry-location", image_registry)
 
     def set_labels(self, labels) -> None:
         """Send the Juju config labels of the control-plane."""
-        value = json.dumps(labels)
-        for relation in self.relations:
-            relation.data[self.unit]["labels"] = value
+        self._publish("labels", labels)
 
     def set_taints(self, taints) -> None:
         """Send the Juju config taints of the control-plane."""
-        value = json.dumps(taints)
-        for relation in self.relations:
-            relation.data[self.unit]["taints"] = value
+        self._publish("taints", taints)
 
     def sign_auth_request(
-        self, request, client_token, kubelet_token, proxy_token
+        self,
+        request,
+        client_token,
+        kubelet_token,
+        proxy_token,
+        expires_at: Optional[int] = None,
+        issued_at: Optional[int] = None,
     ) -> None:
-        """Send authorization tokens to the requesting unit."""
+        """Send authorization tokens to the requesting unit.
+
+        expires_at and issued_at are unix timestamps, where issued_at
+        defaults to now for tokens which expire.
+        """
+        from .model import Creds, CredsRef
+
+        if expires_at is not None and issued_at is None:
+            issued_at = int(time.time())
         creds = {}
         for relation in self.relations:
-            creds.update(json.loads(relation.data[self.unit].get("creds", "{}")))
-        creds[request.user] = Creds(
+            creds.update(self._published(relation, "creds", {}))
+        entry = Creds(
             client_token=client_token,
             kubelet_token=kubelet_token,
             proxy_token=proxy_token,
             scope=request.unit,
-        ).dict()
+            issued_at=issued_at,
+            expires_at=expires_at,
+        )
+        if self.creds_secrets:
+            secret = self._creds_secret(entry)
+            # the expiry is only in the secret, so new tokens don't change
+            # the creds every unit reads
+            entry = CredsRef(
+                scope=request.unit, secret_id=secret.id or secret.get_info().id
+            )
+        creds[request.user] = entry.dict(exclude_none=True)
+
+        self._publish("creds", creds)
+        self._signed.add((request.unit, request.user))
+        generation = self.creds_generation
+        self._publish("creds-generation", generation)
+
+    def _secret_label(self, unit_name: str) -> str:
+        return f"{self.endpoint}-creds-{unit_name.replace('/', '-')}"
 
-        value = json.dumps(creds)
+    def _creds_secret(self, creds) -> Secret:
+        """The secret holding a unit's tokens, granted only to that unit.
+
+        The secrets are owned by the app and managed by the leader, so the
+        next leader updates the same secret. A new revision is only made when
+        the tokens change.
+        """
+        content = {
+            key.replace("_", "-"): str(value)
+            for key, value in creds.dict(exclude_none=True).items()
+        }
+        label = self._secret_label(creds.scope)
+        try:
+            secret = self.model.get_secret(label=label)
+        except SecretNotFoundError:
+            secret = self.charm.app.add_secret(content, label=label)
+        else:
+            if secret.get_content(refresh=True) != content:
+                secret.set_content(content)
         for relation in self.relations:
-            relation.data[self.unit]["creds"] = value
+            for unit in relation.units:
+                if unit.name == creds.scope:
+                    secret.grant(relation, unit=unit)
+        return secret
+
+    @property
+    def creds_generation(self) -> int:
+        """Generation of the creds published by this unit.
+
+        A new generation starts, from the current time in milliseconds, the
+        first time this unit signs requests after creds were cleared, so it
+        is higher than the generation published by any previous leader.
+        """
+        if not self._stored.creds_generation:
+            self._stored.creds_generation = int(time.time() * 1000)
+        return self._stored.creds_generation
 
     @property
     def unit(self) -> Unit:
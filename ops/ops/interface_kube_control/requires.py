@@ -6,46 +6,493 @@ This re-implements the requires side of the interface in ops.framework
 style rather than the reactive style.
 """
 
-import base64
+import json
 import logging
+import time
 from os import PathLike
 from pathlib import Path
-from typing import Optional, Mapping, List
-
-import yaml
-from backports.cached_property import cached_property
-from .model import Data, Taint, Label
-from pydantic import ValidationError
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from .core import (
+    PAYLOAD_VERSION_KEY,
+    Credentials,
+    DnsInfo,
+    EndpointSet,
+    HookProfiler,
+    carry_creds,
+    changed_cohorts,
+    changed_keys,
+    databag_sizes,
+    databags_digest,
+    merge_databags,
+    node_patch,
+    profiled,
+    read_snapshot,
+    refresh_at,
+    size_stats,
+    write_snapshot,
+)
+
+try:
+    from functools import cached_property
+except ImportError:  # Python 3.7
+    from backports.cached_property import cached_property
+
+if TYPE_CHECKING:
+    # pydantic, yaml and the models are only imported once they're used
+    from .endpoints import EndpointProber
+    from .model import Creds, Data, Label, Taint
 
 from ops.charm import CharmBase, RelationBrokenEvent
-from ops.framework import Object
-from ops.model import Relation
+from ops.framework import EventBase, EventSource, Object, ObjectEvents, StoredState
+from ops.model import (
+    ModelError,
+    Relation,
+    RelationDataContent,
+    SecretNotFoundError,
+)
 
 log = logging.getLogger("KubeControlRequirer")
 
+DNS_FIELDS = ("port", "domain", "sdn_ip", "enable_kube_dns")
+
+
+class KubeControlChangedEvent(EventBase):
+    """Related kube-control data changed from old to new."""
+
+    def __init__(self, handle, old: Any = None, new: Any = None):
+        super().__init__(handle)
+        self.old = old
+        self.new = new
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Save event information."""
+        return {"old": self.old, "new": self.new}
+
+    def restore(self, snapshot: Dict[str, Any]) -> None:
+        """Restore event information."""
+        self.old = snapshot["old"]
+        self.new = snapshot["new"]
+
+
+class CredentialsChangedEvent(KubeControlChangedEvent):
+    """Credentials for the requested user changed from old to new."""
+
+    def __init__(self, handle, user: str = "", old: Any = None, new: Any = None):
+        super().__init__(handle, old, new)
+        self.user = user
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Save event information."""
+        return dict(super().snapshot(), user=self.user)
+
+    def restore(self, snapshot: Dict[str, Any]) -> None:
+        """Restore event information."""
+        super().restore(snapshot)
+        self.user = snapshot["user"]
+
+
+class KubeControlRequirerEvents(ObjectEvents):
+    """Events emitted when the related kube-control data changes."""
+
+    api_endpoints_changed = EventSource(KubeControlChangedEvent)
+    cohort_keys_changed = EventSource(KubeControlChangedEvent)
+    credentials_changed = EventSource(CredentialsChangedEvent)
+    default_cni_changed = EventSource(KubeControlChangedEvent)
+    dns_changed = EventSource(KubeControlChangedEvent)
+    labels_changed = EventSource(KubeControlChangedEvent)
+    taints_changed = EventSource(KubeControlChangedEvent)
+
+
+def _user_creds(creds, user: str) -> Optional[Dict[str, str]]:
+    """One user's creds from a snapshot as a plain dict, if present."""
+    from pydantic import ValidationError
+
+    from .model import LazyCreds
 
+    if not creds:
+        return None
+    try:
+        return LazyCreds(creds)[user].dict(exclude_none=True)
+    except (KeyError, ValidationError):
+        return None
+
+
+def _secret_creds(content: Mapping[str, str]) -> "Creds":
+    """Creds from the content of the secret holding them."""
+    from .model import Creds
+
+    return Creds.parse_obj({key.replace("-", "_"): v for key, v in content.items()})
+
+
+@profiled
 class KubeControlRequirer(Object):
     """
     Implements the requirer side of the kube-control interface.
+
+    A digest of the merged relation data and the validated result are kept
+    in charm state for each relation, so hooks where the relation data hasn't
+    changed skip parsing and validation entirely.
+
+    With several kube-control relations, such as while migrating between
+    control-planes, data is read from the active relation, see relation and
+    select_relation. Requests are written to every kube-control relation.
+
+    Events on `on` fire from relation hooks only for data which differs from
+    what was last emitted, carrying the old and new values.
+
+    With a snapshot_path, the last validated data is also kept on disk. While
+    the relation exists but its data is missing or not yet valid, such as
+    straight after a reboot or upgrade, that snapshot is served instead and
+    is_stale is True until fresh relation data replaces it.
+
+    Creds the provider keeps in a Juju secret, see creds_secrets on
+    KubeControlProvides, are read from that secret, and credentials_changed
+    also fires when the secret's content changes.
+
+    With a profile_dir, or $KUBE_CONTROL_PROFILE set, calls into the
+    requirer are profiled and each hook's profile is saved there.
     """
 
-    def __init__(self, charm: CharmBase, endpoint: str = "kube-control"):
+    _stored = StoredState()
+    on = KubeControlRequirerEvents()
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        endpoint: str = "kube-control",
+        endpoint_prober: Optional["EndpointProber"] = None,
+        snapshot_path: Optional[PathLike] = None,
+        profile_dir: Optional[PathLike] = None,
+    ):
         super().__init__(charm, f"relation-{endpoint}")
         self.endpoint = endpoint
+        self.endpoint_prober = endpoint_prober
+        self.snapshot_path = Path(snapshot_path) if snapshot_path else None
+        self.profiler = HookProfiler(profile_dir, f"{endpoint}-requires")
+        self._stale = False
+        self._changed_fields: Set[str] = set()
+        self._merge_conflicts: Optional[Dict[str, Dict[str, Any]]] = {}
+        self._sizes: Dict[int, Tuple[Relation, Dict[str, Dict[str, int]]]] = {}
+        self._stored.set_default(
+            emitted="",
+            cohorts="{}",
+            relations={},
+            active_relation=None,
+            known_creds="{}",
+        )
+        for event in ("relation_changed", "relation_departed"):
+            self.framework.observe(
+                getattr(charm.on[endpoint], event), self._on_relation_changed
+            )
+        self.framework.observe(
+            charm.on[endpoint].relation_broken, self._on_relation_broken
+        )
+        self.framework.observe(charm.on.secret_changed, self._on_secret_changed)
+        self.framework.observe(self.framework.on.pre_commit, self._keep_sizes)
+        if self.profiler.enabled:
+            self.framework.observe(self.framework.on.commit, self._dump_profile)
+
+    def _dump_profile(self, _event) -> None:
+        self.profiler.dump(sum(len(r.units) for r in self.relations))
+
+    @property
+    def relations(self) -> List[Relation]:
+        """Every relation on this endpoint."""
+        return self.model.relations[self.endpoint]
 
     @cached_property
     def relation(self) -> Optional[Relation]:
-        """The lone relation endpoint or None."""
-        return self.model.get_relation(self.endpoint)
+        """The active relation or None.
+
+        This is the relation picked with select_relation, otherwise the
+        oldest relation with remote units, and then the oldest relation.
+        """
+        relations = sorted(self.relations, key=lambda relation: relation.id)
+        selected = [r for r in relations if r.id == self._stored.active_relation]
+        joined = [r for r in relations if r.units]
+        return next(iter(selected + joined + relations), None)
+
+    def select_relation(self, relation_id: Optional[int]) -> None:
+        """Read data from the relation with this id, or None to pick one."""
+        self._stored.active_relation = relation_id
+        self._forget()
+
+    def _state(self, relation: Relation) -> MutableMapping[str, str]:
+        """Digest, validated snapshot and payload sizes kept for a relation."""
+        key = str(relation.id)
+        if key not in self._stored.relations:
+            self._stored.relations[key] = dict(digest="", snapshot="", sizes="{}")
+        return self._stored.relations[key]
+
+    def _forget(self) -> None:
+        """Drop the data and read views cached earlier in this dispatch."""
+        for name in ("relation", "_data", "_ready", "_dns", "_endpoints", "_creds"):
+            self.__dict__.pop(name, None)
 
     @cached_property
-    def _data(self) -> Optional[Data]:
-        if self.relation and self.relation.units:
-            rx = {}
-            for unit in self.relation.units:
-                rx.update(self.relation.data[unit])
-            return Data(**rx)
-        return None
+    def _ready(self) -> Optional["Data"]:
+        """The data if it's ready, checked once until the data changes."""
+        return self._data if self.is_ready else None
+
+    @cached_property
+    def _dns(self) -> DnsInfo:
+        data = self._ready
+        return DnsInfo(
+            {
+                "port": data and data.port,
+                "domain": data and data.domain,
+                "sdn-ip": data and data.sdn_ip,
+                "enable-kube-dns": data and data.enable_kube_dns,
+            }
+        )
+
+    @cached_property
+    def _endpoints(self) -> EndpointSet:
+        return EndpointSet((self._ready and self._ready.api_endpoints) or [])
+
+    @cached_property
+    def _creds(self) -> Dict[str, Optional[Credentials]]:
+        return {}
+
+    @cached_property
+    def _data(self) -> Optional["Data"]:
+        from pydantic import ValidationError
+
+        from .model import Data
+
+        self._stale = False
+        try:
+            data = None
+            if self.relation:
+                data, self._changed_fields, self._merge_conflicts = self._load(
+                    self.relation
+                )
+        except ValidationError:
+            stale = self.relation and self._read_snapshot()
+            if not stale:
+                raise
+            data = None
+        else:
+            stale = data is None and self.relation and self._read_snapshot()
+        if stale:
+            log.info(f"{self.endpoint} serving last known good data, marked stale")
+            self._stale = True
+            return Data.from_snapshot(stale)
+        if data is not None and self.snapshot_path:
+            if self._changed_fields or not self.snapshot_path.exists():
+                snapshot = self._state(self.relation)["snapshot"]
+                write_snapshot(self.snapshot_path, json.loads(snapshot))
+        return data
+
+    def _read_snapshot(self) -> Optional[Dict[str, Any]]:
+        return read_snapshot(self.snapshot_path) if self.snapshot_path else None
+
+    @property
+    def is_stale(self) -> bool:
+        """Whether the data served is the snapshot rather than from the relation."""
+        return self.is_ready and self._stale
+
+    def _load(
+        self, relation: Relation
+    ) -> Tuple[Optional["Data"], Set[str], Optional[Dict[str, Dict[str, Any]]]]:
+        """A relation's validated data, changed fields and merge conflicts.
+
+        The conflicts are None when the data was served without merging.
+        """
+        from .model import Data, DataV2
+
+        if not relation.units:
+            return None, set(), {}
+        units, apps = self._databags(relation)
+        state = self._state(relation)
+        # nothing is decoded while the databags are as they were
+        digest = databags_digest(units, apps)
+        if digest == state["digest"] and state["snapshot"]:
+            return Data.from_snapshot(json.loads(state["snapshot"])), set(), None
+        rx, conflicts, v2 = merge_databags(units, apps)
+        if conflicts:
+            log.warning(f"{self.endpoint} units disagree on {sorted(conflicts)}")
+        if not rx.get("creds"):
+            rx.update(self._last_known_creds(state))
+        data = DataV2(**rx) if v2 else Data(**rx)
+        previous = json.loads(state["snapshot"] or "{}")
+        snapshot = data.to_snapshot()
+        state["digest"] = digest
+        state["snapshot"] = json.dumps(snapshot, sort_keys=True)
+        return data, changed_keys(previous, snapshot), conflicts
+
+    def _databags(
+        self, relation: Relation
+    ) -> Tuple[Dict[str, RelationDataContent], Dict[str, RelationDataContent]]:
+        """The remote units' databags, and the remote app's if it can be read."""
+        apps = {}
+        if relation.app and relation.app in relation.data:
+            apps[relation.app.name] = relation.data[relation.app]
+        return {unit.name: relation.data[unit] for unit in relation.units}, apps
+
+    def _last_known_creds(self, state: Mapping[str, str]) -> Dict[str, Any]:
+        """The creds from the last validated data.
+
+        When no unit has creds, such as between one leader clearing them and
+        the next publishing, these are kept rather than treated as no creds.
+        Users missing from creds which are published keep their last known
+        entry instead, see _carry_creds.
+        """
+        previous = json.loads(state["snapshot"] or "{}")
+        if not previous.get("creds"):
+            return {}
+        log.info(f"{self.endpoint} has no creds, keeping the last known creds")
+        return {
+            "creds": previous["creds"],
+            "creds-generation": previous.get("creds_generation") or 0,
+        }
+
+    def relation_ready(self, relation: Relation) -> bool:
+        """Whether a relation's data is complete and valid."""
+        from pydantic import ValidationError
+
+        if relation is self.relation:
+            return self.is_ready and not self.is_stale
+        try:
+            data, _, _ = self._load(relation)
+        except ValidationError:
+            return False
+        return data is not None
+
+    @property
+    def ready_relations(self) -> List[Relation]:
+        """The relations on this endpoint with complete and valid data."""
+        return [
+            relation for relation in self.relations if self.relation_ready(relation)
+        ]
+
+    @property
+    def merge_conflicts(self) -> Dict[str, Dict[str, Any]]:
+        """Keys the control-plane units disagree on, with each unit's value.
+
+        Merging takes each key from the unit publishing the newest creds
+        generation, which is the leader, and then the lowest unit number.
+        """
+        from pydantic import ValidationError
+
+        try:
+            self._data
+        except ValidationError:
+            pass
+        if self._merge_conflicts is None:
+            # the data was served as last validated, without merging
+            _, self._merge_conflicts, _ = merge_databags(*self._databags(self.relation))
+        return dict(self._merge_conflicts)
+
+    @property
+    def changed_fields(self) -> Set[str]:
+        """Names of the Data fields that changed since the previous hook."""
+        from pydantic import ValidationError
+
+        try:
+            self._data
+        except ValidationError:
+            return set()
+        return set(self._changed_fields)
+
+    @property
+    def payload_stats(self) -> Dict[str, Dict[str, int]]:
+        """Bytes received from the remote units, per databag key.
+
+        Each key maps to its total across units, the most from any one unit,
+        and its growth since the previous hook.
+        """
+        return self._payload_stats(self.relation) if self.relation else {}
+
+    def _payload_stats(self, relation: Relation) -> Dict[str, Dict[str, int]]:
+        """A relation's payload stats, measured once and kept for the hook."""
+        if relation.id not in self._sizes:
+            stats = size_stats(
+                (databag_sizes(relation.data[unit]) for unit in relation.units),
+                json.loads(self._state(relation)["sizes"]),
+            )
+            self._sizes[relation.id] = (relation, stats)
+        return self._sizes[relation.id][1]
+
+    def _keep_sizes(self, _event=None) -> None:
+        """Keep the totals measured in this hook, for the next one's growth."""
+        for relation, stats in self._sizes.values():
+            self._state(relation)["sizes"] = json.dumps(
+                {key: entry["total"] for key, entry in stats.items()}
+            )
+        self._sizes.clear()
+
+    def _on_relation_changed(self, event) -> None:
+        # drop anything cached from earlier in this dispatch
+        self._forget()
+        self._keep_sizes()
+        self._payload_stats(event.relation)
+        if event.relation is not self.relation:
+            return
+        if not self.is_ready or self.is_stale:
+            return
+        previous = json.loads(self._stored.emitted or "{}")
+        self._stored.emitted = self._state(self.relation)["snapshot"]
+        current = json.loads(self._stored.emitted)
+
+        old_dns = {name: previous[name] for name in DNS_FIELDS if previous}
+        new_dns = {name: current[name] for name in DNS_FIELDS}
+        if old_dns != new_dns:
+            self.on.dns_changed.emit(old_dns or None, new_dns)
+        user = self.relation.data[self.model.unit].get("kubelet_user")
+        known = json.loads(self._stored.known_creds)
+        old_creds = user and (
+            _user_creds(previous.get("creds"), user) or known.get(user)
+        )
+        new_creds = user and self._carry_creds(
+            user, _user_creds(current["creds"], user)
+        )
+        if user and old_creds != new_creds:
+            self.on.credentials_changed.emit(
+                user, self._resolve(old_creds), self._resolve(new_creds)
+            )
+        for name in ("api_endpoints", "taints", "labels", "cohort_keys", "default_cni"):
+            if previous.get(name) != current[name] or name not in previous:
+                event = getattr(self.on, f"{name}_changed")
+                event.emit(previous.get(name), current[name])
+
+    def _on_secret_changed(self, event) -> None:
+        if not (event.secret.label or "").startswith(f"{self.endpoint}-creds-"):
+            return
+        user = self.relation and self.relation.data[self.model.unit].get("kubelet_user")
+        old = event.secret.get_content()
+        new = event.secret.get_content(refresh=True)
+        self.__dict__.pop("_creds", None)
+        if user and old != new:
+            self.on.credentials_changed.emit(
+                user,
+                _secret_creds(old).dict(exclude_none=True),
+                _secret_creds(new).dict(exclude_none=True),
+            )
+
+    def _on_relation_broken(self, event) -> None:
+        # the data no longer applies once the relation is gone
+        self._sizes.pop(event.relation.id, None)
+        self._stored.relations.pop(str(event.relation.id), None)
+        if self._stored.active_relation == event.relation.id:
+            self._stored.active_relation = None
+        if event.relation is self.relation:
+            self._stored.known_creds = "{}"
+            if self.snapshot_path and self.snapshot_path.exists():
+                self.snapshot_path.unlink()
 
     def evaluate_relation(self, event) -> Optional[str]:
         """Determine if relation is ready."""
@@ -61,6 +508,8 @@ class KubeControlRequirer(Object):
     @property
     def is_ready(self):
         """Whether the request for this instance has been completed."""
+        from pydantic import ValidationError
+
         try:
             self._data
         except ValidationError as ve:
@@ -75,11 +524,22 @@ class KubeControlRequirer(Object):
         self, ca: PathLike, kubeconfig: PathLike, user: str, k8s_user: str
     ):
         """Write kubeconfig based on available creds."""
+        import base64
+        import yaml
+
         creds = self.get_auth_credentials(k8s_user)
 
         cluster = "juju-cluster"
         context = "juju-context"
-        endpoints = self.get_api_endpoints()
+        old_kubeconfig = Path(kubeconfig)
+        current = None
+        if old_kubeconfig.exists():
+            try:
+                config = yaml.safe_load(old_kubeconfig.read_text())
+                current = config["clusters"][0]["cluster"]["server"]
+            except (yaml.YAMLError, LookupError, TypeError):
+                log.warning(f"Can't read the server from {kubeconfig}")
+        endpoints = self.get_ranked_api_endpoints(current)
         server = endpoints[0] if endpoints else None
         token = creds["client_token"] if creds else None
         ca_b64 = base64.b64encode(Path(ca).read_bytes()).decode("utf-8")
@@ -104,7 +564,6 @@ class KubeControlRequirer(Object):
             "users": [{"name": user, "user": {"token": token}}],
             "current-context": context,
         }
-        old_kubeconfig = Path(kubeconfig)
         new_kubeconfig = Path(f"{kubeconfig}.new")
         new_kubeconfig.parent.mkdir(exist_ok=True, mode=0o750)
         new_kubeconfig.write_text(yaml.safe_dump(config_contents))
@@ -117,32 +576,104 @@ class KubeControlRequirer(Object):
         if changed:
             new_kubeconfig.rename(old_kubeconfig)
 
-    def get_auth_credentials(self, user) -> Optional[Mapping[str, str]]:
+    def get_auth_credentials(self, user) -> Optional[Credentials]:
         """Return the authentication credentials."""
-        if not self.is_ready:
-            return None
+        if user not in self._creds:
+            self._creds[user] = self._credentials(user)
+        return self._creds[user]
 
-        creds = self._data.creds
+    def _credentials(self, user) -> Optional[Credentials]:
+        from pydantic import ValidationError
 
-        if user in creds:
-            return {
+        from .model import CredsRef, LazyCreds
+
+        if self._ready is None:
+            return None
+        try:
+            try:
+                creds = self._ready.creds[user]
+            except KeyError:
+                creds = LazyCreds({user: self._carry_creds(user, None)})[user]
+            else:
+                self._carry_creds(user, creds.dict(exclude_none=True))
+            if isinstance(creds, CredsRef):
+                creds = _secret_creds(self._secret_content(creds.secret_id))
+        except KeyError:
+            return None
+        except ValidationError as ve:
+            log.error(f"{self.endpoint} creds for {user} not valid. ({ve})")
+            return None
+        except (ModelError, SecretNotFoundError) as e:
+            log.error(f"{self.endpoint} creds secret for {user} not readable. ({e})")
+            return None
+        return Credentials(
+            {
                 "user": user,
-                "kubelet_token": creds[user].kubelet_token,
-                "proxy_token": creds[user].proxy_token,
-                "client_token": creds[user].client_token,
+                "kubelet_token": creds.kubelet_token,
+                "proxy_token": creds.proxy_token,
+                "client_token": creds.client_token,
+                **creds.dict(include={"issued_at", "expires_at"}, exclude_none=True),
             }
-        return None
+        )
 
-    def get_dns(self) -> Mapping[str, str]:
+    def _carry_creds(
+        self, user: str, entry: Optional[Dict[str, Any]]
+    ) -> Optional[Dict[str, Any]]:
+        """entry, or the user's last known entry while the creds lack it."""
+        known = json.loads(self._stored.known_creds)
+        carried = dict(known)
+        entry = carry_creds(carried, user, entry)
+        if carried != known:
+            self._stored.known_creds = json.dumps(carried, sort_keys=True)
+        return entry
+
+    def _secret_label(self, secret_id: str) -> str:
+        # a label is only ever given to one secret, so each ID has its own
+        unique = secret_id.replace(":", "/").rpartition("/")[2]
+        return f"{self.endpoint}-creds-{unique}"
+
+    def _secret_content(self, secret_id: str) -> Dict[str, str]:
+        """Content of the secret holding this unit's creds."""
+        return self.model.get_secret(
+            id=secret_id, label=self._secret_label(secret_id)
+        ).get_content()
+
+    def _resolve(self, creds: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Creds as a plain dict, read from their secret if they refer to one."""
+        if not creds or "secret_id" not in creds:
+            return creds
+        try:
+            return _secret_creds(self._secret_content(creds["secret_id"])).dict(
+                exclude_none=True
+            )
+        except (ModelError, SecretNotFoundError):
+            return creds
+
+    def credentials_refresh_at(self, user) -> Optional[float]:
+        """When this unit should ask for the user's creds to be refreshed.
+
+        None if there are no creds or they don't expire. Units pick different
+        times, from their names, ahead of expiry so they don't all ask at once.
+        """
+        creds = self.get_auth_credentials(user)
+        return creds and refresh_at(creds, self.model.unit.name)
+
+    def credentials_expiring(self, user, now: Optional[float] = None) -> bool:
+        """Whether it's time to ask for the user's creds to be refreshed."""
+        when = self.credentials_refresh_at(user)
+        return when is not None and (time.time() if now is None else now) >= when
+
+    def request_credentials_refresh(self, user) -> None:
+        """Ask the control-plane to replace the user's expiring creds."""
+        creds = self.get_auth_credentials(user)
+        if creds and "expires_at" in creds:
+            self._write_all({"auth_refresh": str(creds["expires_at"])})
+
+    def get_dns(self) -> DnsInfo:
         """
         Return DNS info provided by the control-plane.
         """
-        return {
-            "port": self._data.port if self.is_ready else None,
-            "domain": self._data.domain if self.is_ready else None,
-            "sdn-ip": self._data.sdn_ip if self.is_ready else None,
-            "enable-kube-dns": self._data.enable_kube_dns if self.is_ready else None,
-        }
+        return self._dns
 
     def dns_ready(self) -> bool:
         """
@@ -158,7 +689,8 @@ class KubeControlRequirer(Object):
     def set_auth_request(self, user, group="system:nodes") -> None:
         """Notify contol-plane that we are requesting auth.
 
-        Also, use this hostname for the kubelet system account.
+        Also, use this hostname for the kubelet system account, and
+        advertise support for the kube-control-v2 payload.
 
         @params user   - user requesting authentication
         @params groups - Determines the level of eleveted privileges of the
@@ -167,61 +699,117 @@ class KubeControlRequirer(Object):
                          cluster via changing to
                          system:masters.  #wokeignore:rule=master
         """
-        if self.relation:
-            self.relation.data[self.model.unit].update(
-                dict(kubelet_user=user, auth_group=group)
-            )
+        self._write_all(
+            {"kubelet_user": user, "auth_group": group, PAYLOAD_VERSION_KEY: "2"}
+        )
 
     def set_gpu(self, enabled=True):
         """
         Tell the control-plane that we're gpu-enabled (or not).
         """
-        log("Setting gpu={} on kube-control relation".format(enabled))
-        for relation in self.model.relations:
-            relation.data[self.model.unit].update(dict(gpu=enabled))
+        log.info(f"Setting gpu={enabled} on {self.endpoint} relations")
+        self._write_all({"gpu": str(enabled)})
+
+    def _write_all(self, fields: Mapping[str, str]) -> None:
+        """Write fields to every relation on this endpoint.
+
+        Only keys whose value changed are written, so remote units aren't
+        woken by writes which change nothing.
+        """
+        for relation in self.relations:
+            data = relation.data[self.model.unit]
+            changed = {k: v for k, v in fields.items() if data.get(k) != v}
+            if changed:
+                data.update(changed)
 
     def get_cluster_tag(self):
         """
         Tag for identifying resources that are part of the cluster.
         """
-        return self._data.cluster_tag if self.is_ready else None
+        return self._ready and self._ready.cluster_tag
 
     def get_registry_location(self):
         """
         URL for container image registry.
         """
-        return self._data.registry_location if self.is_ready else None
+        return self._ready and self._ready.registry_location
 
     @property
     def cohort_keys(self):
         """
         The cohort snapshot keys sent by the control-plane.
         """
-        return self._data.cohort_keys if self.is_ready else None
+        return self._ready and self._ready.cohort_keys
+
+    def changed_cohorts(self) -> Dict[str, str]:
+        """
+        The cohort keys of snaps which changed since the last call.
+
+        Snaps are compared by their key and the revision it was published as.
+        """
+        changed, current = changed_cohorts(
+            self.cohort_keys or {},
+            (self._ready and self._ready.cohort_revisions) or {},
+            json.loads(self._stored.cohorts),
+        )
+        self._stored.cohorts = json.dumps(current)
+        return changed
 
     def get_default_cni(self):
         """
         Default CNI network to use.
         """
-        return self._data.default_cni if self.is_ready else None
+        return self._ready and self._ready.default_cni
+
+    def get_api_endpoints(self) -> EndpointSet:
+        """
+        Returns the sorted API endpoint URLs.
+        """
+        return self._endpoints
 
-    def get_api_endpoints(self):
+    def get_ranked_api_endpoints(self, current: Optional[str] = None) -> Sequence[str]:
         """
-        Returns a list of API endpoint URLs.
+        Returns API endpoint URLs in order of preference.
+
+        Without an endpoint_prober this is the sorted list from
+        get_api_endpoints(), otherwise the fastest reachable endpoint is first,
+        unless current, the endpoint in use, is reachable and about as fast.
         """
-        api_endpoints = (self.is_ready and self._data.api_endpoints) or []
-        endpoints = set(map(str, api_endpoints))
-        return sorted(endpoints)
+        endpoints = self.get_api_endpoints()
+        if self.endpoint_prober is None:
+            return endpoints
+        return self.endpoint_prober.rank(endpoints, current)
 
     @property
     def has_xcp(self):
         """The has-xcp value."""
-        return (self.is_ready and self._data.has_xcp) or False
+        return (self._ready and self._ready.has_xcp) or False
 
-    def get_controller_taints(self) -> List[Taint]:
+    def get_controller_taints(self) -> List["Taint"]:
         """Returns a list of taints configured on the control-plane nodes."""
-        return (self.is_ready and self._data.taints) or []
+        return (self._ready and self._ready.taints) or []
 
-    def get_controller_labels(self) -> List[Label]:
+    def get_controller_labels(self) -> List["Label"]:
         """Returns a list of lables configured on the control-plane nodes."""
-        return (self.is_ready and self._data.labels) or []
+        return (self._ready and self._ready.labels) or []
+
+    def get_node_patch(
+        self,
+        node: Mapping[str, Any],
+        applied_taints: Iterable[Any] = (),
+        applied_labels: Iterable[Any] = (),
+    ) -> Optional[Dict[str, Any]]:
+        """Minimal merge patch applying the controller taints and labels to node.
+
+        node is the node's current object from the API server. Taints and
+        labels in applied_taints and applied_labels, such as the old values
+        of taints_changed and labels_changed, are removed if no longer sent.
+        Returns None when the node needs no changes.
+        """
+        return node_patch(
+            node,
+            self.get_controller_taints(),
+            self.get_controller_labels(),
+            applied_taints,
+            applied_labels,
+        )
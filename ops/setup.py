@@ -26,7 +26,7 @@ setup(
     version="0.1.0",
     zip_safe=True,
     install_requires=[
-        "backports.cached-property",
+        "backports.cached-property; python_version < '3.8'",
         "pydantic<2",
         "ops",
     ],
@@ -0,0 +1,354 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Fleet convergence benchmark for kube-control.
+
+Micro-timings miss what kube-control costs at scale, which is the hooks and
+relation writes it takes a fleet to settle after something changes. This
+drives KubeControlProvides and KubeControlRequirer, with one Harness per
+unit, through a deploy, a scale-out, a leader change and a token rotation,
+and counts for each scenario:
+
+- hooks: hook executions until no unit has anything left to react to
+- writes: relation databags changed by those hooks
+- bytes: changed keys and values, times the remote units they're sent to
+- seconds: wall time spent in those hooks
+
+Relation changes reach remote units first in, first out, and as with Juju,
+changes which land before the remote unit handled the previous one only
+cost it one hook. The clock is fixed and tokens are always the same size,
+so every count but seconds is the same from one run to the next.
+
+Each Harness calls its own unit <app>/0, the fleet relays its databags to
+the other side under the unit's real name. The control-plane units share
+their app's databag, and when leadership moves the old leader's issued
+tokens secret is copied to the new leader, as Juju would let it read it.
+
+    python tests/bench/convergence.py --workers 100
+"""
+
+import argparse
+import json
+import logging
+import time
+import unittest.mock as mock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ops.charm import CharmBase
+from ops.interface_kube_control import KubeControlProvides, KubeControlRequirer
+from ops.model import SecretNotFoundError
+from ops.testing import Harness
+
+ENDPOINT = "kube-control"
+CONTROL_PLANE = "kubernetes-control-plane"
+WORKER = "kubernetes-worker"
+EPOCH = 1_700_000_000
+TOKEN_TTL = 3600
+TOKENS_LABEL = f"{ENDPOINT}-tokens"
+
+
+class ControlPlaneCharm(CharmBase):
+    """Publishes the cluster's settings, and creds for every request as leader."""
+
+    options: Dict[str, Any] = {}
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.kube_control = KubeControlProvides(self, ENDPOINT, **self.options)
+        events = self.on[ENDPOINT]
+        for event in (
+            events.relation_joined,
+            events.relation_changed,
+            events.relation_departed,
+            self.on.leader_elected,
+            self.on.leader_settings_changed,
+        ):
+            self.framework.observe(event, self._reconcile)
+
+    def _reconcile(self, _event) -> None:
+        kube_control = self.kube_control
+        kube_control.set_api_endpoints(["https://10.0.0.10:6443"])
+        kube_control.set_cluster_name("kubernetes-4ypskxahbu3rnfgsds3pksvwe3uh0lxt")
+        kube_control.set_default_cni("calico")
+        kube_control.set_dns_address("10.152.183.10")
+        kube_control.set_dns_domain("cluster.local")
+        kube_control.set_dns_enabled(True)
+        kube_control.set_dns_port(53)
+        kube_control.set_has_external_cloud_provider(False)
+        kube_control.set_image_registry("rocks.canonical.com:443/cdk")
+        kube_control.set_labels(["node-role.kubernetes.io/control-plane="])
+        kube_control.set_taints(["node-role.kubernetes.io/control-plane:NoSchedule"])
+        if self.unit.is_leader():
+            kube_control.issue_tokens(TOKEN_TTL)
+        else:
+            kube_control.clear_creds()
+
+
+class WorkerCharm(CharmBase):
+    """Asks for creds when joining, and for new ones once they're expiring."""
+
+    user = ""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.kube_control = KubeControlRequirer(self, ENDPOINT)
+        events = self.on[ENDPOINT]
+        self.framework.observe(events.relation_joined, self._on_joined)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+
+    def _on_joined(self, _event) -> None:
+        self.kube_control.set_auth_request(self.user)
+
+    def _on_update_status(self, _event) -> None:
+        if self.kube_control.credentials_expiring(self.user):
+            self.kube_control.request_credentials_refresh(self.user)
+
+
+class Fleet:
+    """Control-plane and worker units related over kube-control.
+
+    Hooks are queued rather than run, see settle.
+    """
+
+    def __init__(self, control_planes: int = 2, **options):
+        self.now = EPOCH
+        self.charms = {
+            CONTROL_PLANE: type(
+                "ControlPlane", (ControlPlaneCharm,), {"options": options}
+            ),
+            WORKER: WorkerCharm,
+        }
+        self.units: Dict[str, Harness] = {}
+        self.relation_ids: Dict[str, int] = {}
+        self.readers: Dict[str, List[str]] = {CONTROL_PLANE: []}
+        self.published: Dict[str, Dict[str, str]] = {}
+        self.queue: Dict[Tuple[str, str], Callable[[], None]] = {}
+        self.hooks = self.writes = self.bytes = 0
+        self.seconds = 0.0
+        for n in range(control_planes):
+            self._add(f"{CONTROL_PLANE}/{n}")
+
+    @property
+    def control_planes(self) -> List[str]:
+        return [name for name in self.units if name.startswith(CONTROL_PLANE)]
+
+    @property
+    def workers(self) -> List[str]:
+        return [name for name in self.units if name.startswith(WORKER)]
+
+    def _add(self, name: str) -> Harness:
+        app = name.split("/")[0]
+        remote = WORKER if app == CONTROL_PLANE else CONTROL_PLANE
+        role = "provides" if app == CONTROL_PLANE else "requires"
+        meta = f"name: {app}\n{role}:\n  {ENDPOINT}:\n    interface: kube-control\n"
+        harness = Harness(self.charms[app], meta=meta)
+        self.relation_ids[name] = harness.add_relation(ENDPOINT, remote)
+        harness.begin()
+        self.units[name] = harness
+        self.readers[name] = []
+        return harness
+
+    def _hook(self, unit: str, event: str, source: Optional[str] = None) -> None:
+        """Queue a hook on a unit, which first sees source's latest databag."""
+
+        def run():
+            harness = self.units[unit]
+            relation_id = self.relation_ids[unit]
+            if source:
+                self._sync(harness, relation_id, source)
+            self.hooks += 1
+            start = time.perf_counter()
+            if source:
+                relation = harness.model.get_relation(ENDPOINT, relation_id)
+                app = harness.model.get_app(source.split("/")[0])
+                remote = harness.model.get_unit(source) if "/" in source else None
+                getattr(harness.charm.on[ENDPOINT], event).emit(relation, app, remote)
+            else:
+                getattr(harness.charm.on, event).emit()
+            harness.framework.commit()
+            self.seconds += time.perf_counter() - start
+            self._publish(unit)
+
+        self.queue.setdefault((unit, f"{source}:{event}"), run)
+
+    def _sync(self, harness: Harness, relation_id: int, source: str) -> None:
+        current = harness.get_relation_data(relation_id, source)
+        latest = self.published.get(source, {})
+        delta = {key: "" for key in current if key not in latest}
+        delta.update(
+            {key: value for key, value in latest.items() if current.get(key) != value}
+        )
+        with harness.hooks_disabled():
+            harness.update_relation_data(relation_id, source, delta)
+
+    def _publish(self, unit: str) -> None:
+        """Count what the hook wrote, and queue relation-changed to the readers."""
+        harness = self.units[unit]
+        relation_id = self.relation_ids[unit]
+        bags = {unit: harness.get_relation_data(relation_id, harness.charm.unit.name)}
+        if harness.charm.unit.is_leader():
+            app = harness.charm.app.name
+            bags[app] = harness.get_relation_data(relation_id, app)
+        for source, data in bags.items():
+            old = self.published.get(source, {})
+            changed = {
+                key for key in old.keys() | data.keys() if old.get(key) != data.get(key)
+            }
+            if not changed:
+                continue
+            self.published[source] = dict(data)
+            readers = self.readers[source]
+            self.writes += 1
+            self.bytes += len(readers) * sum(
+                len(k) + len(data.get(k, "")) for k in changed
+            )
+            for reader in readers:
+                self._hook(reader, "relation_changed", source)
+            if source == CONTROL_PLANE:
+                # the app databag is shared by every unit of the app
+                for peer in self.control_planes:
+                    if peer != unit:
+                        self._sync(self.units[peer], self.relation_ids[peer], source)
+
+    def _join(self, unit: str, remote: str) -> None:
+        harness = self.units[unit]
+        with harness.hooks_disabled():
+            harness.add_relation_unit(self.relation_ids[unit], remote)
+        self.readers[remote].append(unit)
+        if remote.startswith(CONTROL_PLANE) and unit not in self.readers[CONTROL_PLANE]:
+            self.readers[CONTROL_PLANE].append(unit)
+            self._sync(harness, self.relation_ids[unit], CONTROL_PLANE)
+        self._hook(unit, "relation_joined", remote)
+        self._hook(unit, "relation_changed", remote)
+
+    def add_workers(self, count: int) -> None:
+        """Deploy more workers and relate them to every control-plane unit."""
+        start = len(self.workers)
+        for n in range(start, start + count):
+            name = f"{WORKER}/{n}"
+            self._add(name).charm.user = f"system:node:{WORKER}-{n}"
+            for control_plane in self.control_planes:
+                self._join(name, control_plane)
+                self._join(control_plane, name)
+
+    def _copy_tokens_secret(self, source: Harness, target: Harness) -> None:
+        """Give target the content of source's app-owned tokens secret."""
+        try:
+            content = source.model.get_secret(label=TOKENS_LABEL).get_content()
+        except SecretNotFoundError:
+            return
+        with target.hooks_disabled():
+            target.set_leader(True)
+        try:
+            target.model.get_secret(label=TOKENS_LABEL).set_content(content)
+        except SecretNotFoundError:
+            target.charm.app.add_secret(content, label=TOKENS_LABEL)
+
+    def elect(self, leader: str) -> None:
+        """Move leadership to a control-plane unit."""
+        for name in self.control_planes:
+            if name != leader and self.units[name].charm.unit.is_leader():
+                self._copy_tokens_secret(self.units[name], self.units[leader])
+        for name in self.control_planes:
+            harness = self.units[name]
+            was_leader = harness.charm.unit.is_leader()
+            with harness.hooks_disabled():
+                harness.set_leader(name == leader)
+            if name == leader:
+                self._hook(name, "leader_elected")
+            elif was_leader:
+                self._hook(name, "leader_settings_changed")
+
+    def expire_tokens(self) -> None:
+        """Move the clock to when tokens expire, and let the workers notice."""
+        self.now += TOKEN_TTL
+        for name in self.workers:
+            self._hook(name, "update_status")
+
+    def settle(self) -> None:
+        """Run queued hooks until there are none left."""
+        while self.queue:
+            self.queue.pop(next(iter(self.queue)))()
+
+    def converged(self) -> bool:
+        """Whether every worker holds creds which aren't due for a refresh."""
+        for name in self.workers:
+            charm = self.units[name].charm
+            charm.kube_control._forget()
+            creds = charm.kube_control.get_auth_credentials(charm.user)
+            if not creds or charm.kube_control.credentials_expiring(charm.user):
+                return False
+        return True
+
+    def measure(self, scenario: str, change: Callable[[], None]) -> Dict[str, Any]:
+        """Make a change and settle, counting what it took."""
+        self.hooks = self.writes = self.bytes = 0
+        self.seconds = 0.0
+        with mock.patch("time.time", lambda: self.now):
+            change()
+            self.settle()
+            if not self.converged():
+                raise RuntimeError(f"{scenario} left workers without valid creds")
+        return {
+            "scenario": scenario,
+            "workers": len(self.workers),
+            "hooks": self.hooks,
+            "writes": self.writes,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 3),
+        }
+
+    def cleanup(self) -> None:
+        for harness in self.units.values():
+            harness.cleanup()
+
+
+def run(
+    workers: int, control_planes: int = 2, scale_out: int = 1, **options
+) -> List[Dict[str, Any]]:
+    """Results of each scenario, run one after the other on the same fleet."""
+    fleet = Fleet(control_planes, **options)
+    try:
+        leaders = fleet.control_planes
+        return [
+            fleet.measure(
+                "deploy", lambda: (fleet.elect(leaders[0]), fleet.add_workers(workers))
+            ),
+            fleet.measure("scale-out", lambda: fleet.add_workers(scale_out)),
+            fleet.measure("leader-change", lambda: fleet.elect(leaders[-1])),
+            fleet.measure("rotation", fleet.expire_tokens),
+        ]
+    finally:
+        fleet.cleanup()
+
+
+def main(args=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=50)
+    parser.add_argument("--control-planes", type=int, default=2)
+    parser.add_argument(
+        "--scale-out", type=int, help="workers to add, a tenth of them by default"
+    )
+    parser.add_argument("--payload-version", type=int, default=1)
+    parser.add_argument("--app-databag", action="store_true")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(args)
+    results = run(
+        args.workers,
+        args.control_planes,
+        args.scale_out or max(1, args.workers // 10),
+        payload_version=args.payload_version,
+        app_databag=args.app_databag,
+    )
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    columns = list(results[0])
+    print(("{:<14}" + "{:>10}" * (len(columns) - 1)).format(*columns))
+    for result in results:
+        print(("{:<14}" + "{:>10}" * (len(columns) - 1)).format(*result.values()))
+
+
+if __name__ == "__main__":
+    # not-yet-valid data is expected while the fleet converges
+    logging.disable(logging.ERROR)
+    main()
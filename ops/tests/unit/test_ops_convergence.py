@@ -0,0 +1,56 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+import pytest
+
+from tests.bench import convergence
+
+
+def test_convergence_counts_are_deterministic():
+    runs = [convergence.run(workers=3, scale_out=1) for _ in range(2)]
+    for results in runs:
+        for result in results:
+            assert result.pop("seconds") >= 0
+    assert runs[0] == runs[1]
+
+    results = {result.pop("scenario"): result for result in runs[0]}
+    assert list(results) == ["deploy", "scale-out", "leader-change", "rotation"]
+    assert results["scale-out"]["workers"] == 4
+    # the old leader clears its creds and the new one has nothing to sign,
+    # and later every worker asks for new ones
+    assert results["leader-change"]["writes"] == 1
+    assert results["rotation"]["writes"] >= 4
+    assert all(result["hooks"] and result["bytes"] for result in results.values())
+
+
+@pytest.mark.parametrize("options", [{}, {"sign_batch_size": 2}])
+def test_leader_change_keeps_tokens(options):
+    fleet = convergence.Fleet(2, **options)
+
+    def client_tokens():
+        tokens = {}
+        for name in fleet.workers:
+            charm = fleet.units[name].charm
+            charm.kube_control._forget()
+            creds = charm.kube_control.get_auth_credentials(charm.user)
+            tokens[name] = creds["client_token"]
+        return tokens
+
+    try:
+        first, last = fleet.control_planes
+        fleet.measure("deploy", lambda: (fleet.elect(first), fleet.add_workers(4)))
+        before = client_tokens()
+        fleet.measure("leader-change", lambda: fleet.elect(last))
+        assert client_tokens() == before
+
+        # the new leader still refreshes them when they're expiring
+        fleet.measure("rotation", fleet.expire_tokens)
+        after = client_tokens()
+        assert all(after[name] != before[name] for name in before)
+    finally:
+        fleet.cleanup()
+
+
+def test_convergence_cli(capsys):
+    convergence.main(["--workers", "2", "--control-planes", "1", "--json"])
+    out = capsys.readouterr().out
+    assert '"scenario": "rotation"' in out
@@ -0,0 +1,132 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+import socket
+import unittest.mock as mock
+
+import pytest
+from ops.interface_kube_control import EndpointProber, KubeControlRequirer
+
+
+@pytest.fixture()
+def listener():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(8)
+    yield f"https://127.0.0.1:{sock.getsockname()[1]}"
+    sock.close()
+
+
+@pytest.fixture()
+def dead_url():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    url = f"https://127.0.0.1:{sock.getsockname()[1]}"
+    sock.close()
+    yield url
+
+
+def test_probe_listener(listener, dead_url):
+    prober = EndpointProber(timeout=0.5)
+    assert prober.probe(listener) is not None
+    assert prober.probe(dead_url) is None
+
+
+def test_rank_prefers_reachable(listener, dead_url):
+    prober = EndpointProber(timeout=0.5)
+    # dead_url may sort before listener, rank must still put listener first
+    assert prober.rank([dead_url, listener]) == [listener, dead_url]
+
+
+def test_rank_all_unreachable_is_sorted(dead_url):
+    prober = EndpointProber(timeout=0.5)
+    other = "https://127.0.0.1:1"
+    assert prober.rank([other, dead_url]) == sorted([other, dead_url])
+
+
+def test_probe_cache_ttl(listener):
+    now = [1000.0]
+    prober = EndpointProber(ttl=30, timeout=0.5, clock=lambda: now[0])
+    with mock.patch.object(prober, "_connect", return_value=0.01) as connect:
+        assert prober.probe(listener) == 0.01
+        now[0] += 10
+        assert prober.probe(listener) == 0.01
+        assert connect.call_count == 1
+        now[0] += 30
+        prober.probe(listener)
+        assert connect.call_count == 2
+
+
+def test_probe_cache_persisted(listener, tmp_path):
+    cache_path = tmp_path / "probes.json"
+    EndpointProber(timeout=0.5, cache_path=cache_path).rank([listener])
+    prober = EndpointProber(timeout=0.5, cache_path=cache_path)
+    with mock.patch.object(prober, "_connect") as connect:
+        assert prober.probe(listener) is not None
+        connect.assert_not_called()
+
+
+def test_requirer_ranked_endpoints(listener, dead_url):
+    mock_charm = mock.MagicMock()
+    requirer = KubeControlRequirer(
+        mock_charm, endpoint_prober=EndpointProber(timeout=0.5)
+    )
+    with mock.patch.object(
+        KubeControlRequirer, "get_api_endpoints", return_value=[dead_url, listener]
+    ):
+        assert requirer.get_ranked_api_endpoints()[0] == listener
+
+
+def test_rank_keeps_current_within_margin():
+    latency = {"https://a:6443": 0.012, "https://b:6443": 0.010}
+    prober = EndpointProber(margin=0.005)
+    with mock.patch.object(prober, "_connect", side_effect=lambda u, t: latency[u]):
+        assert prober.rank(latency) == ["https://b:6443", "https://a:6443"]
+        assert prober.rank(latency, current="https://a:6443")[0] == "https://a:6443"
+        prober.cache.clear()
+        latency["https://b:6443"] = 0.001
+        assert prober.rank(latency, current="https://a:6443")[0] == "https://b:6443"
+        prober.cache.clear()
+        latency["https://a:6443"] = None
+        assert prober.rank(latency, current="https://a:6443")[0] == "https://b:6443"
+
+
+def test_rank_probe_budget(listener):
+    urls = [f"https://10.0.0.{n}:6443" for n in range(5)]
+    now = [0.0]
+
+    def connect(url, timeout):
+        now[0] += timeout
+        return None
+
+    prober = EndpointProber(timeout=1.0, budget=2.5)
+    with mock.patch.object(prober, "_connect", side_effect=connect), mock.patch(
+        "time.perf_counter", lambda: now[0]
+    ):
+        prober.rank(urls + [listener], current=listener)
+    assert now[0] == 2.5
+    assert listener in prober.cache  # the endpoint in use is probed first
+    assert len(prober.cache) == 3
+
+
+def test_kubeconfig_keeps_server(tmp_path):
+    import yaml
+
+    latency = {"https://a:6443": 0.012, "https://b:6443": 0.010}
+    prober = EndpointProber(ttl=0)
+    requirer = KubeControlRequirer(mock.MagicMock(), endpoint_prober=prober)
+    ca, kubeconfig = tmp_path / "ca.crt", tmp_path / "kubeconfig"
+    ca.write_bytes(b"abcd")
+    with mock.patch.object(
+        prober, "_connect", side_effect=lambda u, t: latency[u]
+    ), mock.patch.object(
+        KubeControlRequirer, "get_api_endpoints", return_value=list(latency)
+    ), mock.patch.object(
+        KubeControlRequirer, "get_auth_credentials", return_value=None
+    ):
+        # b is fastest, then a is faster but within the margin, then beyond it
+        for faster, expected in ((0.012, "b"), (0.009, "b"), (0.004, "a")):
+            latency["https://a:6443"] = faster
+            requirer.create_kubeconfig(ca, kubeconfig, "ubuntu", "system:node:w0")
+            config = yaml.safe_load(kubeconfig.read_text())
+            server = config["clusters"][0]["cluster"]["server"]
+            assert server == f"https://{expected}:6443"
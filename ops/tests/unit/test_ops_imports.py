@@ -0,0 +1,38 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+import json
+import subprocess
+import sys
+
+# Every hook imports the interface, so keep what that costs in check. The
+# modules loaded are what keep it cheap, the time only catches a regression
+# big enough to show on a loaded CI runner.
+IMPORT_SECONDS_BUDGET = 1.0
+IMPORT_MODULES_BUDGET = 10
+DEFERRED_MODULES = ("backports", "base64", "pydantic", "yaml")
+
+IMPORT_PROBE = """
+import json, sys, time
+import ops
+
+before = set(sys.modules)
+start = time.perf_counter()
+from ops.interface_kube_control import KubeControlProvides, KubeControlRequirer
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(set(sys.modules) - before)}))
+"""
+
+
+def test_import_budget():
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_PROBE],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    result = json.loads(out.stdout)
+    loaded = result["modules"]
+    deferred = [m for m in loaded if m.split(".")[0] in DEFERRED_MODULES]
+    assert deferred == [], "these should only be imported when used"
+    assert len(loaded) <= IMPORT_MODULES_BUDGET, loaded
+    assert result["elapsed"] <= IMPORT_SECONDS_BUDGET
@@ -1,17 +1,36 @@
 # Copyright 2022 Canonical Ltd.
 # See LICENSE file for licensing details.
+import json
 import unittest.mock as mock
 
 import pytest
+from ops import SecretNotFoundError
 from ops.charm import CharmBase
+from ops.framework import Object
 from ops.interface_kube_control import KubeControlProvides
+from ops.interface_kube_control.core import TokenIssuer
+from ops.interface_kube_control.provides import AuthRequest
+from ops.testing import Harness
+
+METADATA = """
+name: test
+provides:
+  kube-control:
+    interface: kube-control
+"""
+
+
+@pytest.fixture(scope="function")
+def harness():
+    harness = Harness(CharmBase, meta=METADATA)
+    harness.begin()
+    yield harness
+    harness.cleanup()
 
 
 @pytest.fixture(scope="function")
-def kube_control_provider():
-    mock_charm = mock.MagicMock(auto_spec=CharmBase)
-    mock_charm.framework.model.unit.name = "test/0"
-    yield KubeControlProvides(mock_charm, "kube-control")
+def kube_control_provider(harness):
+    yield KubeControlProvides(harness.charm, "kube-control")
 
 
 def test_sign_auth_request(kube_control_provider):
@@ -31,7 +50,10 @@ def test_sign_auth_request(kube_control_provider):
             kubelet_token="kubernetes-worker/0::kubelet-token-1",
             proxy_token="kube-proxy::proxy-token-1",
         )
-        assert mock_relation.data[kube_control_provider.unit] == {
+        kube_control_provider.flush()
+        published = mock_relation.data[kube_control_provider.unit]
+        generation = published.pop("creds-generation")
+        assert published == {
             "creds": '{"system:node:juju-561c45-7": {"client_token": '
             '"admin::client-token-1", "kubelet_token": '
             '"kubernetes-worker/0::kubelet-token-1", "proxy_token": '
@@ -46,7 +68,9 @@ def test_sign_auth_request(kube_control_provider):
             kubelet_token="kubernetes-worker/1::kubelet-token-2",
             proxy_token="kube-proxy::proxy-token-2",
         )
+        kube_control_provider.flush()
         assert mock_relation.data[kube_control_provider.unit] == {
+            "creds-generation": generation,
             "creds": '{"system:node:juju-561c45-7": {"client_token": '
             '"admin::client-token-1", "kubelet_token": '
             '"kubernetes-worker/0::kubelet-token-1", "proxy_token": '
@@ -56,3 +80,485 @@ def test_sign_auth_request(kube_control_provider):
             '"kubernetes-worker/1::kubelet-token-2", "proxy_token": '
             '"kube-proxy::proxy-token-2", "scope": "kubernetes-worker/1"}}',
         }
+
+
+@pytest.mark.parametrize("remote_version", ["1", "2"])
+def test_payload_v2_negotiation(kube_control_provider, remote_version):
+    kube_control_provider.payload_version = 2
+    with mock.patch.object(
+        KubeControlProvides, "relations", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        mock_relation = mock.MagicMock()
+        mock_relation.units = ["remote/0", "remote/1"]
+        mock_relation.data = {
+            kube_control_provider.unit: {},
+            "remote/0": {"payload-version": "2"},
+            "remote/1": {"payload-version": remote_version},
+        }
+        mock_prop.return_value = [mock_relation]
+        kube_control_provider.set_dns_port(53)
+        kube_control_provider.set_api_endpoints(["https://10.0.0.1:6443"])
+        kube_control_provider.set_has_external_cloud_provider(False)
+        kube_control_provider.flush()
+        published = mock_relation.data[kube_control_provider.unit]
+
+        if remote_version == "1":
+            assert published == {
+                "port": "53",
+                "api-endpoints": '["https://10.0.0.1:6443"]',
+                "has-xcp": "false",
+            }
+        else:
+            assert list(published) == ["kube-control-v2"]
+            assert json.loads(published["kube-control-v2"]) == {
+                "version": 2,
+                "data": {
+                    "port": 53,
+                    "api-endpoints": ["https://10.0.0.1:6443"],
+                    "has-xcp": False,
+                },
+            }
+
+
+class EventRecorder(Object):
+    def __init__(self, parent):
+        super().__init__(parent, "recorder")
+        self.events = []
+
+    def record(self, event):
+        self.events.append((event.handle.kind, event.request, event.previous))
+
+
+def test_auth_request_events():
+    harness = Harness(CharmBase, meta=METADATA)
+    harness.begin()
+    provider = KubeControlProvides(harness.charm, "kube-control")
+    recorder = EventRecorder(harness.charm)
+    for event in (
+        provider.on.auth_requested,
+        provider.on.auth_request_changed,
+        provider.on.auth_request_withdrawn,
+    ):
+        harness.framework.observe(event, recorder.record)
+
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    harness.add_relation_unit(rel_id, "kubernetes-worker/0")
+    harness.add_relation_unit(rel_id, "kubernetes-worker/1")
+    harness.update_relation_data(
+        rel_id,
+        "kubernetes-worker/0",
+        {"kubelet_user": "system:node:w0", "auth_group": "system:nodes"},
+    )
+    request = AuthRequest("kubernetes-worker/0", "system:node:w0", "system:nodes")
+    assert recorder.events == [("auth_requested", request, None)]
+
+    # an unrelated key on another unit emits nothing
+    recorder.events.clear()
+    harness.update_relation_data(rel_id, "kubernetes-worker/1", {"gpu": "False"})
+    harness.update_relation_data(rel_id, "kubernetes-worker/0", {"gpu": "True"})
+    assert recorder.events == []
+
+    harness.update_relation_data(
+        rel_id, "kubernetes-worker/0", {"auth_group": "system:masters"}
+    )
+    changed = request._replace(group="system:masters")
+    assert recorder.events == [("auth_request_changed", changed, request)]
+
+    recorder.events.clear()
+    harness.remove_relation_unit(rel_id, "kubernetes-worker/0")
+    assert recorder.events == [("auth_request_withdrawn", None, changed)]
+    harness.cleanup()
+
+
+def test_payload_budget(harness):
+    from ops.interface_kube_control import PayloadBudgetError
+
+    provider = KubeControlProvides(
+        harness.charm, "kube-control", payload_budget=30, refuse_over_budget=True
+    )
+    with mock.patch.object(
+        KubeControlProvides, "relations", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        mock_relation = mock.MagicMock()
+        mock_relation.name, mock_relation.id = "kube-control", 1
+        mock_relation.data = {provider.unit: {}}
+        mock_prop.return_value = [mock_relation]
+        provider.set_dns_domain("cluster.local")
+        assert provider.payload_stats == {
+            "domain": {"total": 19, "max": 19, "growth": 19}
+        }
+        with pytest.raises(PayloadBudgetError):
+            provider.set_image_registry("rocks.canonical.com/cdk")
+        assert "registry-location" not in mock_relation.data[provider.unit]
+
+
+def test_app_databag(harness):
+    provider = KubeControlProvides(harness.charm, "kube-control", app_databag=True)
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    harness.add_relation_unit(rel_id, "kubernetes-worker/0")
+
+    provider.set_cluster_name("cluster")
+    provider.flush()
+    assert harness.get_relation_data(rel_id, "test") == {}
+
+    harness.set_leader(True)
+    provider.set_cluster_name("cluster")
+    provider.set_dns_port(53)
+    provider.flush()
+    assert harness.get_relation_data(rel_id, "test") == {
+        "cluster-tag": "cluster",
+        "port": "53",
+    }
+    assert harness.get_relation_data(rel_id, "test/0") == {}
+
+
+def test_pending_auth_requests(harness):
+    provider = KubeControlProvides(harness.charm, "kube-control", sign_batch_size=2)
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    for n in range(3):
+        unit = f"kubernetes-worker/{n}"
+        harness.add_relation_unit(rel_id, unit)
+        harness.update_relation_data(
+            rel_id, unit, {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        )
+
+    assert provider.queue_depth == 3
+    signed = []
+    for request in provider.pending_auth_requests():
+        provider.sign_auth_request(request, "c", "k", "p")
+        signed.append(request.unit)
+    assert signed == ["kubernetes-worker/0", "kubernetes-worker/1"]
+    assert provider.queue_depth == 1
+    assert provider.drain_estimate["hooks"] == 1
+
+    provider._signing_queue = None  # as in the next hook
+    assert [r.unit for r in provider.pending_auth_requests()] == ["kubernetes-worker/2"]
+
+
+def test_writes_coalesce(harness):
+    provider = KubeControlProvides(harness.charm, "kube-control")
+    for app in ("kubernetes-worker", "kubernetes-control-plane"):
+        rel_id = harness.add_relation("kube-control", app)
+        harness.add_relation_unit(rel_id, f"{app}/0")
+
+    provider.set_cluster_name("cluster")
+    provider.set_dns_port(53)
+    provider.set_dns_port(5353)
+    provider.set_default_cni("calico")
+    assert provider.backend_calls == 0
+    assert provider._published(provider.relations[0], "port") == 5353
+
+    harness.framework.on.pre_commit.emit()
+    assert provider.backend_calls == 2
+    assert harness.get_relation_data(rel_id, "test/0") == {
+        "cluster-tag": "cluster",
+        "port": "5353",
+        "default-cni": '"calico"',
+    }
+
+    provider.set_dns_port(5353)
+    provider.flush()
+    assert provider.backend_calls == 2
+
+
+def test_profile_dir(harness, tmp_path):
+    provider = KubeControlProvides(harness.charm, "kube-control", profile_dir=tmp_path)
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    harness.add_relation_unit(rel_id, "kubernetes-worker/0")
+    provider.set_dns_port(53)
+    assert provider.profiler.calls == 1
+
+    harness.framework.on.pre_commit.emit()
+    harness.framework.on.commit.emit()
+    (profile,) = tmp_path.glob("*.prof")
+    assert profile.name.endswith("-kube-control-provides-1units.prof")
+
+
+def test_refresh_expiring_creds_first(harness):
+    provider = KubeControlProvides(harness.charm, "kube-control")
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    for n, expires_at in enumerate((3000, 2000, None)):
+        unit = f"kubernetes-worker/{n}"
+        harness.add_relation_unit(rel_id, unit)
+        harness.update_relation_data(
+            rel_id, unit, {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        )
+        request = AuthRequest(unit, f"system:node:w{n}", "g")
+        if expires_at:
+            provider.sign_auth_request(request, "c", "k", "p", expires_at, 1000)
+    provider.flush()
+    creds = json.loads(harness.get_relation_data(rel_id, "test/0")["creds"])
+    assert creds["system:node:w0"]["issued_at"] == 1000
+    assert "expires_at" not in creds.get("system:node:w2", {})
+
+    harness.update_relation_data(
+        rel_id, "kubernetes-worker/0", {"auth_refresh": "3000"}
+    )
+    harness.update_relation_data(
+        rel_id, "kubernetes-worker/1", {"auth_refresh": "2000"}
+    )
+    provider._signing_queue = None  # as in the next hook
+    assert [r.unit for r in provider.pending_auth_requests()] == [
+        "kubernetes-worker/1",
+        "kubernetes-worker/0",
+        "kubernetes-worker/2",
+    ]
+
+
+def test_issue_tokens(harness):
+    provider = KubeControlProvides(harness.charm, "kube-control")
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    for n in range(2):
+        unit = f"kubernetes-worker/{n}"
+        harness.add_relation_unit(rel_id, unit)
+        harness.update_relation_data(
+            rel_id, unit, {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        )
+
+    signed = provider.issue_tokens()
+    assert [r.unit for r in signed] == ["kubernetes-worker/0", "kubernetes-worker/1"]
+    provider.flush()
+    creds = json.loads(harness.get_relation_data(rel_id, "test/0")["creds"])
+    token = creds["system:node:w1"]["client_token"]
+    assert token.startswith("system:node:w1::")
+    assert provider.token_issuer.verify(token) == "system:node:w1"
+    assert token not in provider._stored.tokens
+
+    provider._signing_queue = None  # as in the next hook
+    assert provider.issue_tokens() == []
+    assert provider.backend_calls == 1
+
+
+def test_issued_tokens_shared_with_next_leader(harness):
+    provider = KubeControlProvides(harness.charm, "kube-control")
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    for n in range(2):
+        unit = f"kubernetes-worker/{n}"
+        harness.add_relation_unit(rel_id, unit)
+        harness.update_relation_data(
+            rel_id, unit, {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        )
+
+    # a unit which isn't the leader keeps the records to itself
+    with mock.patch("time.time", return_value=1000):
+        assert len(provider.issue_tokens(3600)) == 2
+    with pytest.raises(SecretNotFoundError):
+        harness.model.get_secret(label="kube-control-tokens")
+
+    harness.set_leader(True)
+    provider._on_pre_commit(None)  # as in the next hook
+    harness.update_relation_data(
+        rel_id, "kubernetes-worker/1", {"auth_refresh": "4600"}
+    )
+    with mock.patch("time.time", return_value=2000):
+        signed = provider.issue_tokens(3600)
+    assert [r.unit for r in signed] == ["kubernetes-worker/1"]
+    secret = harness.model.get_secret(label="kube-control-tokens")
+    shared = json.loads(secret.get_content(refresh=True)["tokens"])
+    assert shared["system:node:w1"]["expires_at"] == 5600
+
+    # a new leader has no creds or records of its own, but signs nothing again
+    provider.clear_creds()
+    provider._stored.tokens = "{}"
+    provider._on_pre_commit(None)
+    assert provider.issue_tokens(3600) == []
+    assert provider.queue_depth == 0
+    secret_id = secret.get_info().id
+    assert harness.get_secret_revisions(secret_id) == [1]
+
+    harness.update_relation_data(
+        rel_id, "kubernetes-worker/0", {"auth_refresh": "4600"}
+    )
+    provider._on_pre_commit(None)
+    assert len(provider.issue_tokens(3600)) == 1
+    assert harness.get_secret_revisions(secret_id) == [1, 2]
+    harness.trigger_secret_removal(secret_id, 1)
+    assert harness.get_secret_revisions(secret_id) == [2]
+
+
+def test_creds_secrets(harness):
+    harness.set_leader(True)
+    provider = KubeControlProvides(harness.charm, "kube-control", creds_secrets=True)
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    for n in range(2):
+        harness.add_relation_unit(rel_id, f"kubernetes-worker/{n}")
+    request = AuthRequest("kubernetes-worker/0", "system:node:w0", "g")
+
+    provider.sign_auth_request(request, "c", "k", "p")
+    provider.flush()
+    creds = json.loads(harness.get_relation_data(rel_id, "test/0")["creds"])
+    secret_id = creds["system:node:w0"]["secret_id"]
+    assert creds == {
+        "system:node:w0": {"scope": "kubernetes-worker/0", "secret_id": secret_id}
+    }
+    assert harness.get_secret_grants(secret_id, rel_id) == {"kubernetes-worker/0"}
+    secret = harness.model.get_secret(id=secret_id)
+    assert secret.get_content()["kubelet-token"] == "k"
+
+    # the same tokens again make no new revision, new ones do
+    provider.sign_auth_request(request, "c", "k", "p")
+    assert len(harness.get_secret_revisions(secret_id)) == 1
+    provider.sign_auth_request(request, "c2", "k2", "p2")
+    assert len(harness.get_secret_revisions(secret_id)) == 2
+
+    # the next leader, with no creds or state of its own, updates the same
+    # secret rather than making a new one
+    provider.clear_creds()
+    provider.flush()
+    provider._stored.tokens = "{}"
+    provider._on_pre_commit(None)
+    provider.sign_auth_request(request, "c3", "k3", "p3")
+    provider.flush()
+    creds = json.loads(harness.get_relation_data(rel_id, "test/0")["creds"])
+    assert creds["system:node:w0"]["secret_id"] == secret_id
+    assert len(harness.get_secret_revisions(secret_id)) == 3
+    assert harness.model.get_secret(id=secret_id).get_info().label == (
+        "kube-control-creds-kubernetes-worker-0"
+    )
+
+    # the secret is the app's, so only the leader manages it, and removes it
+    # when its unit departs
+    harness.set_leader(False)
+    with pytest.raises(SecretNotFoundError):
+        harness.model.get_secret(id=secret_id).get_info()
+    harness.remove_relation_unit(rel_id, "kubernetes-worker/0")
+    assert harness.get_secret_revisions(secret_id) == [1, 2, 3]
+    harness.set_leader(True)
+    harness.add_relation_unit(rel_id, "kubernetes-worker/0")
+    harness.remove_relation_unit(rel_id, "kubernetes-worker/0")
+    with pytest.raises(SecretNotFoundError):
+        harness.model.get_secret(id=secret_id).get_info()
+
+
+def test_creds_secrets_rotation(harness):
+    harness.set_leader(True)
+    provider = KubeControlProvides(harness.charm, "kube-control", creds_secrets=True)
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    harness.add_relation_unit(rel_id, "kubernetes-worker/0")
+    harness.update_relation_data(
+        rel_id,
+        "kubernetes-worker/0",
+        {"kubelet_user": "system:node:w0", "auth_group": "g"},
+    )
+    with mock.patch("time.time", return_value=1000):
+        provider.issue_tokens(3600)
+    provider._on_pre_commit(None)
+    published = harness.get_relation_data(rel_id, "test/0")["creds"]
+    (entry,) = json.loads(published).values()
+    assert list(entry) == ["scope", "secret_id"]
+
+    # new tokens only change the secret, the creds every unit reads stay
+    harness.update_relation_data(
+        rel_id, "kubernetes-worker/0", {"auth_refresh": "4600"}
+    )
+    with mock.patch("time.time", return_value=2000):
+        assert len(provider.issue_tokens(3600)) == 1
+    provider._on_pre_commit(None)
+    assert harness.get_relation_data(rel_id, "test/0")["creds"] == published
+    secret = harness.model.get_secret(id=entry["secret_id"])
+    assert secret.get_content(refresh=True)["expires-at"] == "5600"
+
+
+def test_signing_state_per_hook(harness):
+    provider = KubeControlProvides(harness.charm, "kube-control")
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    for n in range(2):
+        unit = f"kubernetes-worker/{n}"
+        harness.add_relation_unit(rel_id, unit)
+        harness.update_relation_data(
+            rel_id, unit, {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        )
+        # the charm outlives each hook under Harness
+        assert [r.unit for r in provider.issue_tokens()] == [unit]
+        harness.framework.commit()
+
+
+def test_signing_queue_after_leadership_round_trip(harness):
+    harness.set_leader(True)
+    provider = KubeControlProvides(harness.charm, "kube-control", sign_batch_size=1)
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    for n in range(2):
+        unit = f"kubernetes-worker/{n}"
+        harness.add_relation_unit(rel_id, unit)
+        harness.update_relation_data(
+            rel_id, unit, {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        )
+    assert [r.unit for r in provider.issue_tokens()] == ["kubernetes-worker/0"]
+    assert provider.queue_depth == 1
+    harness.framework.commit()
+
+    # while another unit leads, it signs the request still queued here
+    harness.set_leader(False)
+    harness.set_leader(True)
+    other = TokenIssuer()
+    request = ("kubernetes-worker/1", "system:node:w1", "g")
+    other.record(request, other.issue([request])[request])
+    secret = harness.model.get_secret(label="kube-control-tokens")
+    secret.set_content({"tokens": json.dumps(other.dump())})
+
+    assert provider.queue_depth == 0
+    assert provider.issue_tokens() == []
+
+
+def test_payload_version_round_trip(harness):
+    provider = KubeControlProvides(harness.charm, "kube-control", payload_version=2)
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    harness.add_relation_unit(rel_id, "kubernetes-worker/0")
+    harness.update_relation_data(
+        rel_id, "kubernetes-worker/0", {"payload-version": "2"}
+    )
+    provider.set_dns_port(53)
+    provider.set_dns_domain("cluster.local")
+    provider.flush()
+    published = harness.get_relation_data(rel_id, "test/0")
+    assert list(published) == ["kube-control-v2"]
+
+    # a worker which hasn't advertised v2 yet drops the relation to v1
+    harness.add_relation_unit(rel_id, "kubernetes-worker/1")
+    provider.set_dns_port(54)
+    provider.flush()
+    assert harness.get_relation_data(rel_id, "test/0") == {
+        "port": "54",
+        "domain": "cluster.local",
+    }
+
+    harness.update_relation_data(
+        rel_id, "kubernetes-worker/1", {"payload-version": "2"}
+    )
+    provider.set_labels(["a=b"])
+    provider.flush()
+    published = harness.get_relation_data(rel_id, "test/0")
+    assert list(published) == ["kube-control-v2"]
+    assert json.loads(published["kube-control-v2"])["data"] == {
+        "port": 54,
+        "domain": "cluster.local",
+        "labels": ["a=b"],
+    }
+    assert provider._published(provider.relations[0], "port") == 54
+
+
+def test_auth_request_events_after_upgrade():
+    harness = Harness(CharmBase, meta=METADATA)
+    rel_id = harness.add_relation("kube-control", "kubernetes-worker")
+    for n in range(2):
+        unit = f"kubernetes-worker/{n}"
+        harness.add_relation_unit(rel_id, unit)
+        harness.update_relation_data(
+            rel_id, unit, {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        )
+    harness.begin()
+    provider = KubeControlProvides(harness.charm, "kube-control")
+    recorder = EventRecorder(harness.charm)
+    harness.framework.observe(provider.on.auth_requested, recorder.record)
+
+    # requests made before the upgrade are emitted once
+    harness.charm.on.upgrade_charm.emit()
+    assert [request.unit for _, request, _ in recorder.events] == [
+        "kubernetes-worker/0",
+        "kubernetes-worker/1",
+    ]
+    recorder.events.clear()
+    harness.charm.on.upgrade_charm.emit()
+    harness.update_relation_data(rel_id, "kubernetes-worker/0", {"gpu": "True"})
+    assert recorder.events == []
+    harness.cleanup()
@@ -1,19 +1,49 @@
 # Copyright 2022 Canonical Ltd.
 # See LICENSE file for licensing details.
+import gc
+import json
 import unittest.mock as mock
 from pathlib import Path
 
 import pytest
 import yaml
 from ops.charm import RelationBrokenEvent, CharmBase
+from ops.framework import Object
+from ops.model import Unit
 from ops.interface_kube_control import KubeControlRequirer
+from ops.interface_kube_control.core import decode_field, encode_payload
+from ops.interface_kube_control.model import Data
+from ops.testing import Harness
+
+METADATA = """
+name: test
+requires:
+  kube-control:
+    interface: kube-control
+"""
 
 
 @pytest.fixture(scope="function")
-def kube_control_requirer():
-    mock_charm = mock.MagicMock(auto_spec=CharmBase)
-    mock_charm.framework.model.unit.name = "test/0"
-    yield KubeControlRequirer(mock_charm)
+def harness():
+    harness = Harness(CharmBase, meta=METADATA)
+    harness.begin()
+    yield harness
+    harness.cleanup()
+
+
+@pytest.fixture(scope="function")
+def kube_control_requirer(harness):
+    yield KubeControlRequirer(harness.charm)
+
+
+def set_remote_data(relation, databags):
+    """Give a mocked relation remote units publishing the given databags."""
+    units = {}
+    for name in databags:
+        units[name] = mock.MagicMock(spec=Unit)
+        units[name].name = name
+    relation.units = list(units.values())
+    relation.data = {units[name]: data for name, data in databags.items()}
 
 
 @pytest.fixture(autouse=True)
@@ -62,8 +92,7 @@ def test_is_ready_invalid_data(kube_control_requirer, relation_data):
         KubeControlRequirer, "relation", new_callable=mock.PropertyMock
     ) as mock_prop:
         relation = mock_prop.return_value
-        relation.units = ["remote/0"]
-        relation.data = {"remote/0": relation_data}
+        set_remote_data(relation, {"remote/0": relation_data})
         assert kube_control_requirer.is_ready is False
 
 
@@ -72,8 +101,7 @@ def test_is_ready_success(kube_control_requirer, relation_data):
         KubeControlRequirer, "relation", new_callable=mock.PropertyMock
     ) as mock_prop:
         relation = mock_prop.return_value
-        relation.units = ["remote/0"]
-        relation.data = {"remote/0": relation_data}
+        set_remote_data(relation, {"remote/0": relation_data})
         assert kube_control_requirer.is_ready is True
 
 
@@ -83,8 +111,7 @@ def test_create_kubeconfig(kube_control_requirer, relation_data, mock_ca_cert, t
         KubeControlRequirer, "relation", new_callable=mock.PropertyMock
     ) as mock_prop:
         relation = mock_prop.return_value
-        relation.units = ["remote/0"]
-        relation.data = {"remote/0": relation_data}
+        set_remote_data(relation, {"remote/0": relation_data})
 
         kube_config = Path(tmpdir) / "kube_config"
 
@@ -111,8 +138,7 @@ def test_taints_and_labels(kube_control_requirer, relation_data):
         KubeControlRequirer, "relation", new_callable=mock.PropertyMock
     ) as mock_prop:
         relation = mock_prop.return_value
-        relation.units = ["remote/0"]
-        relation.data = {"remote/0": relation_data}
+        set_remote_data(relation, {"remote/0": relation_data})
         taints = kube_control_requirer.get_controller_taints()
         labels = kube_control_requirer.get_controller_labels()
         assert taints[0].groups == (
@@ -127,3 +153,570 @@ def test_taints_and_labels(kube_control_requirer, relation_data):
         assert labels[0].groups == ("node-role.kubernetes.io/control-plane", "")
         assert labels[0].key == "node-role.kubernetes.io/control-plane"
         assert labels[0].value == "", "Labels must have a value, it can be an empty str"
+
+
+def test_payload_v2(kube_control_requirer, relation_data):
+    payload = {
+        key: json.loads(relation_data[key])
+        for key in (
+            "api-endpoints",
+            "cohort-keys",
+            "creds",
+            "default-cni",
+            "has-xcp",
+            "port",
+            "taints",
+            "labels",
+        )
+    }
+    for key in ("cluster-tag", "domain", "registry-location", "sdn-ip"):
+        payload[key] = relation_data[key]
+    payload["enable-kube-dns"] = True
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        set_remote_data(
+            relation,
+            {
+                "remote/0": {
+                    "kube-control-v2": json.dumps({"version": 2, "data": payload})
+                }
+            },
+        )
+        assert kube_control_requirer.is_ready is True
+        assert kube_control_requirer.get_dns()["port"] == 53
+        assert kube_control_requirer.get_api_endpoints() == [
+            "https://10.246.154.7:6443"
+        ]
+        creds = kube_control_requirer.get_auth_credentials("test/0")
+        assert creds["client_token"] == "admin::redacted"
+        assert kube_control_requirer.get_controller_taints()[0].effect == "NoSchedule"
+
+
+def test_changed_fields_across_hooks(harness, relation_data):
+    def next_hook():
+        # each requirer instance stands in for a new hook, the framework
+        # only allows one live instance at a time
+        gc.collect()
+        return KubeControlRequirer(harness.charm)
+
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        set_remote_data(relation, {"remote/0": relation_data})
+
+        requirer = next_hook()
+        assert "creds" in requirer.changed_fields
+        assert "port" in requirer.changed_fields
+        harness.framework.commit()
+        del requirer
+
+        with mock.patch.object(Data, "__init__") as validate:
+            requirer = next_hook()
+            assert requirer.changed_fields == set()
+            creds = requirer.get_auth_credentials("test/0")
+            assert creds["client_token"] == "admin::redacted"
+            validate.assert_not_called()
+        harness.framework.commit()
+        del requirer
+
+        relation_data["port"] = "5353"
+        requirer = next_hook()
+        assert requirer.changed_fields == {"port"}
+        assert requirer.get_dns()["port"] == 5353
+
+
+def test_unchanged_v2_hook_skips_decoding(harness, relation_data):
+    from ops.interface_kube_control import requires
+
+    def next_hook():
+        gc.collect()
+        return KubeControlRequirer(harness.charm)
+
+    fields = {key: decode_field(key, value) for key, value in relation_data.items()}
+    payload = encode_payload(fields)
+    assert isinstance(json.loads(payload)["data"]["creds"], str)
+    other = encode_payload(dict(fields, port=5353))
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        set_remote_data(
+            relation,
+            {
+                "remote/0": {"kube-control-v2": payload},
+                "remote/1": {"kube-control-v2": other},
+            },
+        )
+        requirer = next_hook()
+        assert requirer.is_ready
+        assert requirer.merge_conflicts["port"] == {"remote/0": 53, "remote/1": 5353}
+        harness.framework.commit()
+        del requirer
+
+        with mock.patch.object(
+            requires, "merge_databags", wraps=requires.merge_databags
+        ) as merge:
+            requirer = next_hook()
+            creds = requirer.get_auth_credentials("test/0")
+            assert creds["client_token"] == "admin::redacted"
+            merge.assert_not_called()
+            # only the requested user's creds were decoded
+            assert requirer._data.creds._entries is None
+            assert list(requirer.merge_conflicts) == ["port"]
+
+
+class EventRecorder(Object):
+    def __init__(self, parent):
+        super().__init__(parent, "recorder")
+        self.events = []
+
+    def record(self, event):
+        self.events.append(event)
+
+
+def test_change_events(harness, relation_data):
+    requirer = KubeControlRequirer(harness.charm)
+    recorder = EventRecorder(harness.charm)
+    seen = recorder.events
+
+    for name in (
+        "api_endpoints_changed",
+        "cohort_keys_changed",
+        "credentials_changed",
+        "default_cni_changed",
+        "dns_changed",
+        "labels_changed",
+        "taints_changed",
+    ):
+        harness.framework.observe(getattr(requirer.on, name), recorder.record)
+
+    rel_id = harness.add_relation("kube-control", "kubernetes-control-plane")
+    harness.update_relation_data(rel_id, "test/0", {"kubelet_user": "test/0"})
+    harness.add_relation_unit(rel_id, "kubernetes-control-plane/0")
+    harness.update_relation_data(rel_id, "kubernetes-control-plane/0", relation_data)
+    assert {type(e).__name__ for e in seen} == {
+        "KubeControlChangedEvent",
+        "CredentialsChangedEvent",
+    }
+    assert len(seen) == 7
+
+    seen.clear()
+    harness.update_relation_data(rel_id, "kubernetes-control-plane/0", {"port": "5353"})
+    (dns,) = seen
+    assert dns.old["port"] == 53
+    assert dns.new["port"] == 5353
+
+    seen.clear()
+    creds = json.loads(relation_data["creds"])
+    creds["test/0"]["client_token"] = "admin::rotated"
+    creds["other/0"] = dict(creds["test/0"], scope="other/0")
+    harness.update_relation_data(
+        rel_id, "kubernetes-control-plane/0", {"creds": json.dumps(creds)}
+    )
+    (cred,) = seen
+    assert cred.user == "test/0"
+    assert cred.old["client_token"] == "admin::redacted"
+    assert cred.new["client_token"] == "admin::rotated"
+
+    seen.clear()
+    harness.update_relation_data(
+        rel_id, "kubernetes-control-plane/0", {"egress-subnets": "10.0.0.0/24"}
+    )
+    assert seen == []
+
+
+def test_changed_cohorts(kube_control_requirer, relation_data):
+    relation_data["cohort-revisions"] = json.dumps(
+        {snap: 1 for snap in json.loads(relation_data["cohort-keys"])}
+    )
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        set_remote_data(relation, {"remote/0": relation_data})
+        assert len(kube_control_requirer.changed_cohorts()) == 7
+        assert kube_control_requirer.changed_cohorts() == {}
+
+        cohort_keys = json.loads(relation_data["cohort-keys"])
+        cohort_keys["kubelet"] = "new-key"
+        revisions = json.loads(relation_data["cohort-revisions"])
+        revisions["kubelet"] = 2
+        relation_data["cohort-keys"] = json.dumps(cohort_keys)
+        relation_data["cohort-revisions"] = json.dumps(revisions)
+        kube_control_requirer._forget()
+        assert kube_control_requirer.changed_cohorts() == {"kubelet": "new-key"}
+
+        # a new leader's revision can match the last one's for another key
+        cohort_keys["kubelet"] = "other-key"
+        relation_data["cohort-keys"] = json.dumps(cohort_keys)
+        kube_control_requirer._forget()
+        assert kube_control_requirer.changed_cohorts() == {"kubelet": "other-key"}
+
+
+def test_malformed_creds(kube_control_requirer, relation_data, caplog):
+    relation_data["creds"] = '{"test/0": {"client_token": admin}}'
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        set_remote_data(relation, {"remote/0": relation_data})
+        assert kube_control_requirer.get_auth_credentials("test/0") is None
+        assert "creds for test/0 not valid" in caplog.text
+        assert list(kube_control_requirer._ready.creds) == []
+
+
+def test_lazy_creds(kube_control_requirer, relation_data):
+    creds = json.loads(relation_data["creds"])
+    creds["other/0"] = {"scope": "other/0"}
+    relation_data["creds"] = json.dumps(creds)
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        set_remote_data(relation, {"remote/0": relation_data})
+        # only the requested entry is decoded and validated
+        assert kube_control_requirer.is_ready is True
+        creds = kube_control_requirer.get_auth_credentials("test/0")
+        assert creds["kubelet_token"] == "test/0::redacted"
+        assert kube_control_requirer.get_auth_credentials("other/0") is None
+        assert kube_control_requirer.get_auth_credentials("missing/0") is None
+
+
+def test_creds_generation_handoff(kube_control_requirer, relation_data):
+    old_leader = dict(relation_data, **{"creds-generation": "100"})
+    new_leader = {k: v for k, v in relation_data.items() if k != "creds"}
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        set_remote_data(relation, {"remote/0": old_leader, "remote/1": new_leader})
+
+        def client_token():
+            kube_control_requirer._forget()
+            creds = kube_control_requirer.get_auth_credentials("test/0")
+            return creds and creds["client_token"]
+
+        assert client_token() == "admin::redacted"
+
+        # old leader clears its creds before the new leader publishes
+        del old_leader["creds"], old_leader["creds-generation"]
+        assert client_token() == "admin::redacted"
+        assert "creds" not in kube_control_requirer.changed_fields
+
+        # the new leader's generation wins over stale creds
+        creds = json.loads(relation_data["creds"])
+        creds["test/0"]["client_token"] = "admin::new"
+        new_leader.update({"creds": json.dumps(creds), "creds-generation": "200"})
+        old_leader.update({"creds": relation_data["creds"], "creds-generation": "100"})
+        assert client_token() == "admin::new"
+
+
+def test_creds_partial_handoff(kube_control_requirer, relation_data):
+    creds = json.loads(relation_data["creds"])
+    creds["other/0"] = dict(creds["test/0"], scope="other/0")
+    old_leader = dict(relation_data, creds=json.dumps(creds))
+    old_leader["creds-generation"] = "100"
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        set_remote_data(relation, {"remote/0": old_leader})
+
+        def client_token(user):
+            kube_control_requirer._forget()
+            creds = kube_control_requirer.get_auth_credentials(user)
+            return creds and creds["client_token"]
+
+        assert client_token("test/0") == "admin::redacted"
+
+        # a new leader signing in batches has only signed other/0 so far
+        new_creds = {"other/0": dict(creds["other/0"], client_token="admin::new")}
+        new_leader = dict(relation_data, creds=json.dumps(new_creds))
+        new_leader["creds-generation"] = "200"
+        set_remote_data(relation, {"remote/0": old_leader, "remote/1": new_leader})
+        assert client_token("other/0") == "admin::new"
+        assert client_token("test/0") == "admin::redacted"
+
+        new_creds["test/0"] = dict(creds["test/0"], client_token="admin::newer")
+        new_leader["creds"] = json.dumps(new_creds)
+        assert client_token("test/0") == "admin::newer"
+
+
+def test_merge_conflicts(kube_control_requirer, relation_data):
+    other = dict(relation_data, **{"registry-location": "other.registry"})
+    del other["creds"]
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        # remote/1 is preferred as the unit publishing creds
+        set_remote_data(relation, {"remote/0": other, "remote/1": relation_data})
+        assert kube_control_requirer.get_registry_location() == (
+            "rocks.canonical.com:443/cdk"
+        )
+        assert kube_control_requirer.merge_conflicts == {
+            "registry-location": {
+                "remote/0": "other.registry",
+                "remote/1": "rocks.canonical.com:443/cdk",
+            }
+        }
+
+
+def test_get_node_patch(kube_control_requirer, relation_data):
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        set_remote_data(mock_prop.return_value, {"remote/0": relation_data})
+        taints = kube_control_requirer.get_controller_taints()
+        labels = kube_control_requirer.get_controller_labels()
+        node = {
+            "metadata": {"labels": dict(label.groups for label in labels)},
+            "spec": {
+                "taints": [
+                    {"key": taint.key, "effect": taint.effect} for taint in taints
+                ]
+            },
+        }
+        assert kube_control_requirer.get_node_patch(node) is None
+        node["metadata"]["labels"] = {}
+        patch = kube_control_requirer.get_node_patch(node)
+        assert patch == {"metadata": {"labels": dict(label.groups for label in labels)}}
+
+
+def test_payload_stats(kube_control_requirer, relation_data):
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        set_remote_data(
+            mock_prop.return_value,
+            {"remote/0": relation_data, "remote/1": {"port": "53"}},
+        )
+        stats = kube_control_requirer.payload_stats
+        port = len("port") + len(relation_data["port"])
+        assert stats["port"] == {
+            "total": port + 6,
+            "max": max(port, 6),
+            "growth": port + 6,
+        }
+        assert stats["creds"]["total"] == len("creds") + len(relation_data["creds"])
+
+
+def test_payload_growth_seen_by_the_charm(harness):
+    class Charm(Object):
+        # observes relation-changed after the requirer, as a charm would
+        def record(self, _event):
+            growth.append(requirer.payload_stats["cluster-tag"]["growth"])
+
+    requirer = KubeControlRequirer(harness.charm)
+    growth = []
+    charm = Charm(harness.charm, "charm")
+    harness.framework.observe(
+        harness.charm.on["kube-control"].relation_changed, charm.record
+    )
+    rel_id = harness.add_relation("kube-control", "kubernetes-control-plane")
+    harness.add_relation_unit(rel_id, "kubernetes-control-plane/0")
+    harness.update_relation_data(
+        rel_id, "kubernetes-control-plane/0", {"cluster-tag": "abc"}
+    )
+    harness.framework.commit()
+    harness.update_relation_data(
+        rel_id, "kubernetes-control-plane/0", {"cluster-tag": "abcdefghij"}
+    )
+    charm.record(None)  # later in the same hook
+    harness.framework.commit()
+    assert growth == [len("cluster-tag") + 3, 7, 7]
+
+
+def test_last_known_good_snapshot(relation_data, tmp_path):
+    snapshot_path = tmp_path / "kube-control.json"
+
+    def startup():
+        # a fresh charm, as after a reboot or upgrade
+        harness = Harness(CharmBase, meta=METADATA)
+        harness.begin()
+        return KubeControlRequirer(harness.charm, snapshot_path=snapshot_path)
+
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        relation = mock_prop.return_value
+        set_remote_data(relation, {"remote/0": relation_data})
+        requirer = startup()
+        assert requirer.is_ready and not requirer.is_stale
+        assert snapshot_path.stat().st_mode & 0o777 == 0o600
+
+        set_remote_data(relation, {})
+        requirer = startup()
+        assert requirer.is_ready and requirer.is_stale
+        assert requirer.get_dns()["port"] == int(relation_data["port"])
+        creds = requirer.get_auth_credentials("test/0")
+        assert creds["client_token"] == "admin::redacted"
+
+        set_remote_data(relation, {"remote/0": relation_data})
+        requirer = startup()
+        assert requirer.is_ready and not requirer.is_stale
+
+        doc = json.loads(snapshot_path.read_text())
+        doc["data"]["port"] = 1
+        snapshot_path.write_text(json.dumps(doc))
+        set_remote_data(relation, {})
+        requirer = startup()
+        assert not requirer.is_ready
+
+        mock_prop.return_value = None
+        assert not startup().is_ready
+
+
+def test_multiple_relations(relation_data):
+    harness = Harness(
+        CharmBase,
+        meta=METADATA + "  other:\n    interface: other\n",
+    )
+    harness.begin()
+    requirer = KubeControlRequirer(harness.charm)
+    first = harness.add_relation("kube-control", "cp-a")
+    second = harness.add_relation("kube-control", "cp-b")
+    other = harness.add_relation("other", "other-app")
+    harness.add_relation_unit(second, "cp-b/0")
+    harness.update_relation_data(second, "cp-b/0", relation_data)
+
+    # the oldest relation with remote units is active until one is selected
+    assert requirer.relation.id == second
+    assert requirer.is_ready
+    assert [r.id for r in requirer.ready_relations] == [second]
+
+    harness.add_relation_unit(first, "cp-a/0")
+    harness.update_relation_data(first, "cp-a/0", dict(relation_data, port="5353"))
+    assert {r.id for r in requirer.ready_relations} == {first, second}
+    requirer.select_relation(first)
+    assert requirer.get_dns()["port"] == 5353
+    requirer.select_relation(second)
+    assert requirer.get_dns()["port"] == int(relation_data["port"])
+
+    requirer.set_gpu(True)
+    requirer.set_auth_request("test/0")
+    for rel_id in (first, second):
+        published = harness.get_relation_data(rel_id, "test/0")
+        assert published["gpu"] == "True"
+        assert published["kubelet_user"] == "test/0"
+    assert harness.get_relation_data(other, "test/0") == {}
+
+    harness.remove_relation(second)
+    requirer.select_relation(None)
+    assert requirer.relation.id == first
+    harness.cleanup()
+
+
+def test_app_databag_first(harness, relation_data):
+    requirer = KubeControlRequirer(harness.charm)
+    rel_id = harness.add_relation("kube-control", "kubernetes-control-plane")
+    harness.add_relation_unit(rel_id, "kubernetes-control-plane/0")
+    harness.update_relation_data(rel_id, "kubernetes-control-plane/0", relation_data)
+    harness.update_relation_data(
+        rel_id, "kubernetes-control-plane", {"cluster-tag": "from-app"}
+    )
+    assert requirer.get_cluster_tag() == "from-app"
+    assert requirer.get_dns()["port"] == int(relation_data["port"])
+
+
+def test_credentials_expiring(harness, kube_control_requirer, relation_data):
+    creds = json.loads(relation_data["creds"])
+    creds["test/0"].update(issued_at=1000, expires_at=4000)
+    relation_data["creds"] = json.dumps(creds)
+    rel_id = harness.add_relation("kube-control", "kubernetes-control-plane")
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        set_remote_data(mock_prop.return_value, {"remote/0": relation_data})
+        creds = kube_control_requirer.get_auth_credentials("test/0")
+        assert (creds["issued_at"], creds["expires_at"]) == (1000, 4000)
+
+        # refreshed between a half and a third of the lifetime before expiry
+        refresh_at = kube_control_requirer.credentials_refresh_at("test/0")
+        assert 2500 <= refresh_at <= 3000
+        assert not kube_control_requirer.credentials_expiring("test/0", now=2499)
+        assert kube_control_requirer.credentials_expiring("test/0", now=3000)
+
+        kube_control_requirer.request_credentials_refresh("test/0")
+        assert harness.get_relation_data(rel_id, "test/0") == {"auth_refresh": "4000"}
+
+
+def test_read_views(kube_control_requirer, relation_data):
+    with mock.patch.object(
+        KubeControlRequirer, "relation", new_callable=mock.PropertyMock
+    ) as mock_prop:
+        set_remote_data(mock_prop.return_value, {"remote/0": relation_data})
+        with mock.patch.object(
+            KubeControlRequirer, "is_ready", new_callable=mock.PropertyMock
+        ) as is_ready:
+            is_ready.return_value = True
+            dns = kube_control_requirer.get_dns()
+            creds = kube_control_requirer.get_auth_credentials("test/0")
+            endpoints = kube_control_requirer.get_api_endpoints()
+            assert kube_control_requirer.get_dns() is dns
+            assert kube_control_requirer.get_auth_credentials("test/0") is creds
+            assert kube_control_requirer.get_api_endpoints() is endpoints
+            assert is_ready.call_count == 1
+
+        assert dns.domain == dns["domain"] == "cluster.local"
+        assert creds.client_token == "admin::redacted"
+        assert endpoints == ["https://10.246.154.7:6443"]
+        assert endpoints + ["https://b"] == ["https://10.246.154.7:6443", "https://b"]
+        with pytest.raises(TypeError):
+            endpoints.append("https://b")
+        with pytest.raises(TypeError):
+            dns["port"] = 54
+
+
+def test_creds_secret(harness, relation_data):
+    requirer = KubeControlRequirer(harness.charm)
+    recorder = EventRecorder(harness.charm)
+    harness.framework.observe(requirer.on.credentials_changed, recorder.record)
+
+    rel_id = harness.add_relation("kube-control", "kubernetes-control-plane")
+    harness.update_relation_data(rel_id, "test/0", {"kubelet_user": "test/0"})
+    harness.add_relation_unit(rel_id, "kubernetes-control-plane/0")
+    content = {
+        "client-token": "admin::secret",
+        "kubelet-token": "test/0::secret",
+        "proxy-token": "kube-proxy::secret",
+        "scope": "test/0",
+    }
+    secret_id = harness.add_model_secret("kubernetes-control-plane/0", content)
+    harness.grant_secret(secret_id, "test/0")
+    relation_data["creds"] = json.dumps(
+        {"test/0": {"scope": "test/0", "secret_id": secret_id}}
+    )
+    harness.update_relation_data(rel_id, "kubernetes-control-plane/0", relation_data)
+    (cred,) = recorder.events
+    assert cred.new["client_token"] == "admin::secret"
+    assert requirer.get_auth_credentials("test/0")["kubelet_token"] == "test/0::secret"
+
+    recorder.events.clear()
+    harness.set_secret_content(secret_id, dict(content, **{"client-token": "a::new"}))
+    (cred,) = recorder.events
+    assert (cred.old["client_token"], cred.new["client_token"]) == (
+        "admin::secret",
+        "a::new",
+    )
+    assert requirer.get_auth_credentials("test/0")["client_token"] == "a::new"
+
+    # creds moved to another secret are read from it, under their own label
+    recorder.events.clear()
+    moved = harness.add_model_secret("kubernetes-control-plane/0", content)
+    harness.grant_secret(moved, "test/0")
+    relation_data["creds"] = json.dumps(
+        {"test/0": {"scope": "test/0", "secret_id": moved}}
+    )
+    harness.update_relation_data(rel_id, "kubernetes-control-plane/0", relation_data)
+    assert requirer.get_auth_credentials("test/0")["client_token"] == "admin::secret"
+    for i, token in ((secret_id, "a::new"), (moved, "admin::secret")):
+        secret = harness.model.get_secret(label=requirer._secret_label(i))
+        assert secret.get_content(refresh=True)["client-token"] == token
+    recorder.events.clear()
+    harness.set_secret_content(moved, dict(content, **{"client-token": "a::moved"}))
+    (cred,) = recorder.events
+    assert cred.new["client_token"] == "a::moved"
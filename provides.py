@@ -10,27 +10,81 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import List, Union
-from charms.reactive import Endpoint, toggle_flag, set_flag, data_changed
+import json
+import time
+from typing import Any, Dict, List, Optional, Union
+from charms.reactive import Endpoint, toggle_flag, set_flag, is_flag_set
 
 from charmhelpers.core import hookenv, unitdata
 
 try:
+    from .core import (
+        HookProfiler,
+        PayloadBudgetError,
+        PayloadMeter,
+        SigningQueue,
+        TokenIssuer,
+        diff_digests,
+        profiled,
+        refresh_requested,
+        request_digest,
+    )
     from .models import Taint, Label, DecodeError
 except ImportError:
     # when this code is under test...it's not installed in a package
     # so catching this exception is simply for the test framework
+    from core import (
+        HookProfiler,
+        PayloadBudgetError,
+        PayloadMeter,
+        SigningQueue,
+        TokenIssuer,
+        diff_digests,
+        profiled,
+        refresh_requested,
+        request_digest,
+    )
     from models import Taint, Label, DecodeError
 
-DB = unitdata.kv()
-
 
+@profiled
 class KubeControlProvider(Endpoint):
     """
     Implements the kubernetes-control-plane side of the kube-control interface.
+
+    With app_databag set, the leader publishes the shared fields once in the
+    application data rather than every unit publishing them in its own, and
+    the other units publish nothing.
+
+    Auth requests waiting to be signed are kept in a queue in unitdata.
+    pending_auth_requests() hands out at most sign_batch_size of them, or as
+    many as fit in sign_time_budget seconds, per hook, and the rest wait for
+    later hooks. See queue_depth and drain_estimate. issue_tokens() signs
+    them with tokens it generates, keeping only their hashes.
+
+    The bytes written to each relation are measured as they're published,
+    see payload_stats. Writes which take a relation's data over
+    payload_budget bytes log a warning, or raise PayloadBudgetError when
+    refuse_over_budget is set.
+
+    With a profile_dir, or $KUBE_CONTROL_PROFILE set, calls into the
+    endpoint are profiled and each hook's profile is saved there.
     """
 
     DecodeError = DecodeError
+    PayloadBudgetError = PayloadBudgetError
+
+    app_databag = False
+    sign_batch_size: Optional[int] = None
+    sign_time_budget: Optional[float] = None
+    _signing_queue = None
+    _signed_requests = None
+    _token_issuer = None
+    payload_budget: Optional[int] = None
+    refuse_over_budget = False
+    _payload_meter = None
+    profile_dir = None
+    _profiler = None
 
     def manage_flags(self):
         toggle_flag(self.expand_name("{endpoint_name}.connected"), self.is_joined)
@@ -38,10 +92,47 @@ class KubeControlProvider(Endpoint):
             self.expand_name("{endpoint_name}.gpu.available"),
             self.is_joined and self._get_gpu(),
         )
-        requests_data_id = self.expand_name("{endpoint_name}.requests")
-        requests = self.auth_user()
-        if data_changed(requests_data_id, requests):
-            set_flag(self.expand_name("{endpoint_name}.requests.changed"))
+        db = unitdata.kv()
+        digests_id = self.expand_name("{endpoint_name}.request-digests")
+        baseline_id = self.expand_name("{endpoint_name}.request-baseline")
+        changed_flag = self.expand_name("{endpoint_name}.requests.changed")
+        previous = db.get(digests_id)
+        joined = {unit.unit_name: unit for unit in self.all_joined_units}
+        digests = {
+            name: digest for name, digest in (previous or {}).items() if name in joined
+        }
+        # only the remote unit's data can have changed in a relation hook
+        names = joined if previous is None else [hookenv.remote_unit()]
+        for name in filter(joined.__contains__, names):
+            data = joined[name].received_raw
+            digests.pop(name, None)
+            if data.get("kubelet_user"):
+                digests[name] = request_digest(
+                    data.get("kubelet_user"),
+                    data.get("auth_group"),
+                    *filter(None, [data.get("auth_refresh")]),
+                )
+        db.set(digests_id, digests)
+        if not is_flag_set(changed_flag):
+            # the changes so far were handled, count new ones from here
+            db.set(baseline_id, previous or {})
+        changes = diff_digests(db.get(baseline_id) or {}, digests)
+        db.set(self.expand_name("{endpoint_name}.request-changes"), changes)
+        if any(changes.values()):
+            set_flag(changed_flag)
+
+    def request_changes(self):
+        """
+        Units whose auth requests were added, changed or removed since
+        requests.changed was last cleared, as a dict with lists of unit names
+        under "added", "changed" and "removed".
+        """
+        changes_id = self.expand_name("{endpoint_name}.request-changes")
+        return unitdata.kv().get(changes_id) or {
+            "added": [],
+            "changed": [],
+            "removed": [],
+        }
 
     def set_dns(self, port, domain, sdn_ip, enable_kube_dns):
         """
@@ -51,15 +142,15 @@ class KubeControlProvider(Endpoint):
         sdn_ip is not required in your deployment, the units private-ip
         is available implicitly.
         """
-        for relation in self.relations:
-            relation.to_publish_raw.update(
-                {
-                    "port": port,
-                    "domain": domain,
-                    "sdn-ip": sdn_ip,
-                    "enable-kube-dns": enable_kube_dns,
-                }
-            )
+        self._publish(
+            {
+                "port": port,
+                "domain": domain,
+                "sdn-ip": sdn_ip,
+                "enable-kube-dns": enable_kube_dns,
+            },
+            raw=True,
+        )
 
     def auth_user(self):
         """
@@ -81,35 +172,255 @@ class KubeControlProvider(Endpoint):
         requests.sort()
         return requests
 
-    def sign_auth_request(self, scope, user, kubelet_token, proxy_token, client_token):
+    def sign_auth_request(
+        self,
+        scope,
+        user,
+        kubelet_token,
+        proxy_token,
+        client_token,
+        expires_at=None,
+        issued_at=None,
+    ):
         """
         Send authorization tokens to the requesting unit.
+
+        expires_at and issued_at are unix timestamps, where issued_at
+        defaults to now for tokens which expire.
         """
+        db = unitdata.kv()
         cred = {
             "scope": scope,
             "kubelet_token": kubelet_token,
             "proxy_token": proxy_token,
             "client_token": client_token,
         }
+        if expires_at is not None:
+            cred["issued_at"] = int(time.time()) if issued_at is None else issued_at
+            cred["expires_at"] = expires_at
 
-        if not DB.get("creds"):
-            DB.set("creds", {})
+        if not db.get("creds"):
+            db.set("creds", {})
 
-        all_creds = DB.get("creds")
+        all_creds = db.get("creds")
         all_creds[user] = cred
-        DB.set("creds", all_creds)
+        db.set("creds", all_creds)
+        self._signed.add((scope, user))
 
-        for relation in self.relations:
-            relation.to_publish.update({"creds": all_creds})
+        # a new generation starts the first time this unit signs after creds
+        # were cleared, so it's higher than any previous leader's generation
+        if not db.get("creds-generation"):
+            db.set("creds-generation", int(time.time() * 1000))
+        generation = db.get("creds-generation")
+
+        self._publish({"creds": all_creds})
+        self._publish({"creds-generation": str(generation)}, raw=True)
+
+    @property
+    def profiler(self):
+        """Profiles calls into the endpoint, saved when the hook exits."""
+        if self._profiler is None:
+            self._profiler = HookProfiler(
+                self.profile_dir, self.expand_name("{endpoint_name}-provides")
+            )
+            if self._profiler.enabled:
+                hookenv.atexit(lambda: self._profiler.dump(len(self.all_joined_units)))
+        return self._profiler
+
+    @property
+    def _signed(self):
+        """Scope and user of the requests signed by this instance."""
+        if self._signed_requests is None:
+            self._signed_requests = set()
+        return self._signed_requests
+
+    @property
+    def signing_queue(self) -> SigningQueue:
+        """
+        Auth requests which haven't been signed, oldest first. Requests to
+        refresh creds come first, the soonest to expire first.
+        """
+        if self._signing_queue is None:
+            db = unitdata.kv()
+            creds = db.get("creds") or {}
+            refresh = {
+                unit.unit_name: unit.received_raw.get("auth_refresh")
+                for unit in self.all_joined_units
+            }
+
+            def entry(r):
+                # a previous leader's creds are known from its issuer records
+                return creds.get(r[1]) or issuer.issued.get(r[1])
+
+            def refreshing(r):
+                if entry(r) and refresh_requested(entry(r), refresh.get(r[0])):
+                    return entry(r)["expires_at"]
+                return None
+
+            def done(r):
+                signed = (entry(r) or {}).get("scope") == r[0]
+                return signed and refreshing(r) is None and not issuer.stale(r)
+
+            issuer = self.token_issuer
+
+            self._signing_queue = SigningQueue(
+                db.get(self.expand_name("{endpoint_name}.sign-queue")),
+                self.sign_batch_size,
+                self.sign_time_budget,
+            )
+            self._signing_queue.sync(
+                (
+                    (unit, request["user"], request["group"])
+                    for unit, request in self.auth_user()
+                    if request["user"] and request["group"]
+                ),
+                done,
+                refreshing,
+            )
+        return self._signing_queue
+
+    def pending_auth_requests(self):
+        """
+        The auth requests to sign in this hook, as (unit, request) pairs in
+        the same form as auth_user().
+
+        Each should be signed with sign_auth_request before asking for the
+        next. Requests left unsigned go to the back of the queue.
+        """
+        queue = self.signing_queue
+        try:
+            for unit, user, group in queue.batch(lambda r: r[:2] in self._signed):
+                yield unit, {"user": user, "group": group}
+        finally:
+            unitdata.kv().set(
+                self.expand_name("{endpoint_name}.sign-queue"), queue.dump()
+            )
+
+    @property
+    def token_issuer(self) -> TokenIssuer:
+        """
+        Hashes of the tokens issued by issue_tokens, kept in unitdata. The
+        leader keeps them in leader data too, so the next leader knows which
+        requests were signed before it and doesn't sign them again.
+        """
+        if self._token_issuer is None:
+            tokens_id = self.expand_name("{endpoint_name}.tokens")
+            self._token_issuer = TokenIssuer(unitdata.kv().get(tokens_id))
+            shared = hookenv.leader_get(tokens_id)
+            if shared:
+                self._token_issuer.merge(json.loads(shared))
+        return self._token_issuer
+
+    def issue_tokens(self, ttl=None):
+        """
+        Generate and send tokens for this hook's pending auth requests, and
+        return the (unit, request) pairs signed.
+
+        Tokens for the whole batch come from one read of the RNG, and only
+        their hashes are kept, see token_issuer. Signed requests leave the
+        queue, so later hooks, and later leaders, don't generate new tokens
+        for the same user, group and scope. ttl is how many seconds the
+        tokens are valid for.
+        """
+        issuer = self.token_issuer
+        batch = self.signing_queue.pending[: self.sign_batch_size]
+        tokens = issuer.issue(batch)
+        signed = []
+        for unit, request in self.pending_auth_requests():
+            key = (unit, request["user"], request["group"])
+            fresh = tokens.get(key) or issuer.issue([key])[key]
+            issued_at = int(time.time())
+            expires_at = None if ttl is None else issued_at + ttl
+            self.sign_auth_request(
+                unit,
+                request["user"],
+                fresh["kubelet_token"],
+                fresh["proxy_token"],
+                fresh["client_token"],
+                expires_at=expires_at,
+            )
+            issuer.record(key, fresh, issued_at, expires_at)
+            signed.append((unit, request))
+        tokens_id = self.expand_name("{endpoint_name}.tokens")
+        unitdata.kv().set(tokens_id, issuer.dump())
+        if signed and hookenv.is_leader():
+            hookenv.leader_set({tokens_id: json.dumps(issuer.dump(), sort_keys=True)})
+        return signed
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of auth requests waiting to be signed.
+        """
+        return self.signing_queue.depth
+
+    @property
+    def drain_estimate(self) -> Dict[str, Optional[float]]:
+        """
+        Estimated seconds of signing and hooks until the queue is empty.
+        Either is None until enough requests have been timed to tell.
+        """
+        queue = self.signing_queue
+        return {"seconds": queue.drain_seconds, "hooks": queue.drain_hooks}
 
     def clear_creds(self):
         """
         Clear creds from the relation. This is used by non-leader units to stop
         advertising creds so that the leader can assume full control of them.
         """
-        DB.unset("creds")
+        db = unitdata.kv()
+        db.unset("creds")
+        db.unset("creds-generation")
+        self._publish({"creds": "", "creds-generation": ""}, raw=True)
+
+    @property
+    def payload_meter(self) -> PayloadMeter:
+        """Accounts for the bytes published to each relation this hook."""
+        if self._payload_meter is None:
+            self._payload_meter = PayloadMeter(
+                self.payload_budget, self.refuse_over_budget
+            )
+        return self._payload_meter
+
+    @property
+    def payload_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Bytes published by this unit in this hook, per relation data key.
+
+        Each key maps to its total across relations, the most in any one
+        relation, and its growth in this hook.
+        """
+        return self.payload_meter.stats
+
+    def _publish(self, fields: Dict[str, Any], raw: bool = False):
+        """
+        Publish fields to every relation, measuring them as they're written.
+
+        Fields are JSON encoded unless raw is set.
+        """
+        if self.app_databag and not hookenv.is_leader():
+            return
+        if raw:
+            encoded = {
+                key: "" if value is None else str(value)
+                for key, value in fields.items()
+            }
+        else:
+            encoded = {
+                key: json.dumps(value, sort_keys=True) for key, value in fields.items()
+            }
         for relation in self.relations:
-            relation.to_publish_raw["creds"] = ""
+            if self.app_databag:
+                name = f"{relation.relation_id}/{hookenv.service_name()}"
+                databag, view = relation.to_publish_app_raw, relation.to_publish_app
+            else:
+                name = relation.relation_id
+                databag, view = relation.to_publish_raw, relation.to_publish
+            self.payload_meter.publish(name, databag, encoded)
+            if raw:
+                view = databag
+            for key, value in fields.items():
+                view[key] = value
 
     def _get_gpu(self):
         """
@@ -126,22 +437,33 @@ class KubeControlProvider(Endpoint):
         """
         Send the cluster tag to the remote units.
         """
-        for relation in self.relations:
-            relation.to_publish_raw.update({"cluster-tag": cluster_tag})
+        self._publish({"cluster-tag": cluster_tag}, raw=True)
 
     def set_registry_location(self, registry_location):
         """
         Send the registry location to the remote units.
         """
-        for relation in self.relations:
-            relation.to_publish_raw.update({"registry-location": registry_location})
+        self._publish({"registry-location": registry_location}, raw=True)
 
     def set_cohort_keys(self, cohort_keys):
         """
         Send the cohort snapshot keys.
+
+        Each snap also gets a revision in cohort-revisions which is only
+        bumped when that snap's key changes, so requirers can tell which
+        snaps to refresh without comparing every key.
         """
-        for relation in self.relations:
-            relation.to_publish["cohort-keys"] = cohort_keys
+        db = unitdata.kv()
+        previous = db.get("cohort-keys") or {}
+        revisions = db.get("cohort-revisions") or {}
+        for snap, key in cohort_keys.items():
+            if snap not in previous or previous[snap] != key:
+                revisions[snap] = revisions.get(snap, 0) + 1
+        db.set("cohort-keys", cohort_keys)
+        db.set("cohort-revisions", revisions)
+
+        published = {snap: revisions[snap] for snap in cohort_keys}
+        self._publish({"cohort-keys": cohort_keys, "cohort-revisions": published})
 
     def set_default_cni(self, default_cni):
         """
@@ -150,23 +472,20 @@ class KubeControlProvider(Endpoint):
         default CNI. For example: "flannel" or "calico". If no default has
         been chosen then "" can be sent instead.
         """
-        for relation in self.relations:
-            relation.to_publish["default-cni"] = default_cni
+        self._publish({"default-cni": default_cni})
 
     def set_api_endpoints(self, endpoints):
         """
         Send the list of API endpoint URLs to which workers should connect.
         """
         endpoints = sorted(endpoints)
-        for relation in self.relations:
-            relation.to_publish["api-endpoints"] = endpoints
+        self._publish({"api-endpoints": endpoints})
 
     def set_has_xcp(self, has_xcp):
         """
         Set the flag indicating that an external cloud provider is in use.
         """
-        for relation in self.relations:
-            relation.to_publish["has-xcp"] = bool(has_xcp)
+        self._publish({"has-xcp": bool(has_xcp)})
 
     def set_controller_taints(
         self, taints: List[Union[Taint, str]]
@@ -176,8 +495,7 @@ class KubeControlProvider(Endpoint):
         """
         taints = [str(_) for _ in taints if Taint.valid(_)]
         dedup = sorted(set(taints))
-        for relation in self.relations:
-            relation.to_publish["taints"] = dedup
+        self._publish({"taints": dedup})
         return self
 
     def set_controller_labels(
@@ -188,6 +506,5 @@ class KubeControlProvider(Endpoint):
         """
         labels = [str(_) for _ in labels if Label.valid(_)]
         dedup = sorted(set(labels))
-        for relation in self.relations:
-            relation.to_publish["labels"] = dedup
+        self._publish({"labels": dedup})
         return self
@@ -11,101 +11,246 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List
+import json
+import time
+from typing import Any, Dict, Iterable, List, Mapping, Optional
 from charms.reactive import (
     Endpoint,
     toggle_flag,
 )
 
-from charmhelpers.core.hookenv import log
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import atexit, local_unit, log
 
 try:
+    from .core import (
+        Credentials,
+        DnsInfo,
+        EndpointSet,
+        HookProfiler,
+        carry_creds,
+        changed_cohorts,
+        databag_sizes,
+        encode_fields,
+        extract_creds,
+        merge_databags,
+        node_patch,
+        profiled,
+        read_snapshot,
+        refresh_at,
+        size_stats,
+        write_snapshot,
+    )
     from .models import Taint, Label
 except ImportError:
     # when this code is under test...it's not installed in a package
     # so catching this exception is simply for the test framework
+    from core import (
+        Credentials,
+        DnsInfo,
+        EndpointSet,
+        HookProfiler,
+        carry_creds,
+        changed_cohorts,
+        databag_sizes,
+        encode_fields,
+        extract_creds,
+        merge_databags,
+        node_patch,
+        profiled,
+        read_snapshot,
+        refresh_at,
+        size_stats,
+        write_snapshot,
+    )
     from models import Taint, Label
 
 
+@profiled
 class KubeControlRequirer(Endpoint):
     """
     Implements the kubernetes-worker side of the kube-control interface.
+
+    With a snapshot_path, the last complete data is also kept on disk. While
+    the relation exists but no control-plane units are joined, such as during
+    a controller outage, that snapshot is served instead and the
+    {endpoint_name}.stale flag is set until fresh relation data replaces it.
+
+    With a profile_dir, or $KUBE_CONTROL_PROFILE set, calls into the
+    endpoint are profiled and each hook's profile is saved there.
     """
 
+    snapshot_path = None
+    _last_known_good = None
+    profile_dir = None
+    _profiler = None
+    _views = None
+    _view_sources = ()
+    _payload_stats = None
+
+    @property
+    def profiler(self):
+        """Profiles calls into the endpoint, saved when the hook exits."""
+        if self._profiler is None:
+            self._profiler = HookProfiler(
+                self.profile_dir, self.expand_name("{endpoint_name}-requires")
+            )
+            if self._profiler.enabled:
+                atexit(lambda: self._profiler.dump(len(self.all_joined_units)))
+        return self._profiler
+
     def manage_flags(self):
         """
         Set states corresponding to the data we have.
         """
         toggle_flag(self.expand_name("{endpoint_name}.connected"), self.is_joined)
+        if not self.is_joined:
+            unitdata.kv().unset(self.expand_name("{endpoint_name}.creds"))
+            unitdata.kv().unset(self.expand_name("{endpoint_name}.known-creds"))
+        # measures this hook's payload, for the next hook's growth
+        self.payload_stats
+        if self.is_joined and self.snapshot_path and self.dns_ready():
+            self._save_snapshot()
+        stale = self.is_stale
+        toggle_flag(self.expand_name("{endpoint_name}.stale"), stale)
+        available = self.is_joined or stale
         toggle_flag(
             self.expand_name("{endpoint_name}.dns.available"),
-            self.is_joined and self.dns_ready(),
+            available and self.dns_ready(),
         )
         toggle_flag(
             self.expand_name("{endpoint_name}.auth.available"),
-            self.is_joined and self._has_auth_credentials(),
+            available and self._has_auth_credentials(),
         )
         toggle_flag(
             self.expand_name("{endpoint_name}.cluster_tag.available"),
-            self.is_joined and self.get_cluster_tag(),
+            available and self.get_cluster_tag(),
         )
         toggle_flag(
             self.expand_name("{endpoint_name}.registry_location.available"),
-            self.is_joined and self.get_registry_location(),
+            available and self.get_registry_location(),
         )
         toggle_flag(
             self.expand_name("{endpoint_name}.controller_taints.available"),
-            self.is_joined and self.get_controller_taints(),
+            available and self.get_controller_taints(),
         )
         toggle_flag(
             self.expand_name("{endpoint_name}.controller_labels.available"),
-            self.is_joined and self.get_controller_labels(),
+            available and self.get_controller_labels(),
         )
         toggle_flag(
             self.expand_name("{endpoint_name}.cohort_keys.available"),
-            self.is_joined and self.cohort_keys,
+            available and self.cohort_keys,
         )
         toggle_flag(
             self.expand_name("{endpoint_name}.default_cni.available"),
-            self.is_joined and self.get_default_cni() is not None,
+            available and self.get_default_cni() is not None,
         )
         toggle_flag(
             self.expand_name("{endpoint_name}.api_endpoints.available"),
-            self.is_joined and self.get_api_endpoints(),
+            available and self.get_api_endpoints(),
+        )
+
+    def _view(self, name, build):
+        """
+        A read view built once for the data currently received.
+
+        Views are rebuilt once any unit or application data received, or the
+        snapshot served while stale, is replaced.
+        """
+        sources = (
+            self._last_known_good,
+            *(relation.received_app_raw for relation in self.relations),
+            *(relation.received_app for relation in self.relations),
+            *(unit.received_raw for unit in self.all_joined_units),
+            *(unit.received for unit in self.all_joined_units),
         )
+        if len(sources) != len(self._view_sources) or any(
+            new is not old for new, old in zip(sources, self._view_sources)
+        ):
+            self._views, self._view_sources = {}, sources
+        if name not in self._views:
+            self._views[name] = build()
+        return self._views[name]
 
     def get_auth_credentials(self, user):
         """
         Return the authentication credentials.
         """
-        rx = {}
-        for unit in self.all_joined_units:
-            rx.update(unit.received.get("creds", {}))
-        if not rx:
+        return self._view(f"creds:{user}", lambda: self._credentials(user))
+
+    def _credentials(self, user):
+        raw = self._current_creds()
+        # only this user's entry is decoded from the creds
+        creds = self._carry_creds(user, raw and extract_creds(raw, user) or None)
+        if not creds:
             return None
 
-        if user in rx:
-            return {
+        expiry = {k: creds[k] for k in ("issued_at", "expires_at") if k in creds}
+        return Credentials(
+            {
                 "user": user,
-                "kubelet_token": rx[user]["kubelet_token"],
-                "proxy_token": rx[user]["proxy_token"],
-                "client_token": rx[user]["client_token"],
+                "kubelet_token": creds["kubelet_token"],
+                "proxy_token": creds["proxy_token"],
+                "client_token": creds["client_token"],
+                **expiry,
             }
-        else:
-            return None
+        )
+
+    def _carry_creds(self, user, entry):
+        """entry, or the user's last known entry while the creds lack it."""
+        kv = unitdata.kv()
+        known_id = self.expand_name("{endpoint_name}.known-creds")
+        known = kv.get(known_id) or {}
+        carried = dict(known)
+        entry = carry_creds(carried, user, entry)
+        if carried != known:
+            kv.set(known_id, carried)
+        return entry
+
+    def credentials_refresh_at(self, user):
+        """
+        When this unit should ask for the user's creds to be refreshed, or
+        None if there are no creds or they don't expire. Units pick different
+        times, from their names, ahead of expiry so they don't all ask at once.
+        """
+        creds = self.get_auth_credentials(user)
+        return creds and refresh_at(creds, local_unit())
+
+    def credentials_expiring(self, user, now=None):
+        """
+        Whether it's time to ask for the user's creds to be refreshed.
+        """
+        when = self.credentials_refresh_at(user)
+        return when is not None and (time.time() if now is None else now) >= when
+
+    def request_credentials_refresh(self, user):
+        """
+        Ask the control-plane to replace the user's expiring creds.
+        """
+        creds = self.get_auth_credentials(user)
+        if creds and "expires_at" in creds:
+            for relation in self.relations:
+                relation.to_publish_raw.update(
+                    {"auth_refresh": str(creds["expires_at"])}
+                )
 
     def get_dns(self):
         """
         Return DNS info provided by the control-plane.
         """
-        rx = self.all_joined_units.received_raw
+        return self._view("dns", self._dns)
 
-        return {
-            "port": rx.get("port"),
-            "domain": rx.get("domain"),
-            "sdn-ip": rx.get("sdn-ip"),
-            "enable-kube-dns": rx.get("enable-kube-dns"),
-        }
+    def _dns(self):
+        rx = self._merged()
+        return DnsInfo(
+            {
+                "port": rx.get("port"),
+                "domain": rx.get("domain"),
+                "sdn-ip": rx.get("sdn-ip"),
+                "enable-kube-dns": rx.get("enable-kube-dns"),
+            }
+        )
 
     def dns_ready(self):
         """
@@ -144,56 +289,200 @@ class KubeControlRequirer(Endpoint):
         """
         Predicate method to signal we have authentication credentials.
         """
-        if self.all_joined_units.received_raw.get("creds"):
+        if self._current_creds():
             return True
 
+    def _current_creds(self):
+        """
+        The serialized creds with the newest generation.
+
+        Units which published no creds are ignored, as are older generations
+        still published by a previous leader. When no unit has creds, such
+        as between one leader clearing them and the next publishing, the last
+        known creds are kept rather than treated as no creds. Users missing
+        from the newest creds keep their last known entry, see carry_creds.
+        """
+        # merging prefers the unit with the newest creds generation
+        current = self._merged().get("creds")
+        kv = unitdata.kv()
+        last_known_id = self.expand_name("{endpoint_name}.creds")
+        if not current:
+            return kv.get(last_known_id)
+        if kv.get(last_known_id) != current:
+            kv.set(last_known_id, current)
+        return current
+
+    def _snapshot(self):
+        """
+        The data saved on disk, if it applies to the current relations.
+        """
+        if not (self.snapshot_path and self.relations):
+            return None
+        if self._last_known_good is None:
+            self._last_known_good = read_snapshot(self.snapshot_path) or {}
+        return self._last_known_good
+
+    def _save_snapshot(self):
+        data = dict(self._merged())
+        data["api-endpoints"] = json.dumps(self.get_api_endpoints())
+        if self._snapshot() != data:
+            write_snapshot(self.snapshot_path, data)
+            self._last_known_good = data
+
+    @property
+    def is_stale(self):
+        """
+        Whether the data served is the snapshot rather than from the relation.
+        """
+        return not self.all_joined_units and bool(self._snapshot())
+
+    def _merge(self):
+        if self.is_stale:
+            return self._snapshot(), {}
+        merged, conflicts, v2 = merge_databags(
+            {unit.unit_name: unit.received_raw for unit in self.all_joined_units},
+            {
+                relation.application_name: relation.received_app_raw
+                for relation in self.relations
+            },
+        )
+        # fields from a kube-control-v2 payload are read as if sent as keys
+        return (encode_fields(merged) if v2 else merged), conflicts
+
+    def _merged(self):
+        """
+        The data from all control-plane units, merged deterministically.
+        """
+        merged, _ = self._merge()
+        return merged
+
+    def _received(self, key, default=None):
+        """
+        The JSON decoded value of a key from the merged data.
+        """
+        raw = self._merged().get(key)
+        return json.loads(raw) if raw else default
+
+    @property
+    def payload_stats(self):
+        """
+        Bytes received from the control-plane units, per relation data key.
+
+        Each key maps to its total across units, the most from any one unit,
+        and its growth since the previous hook. The totals are kept for the
+        next hook when this one exits.
+        """
+        if self._payload_stats is None:
+            sizes_id = self.expand_name("{endpoint_name}.payload-sizes")
+            stats = size_stats(
+                (databag_sizes(unit.received_raw) for unit in self.all_joined_units),
+                unitdata.kv().get(sizes_id) or {},
+            )
+            totals = {key: entry["total"] for key, entry in stats.items()}
+            atexit(lambda: unitdata.kv().set(sizes_id, totals))
+            self._payload_stats = stats
+        return self._payload_stats
+
+    @property
+    def merge_conflicts(self):
+        """
+        Keys the control-plane units disagree on, with each unit's value.
+        """
+        _, conflicts = self._merge()
+        return conflicts
+
     def get_cluster_tag(self):
         """
         Tag for identifying resources that are part of the cluster.
         """
-        return self.all_joined_units.received_raw.get("cluster-tag")
+        return self._merged().get("cluster-tag")
 
     def get_registry_location(self):
         """
         URL for container image registry.
         """
-        return self.all_joined_units.received_raw.get("registry-location")
+        return self._merged().get("registry-location")
 
     @property
     def cohort_keys(self):
         """
         The cohort snapshot keys sent by the control-planes.
         """
-        return self.all_joined_units.received["cohort-keys"]
+        return self._received("cohort-keys")
+
+    def changed_cohorts(self):
+        """
+        The cohort keys of snaps which changed since the last call.
+
+        Snaps are compared by their key and the revision it was published as.
+        """
+        seen_id = self.expand_name("{endpoint_name}.cohort-revisions")
+        kv = unitdata.kv()
+        changed, current = changed_cohorts(
+            self.cohort_keys or {},
+            self._received("cohort-revisions") or {},
+            kv.get(seen_id) or {},
+        )
+        kv.set(seen_id, current)
+        return changed
 
     def get_default_cni(self):
         """
         Default CNI network to use.
         """
-        return self.all_joined_units.received["default-cni"]
+        return self._received("default-cni")
 
     def get_api_endpoints(self):
         """
-        Returns a list of API endpoint URLs.
+        Returns the sorted API endpoint URLs.
         """
-        endpoints = set()
+        return self._view("api-endpoints", self._api_endpoints)
+
+    def _api_endpoints(self):
+        if self.is_stale:
+            return EndpointSet(json.loads(self._snapshot()["api-endpoints"]))
+        endpoints = []
+        for relation in self.relations:
+            endpoints.extend(relation.received_app.get("api-endpoints") or [])
         for unit in self.all_joined_units:
-            endpoints.update(unit.received["api-endpoints"] or [])
-        return sorted(endpoints)
+            endpoints.extend(unit.received["api-endpoints"] or [])
+        return EndpointSet(endpoints)
 
     @property
     def has_xcp(self):
         """
         The flag indicating whether an external cloud provider is in use.
         """
-        return self.all_joined_units.received.get("has-xcp", False)
+        return self._received("has-xcp", False)
 
     def get_controller_taints(self) -> List[Taint]:
         """Returns a list of taints configured on the control-plane nodes."""
-        taints = self.all_joined_units.received.get("taints", [])
+        taints = self._received("taints", [])
         return [Taint.decode(_) for _ in taints]
 
     def get_controller_labels(self) -> List[Label]:
         """Returns a list of lables configured on the control-plane nodes."""
-        labels = self.all_joined_units.received.get("labels", [])
+        labels = self._received("labels", [])
         return [Label.decode(_) for _ in labels]
+
+    def get_node_patch(
+        self,
+        node: Mapping[str, Any],
+        applied_taints: Iterable[Any] = (),
+        applied_labels: Iterable[Any] = (),
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Minimal merge patch applying the controller taints and labels to node.
+
+        node is the node's current object from the API server. Taints and
+        labels in applied_taints and applied_labels, such as the ones this
+        was last called with, are removed if no longer sent.
+        Returns None when the node needs no changes.
+        """
+        return node_patch(
+            node,
+            self.get_controller_taints(),
+            self.get_controller_labels(),
+            applied_taints,
+            applied_labels,
+        )
@@ -1,4 +1,5 @@
 import sys
+import pytest
 from unittest.mock import MagicMock
 
 charmhelpers = MagicMock()
@@ -21,3 +22,33 @@ class MockEndpoint(MagicMock):
 
 
 charms.reactive.Endpoint = MockEndpoint
+
+
+class MockKV(dict):
+    def get(self, key, default=None):
+        return super().get(key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+    def unset(self, key):
+        self.pop(key, None)
+
+
+@pytest.fixture
+def kv():
+    store = MockKV()
+    charmhelpers.core.unitdata.kv.return_value = store
+    yield store
+    charmhelpers.core.unitdata.kv.reset_mock(return_value=True)
+
+
+@pytest.fixture
+def leader_data():
+    store = {}
+    hookenv = charmhelpers.core.hookenv
+    hookenv.leader_get.side_effect = store.get
+    hookenv.leader_set.side_effect = store.update
+    yield store
+    hookenv.leader_get.reset_mock(side_effect=True)
+    hookenv.leader_set.reset_mock(side_effect=True)
@@ -0,0 +1,354 @@
+import json
+
+import core
+import pytest
+
+
+def test_core_needs_no_framework():
+    assert not {"charmhelpers", "charms", "ops", "pydantic"} & set(vars(core))
+
+
+@pytest.mark.parametrize(
+    "key, value, expected",
+    [
+        ("api-endpoints", ["https://a:6443"], '["https://a:6443"]'),
+        ("cluster-tag", "k8s", "k8s"),
+        ("creds-generation", 12, "12"),
+        ("default-cni", "", '""'),
+        ("enable-kube-dns", True, "True"),
+        ("has-xcp", False, "false"),
+        ("port", 53, "53"),
+        ("sdn-ip", "10.152.183.10", "10.152.183.10"),
+        ("creds", None, ""),
+    ],
+)
+def test_encode_field(key, value, expected):
+    assert core.encode_field(key, value) == expected
+
+
+def test_merge_databags_prefers_v2():
+    v1 = {"cluster-tag": "old", "port": "53"}
+    v2 = {core.PAYLOAD_V2_KEY: core.encode_payload({"cluster-tag": "new", "port": 53})}
+    merged, conflicts, is_v2 = core.merge_databags({"cp/0": v1, "cp/1": v2})
+    assert is_v2
+    assert merged == {"cluster-tag": "new", "port": 53}
+    assert conflicts == {}
+    assert core.encode_fields(merged) == {"cluster-tag": "new", "port": "53"}
+
+
+def test_merge_databags_skips_invalid_payload():
+    bad = {core.PAYLOAD_V2_KEY: json.dumps({"version": 3})}
+    merged, _, is_v2 = core.merge_databags({"cp/0": bad, "cp/1": {"domain": "a"}})
+    assert not is_v2
+    assert merged == {"domain": "a"}
+
+
+def test_merge_databags_invalid_creds_generation(caplog):
+    units = {
+        "cp/0": {"creds": '{"u": {}}', "creds-generation": "x", "port": "1"},
+        "cp/1": {"creds": '{"u": {}}', "creds-generation": "2", "port": "2"},
+    }
+    merged, _, _ = core.merge_databags(units)
+    assert merged["port"] == "2"
+    assert "Ignoring creds-generation from cp/0" in caplog.text
+
+
+def test_changed_keys():
+    old = {"a": 1, "b": 2}
+    assert core.changed_keys(old, {"a": 1, "b": 3, "c": 4, "d": None}) == {"b", "c"}
+
+
+NODE = {
+    "metadata": {"labels": {"kubernetes.io/hostname": "n1", "a": "1", "old": "x"}},
+    "spec": {
+        "taints": [
+            {"key": "node.kubernetes.io/not-ready", "effect": "NoSchedule"},
+            {"key": "t", "value": "1", "effect": "NoSchedule"},
+        ]
+    },
+}
+
+
+def test_node_patch_up_to_date():
+    patch = core.node_patch(NODE, ["t=1:NoSchedule"], ["a=1"], ["t=1:NoSchedule"])
+    assert patch is None
+
+
+def test_node_patch_minimal():
+    patch = core.node_patch(
+        NODE,
+        ["t=2:NoSchedule", "u:NoExecute"],
+        ["a=1", "b="],
+        applied_labels=["old=x", "gone=y"],
+    )
+    assert patch == {
+        "metadata": {"labels": {"b": "", "old": None}},
+        "spec": {
+            "taints": [
+                {"key": "node.kubernetes.io/not-ready", "effect": "NoSchedule"},
+                {"key": "t", "value": "2", "effect": "NoSchedule"},
+                {"key": "u", "effect": "NoExecute"},
+            ]
+        },
+    }
+
+
+def test_node_patch_removes_applied_taint():
+    patch = core.node_patch(NODE, [], ["a=1"], ["t=1:NoSchedule"])
+    assert patch == {
+        "spec": {
+            "taints": [{"key": "node.kubernetes.io/not-ready", "effect": "NoSchedule"}]
+        }
+    }
+
+
+def test_payload_meter():
+    meter = core.PayloadMeter(budget=20)
+    databag = {"a": "1234"}
+    meter.publish("rel:1", databag, {"b": "123456789"})
+    assert meter.stats == {
+        "a": {"total": 5, "max": 5, "growth": 0},
+        "b": {"total": 10, "max": 10, "growth": 10},
+    }
+    meter.publish("rel:1", databag, {"a": ""})
+    assert meter.stats["a"] == {"total": 0, "max": 0, "growth": -5}
+
+
+def test_payload_meter_budget(caplog):
+    meter = core.PayloadMeter(budget=8)
+    meter.publish("rel:1", {}, {"creds": "{}"})
+    assert not caplog.records
+    meter.publish("rel:1", {}, {"creds": "{}", "cohort-keys": "{}"})
+    assert "over the 8 budget after writing cohort-keys" in caplog.text
+
+    meter.refuse = True
+    with pytest.raises(core.PayloadBudgetError):
+        meter.publish("rel:1", {}, {"creds": '{"user": {}}'})
+    assert meter.sizes["rel:1"]["creds"] == 7
+
+
+def test_snapshot_integrity(tmp_path):
+    path = tmp_path / "state" / "snapshot.json"
+    assert core.read_snapshot(path) is None
+    core.write_snapshot(path, {"port": 53})
+    assert core.read_snapshot(path) == {"port": 53}
+
+    path.write_text(path.read_text().replace("53", "54"))
+    assert core.read_snapshot(path) is None
+    path.write_text("not json")
+    assert core.read_snapshot(path) is None
+
+
+def test_merge_databags_app_first():
+    units = {
+        "cp/0": {"cluster-tag": "unit", "domain": "local"},
+        "cp/1": {"cluster-tag": "unit"},
+    }
+    apps = {"cp": {"cluster-tag": "app"}, "empty": {}}
+    merged, conflicts, is_v2 = core.merge_databags(units, apps)
+    assert merged == {"cluster-tag": "app", "domain": "local"}
+    assert conflicts == {} and not is_v2
+
+    v2 = {core.PAYLOAD_V2_KEY: core.encode_payload({"port": 53})}
+    merged, _, is_v2 = core.merge_databags(units, {"cp": v2})
+    assert merged == {"port": 53} and is_v2
+
+
+def test_signing_queue_batches():
+    now = [0.0]
+    queue = core.SigningQueue(max_items=2, clock=lambda: now[0])
+    requests = [(f"w/{n}", f"user-{n}", "system:nodes") for n in range(5)]
+    queue.sync(requests, lambda r: r[0] == "w/4")
+    assert queue.depth == 4
+    assert queue.drain_hooks == 2
+
+    signed = set()
+    for request in queue.batch(signed.__contains__):
+        now[0] += 0.5
+        signed.add(request)
+    assert signed == set(requests[:2])
+    assert queue.depth == 2
+    assert queue.drain_seconds == 1.0
+
+    # withdrawn requests leave, state survives a new hook
+    queue.sync(requests[1:4], signed.__contains__)
+    queue = core.SigningQueue(queue.dump(), time_budget=0.4, clock=lambda: now[0])
+    assert queue.pending == requests[2:4]
+    assert queue.drain_hooks == 2
+
+
+def test_signing_queue_drops_requests_done_elsewhere():
+    queue = core.SigningQueue(max_items=1)
+    queue.sync([("a",), ("b",)], lambda r: False)
+    queue.sync([("a",), ("b",)], lambda r: r == ("a",))
+    assert queue.pending == [("b",)]
+
+
+def test_signing_queue_unsigned_go_to_back():
+    queue = core.SigningQueue(max_items=1)
+    queue.sync([("a",), ("b",)], lambda r: False)
+    assert list(queue.batch(lambda r: False)) == [("a",)]
+    assert queue.pending == [("b",), ("a",)]
+
+
+@core.profiled
+class Profiled:
+    def __init__(self, directory):
+        self.profiler = core.HookProfiler(directory, "test", keep=2)
+
+    def outer(self):
+        return self.inner() + 1
+
+    def inner(self):
+        return sum(range(100))
+
+    def items(self):
+        yield from range(3)
+
+
+def test_hook_profiler(tmp_path, monkeypatch):
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/kube-control-relation-changed")
+    assert not core.HookProfiler().enabled
+    assert Profiled(None).outer() == 4951
+
+    profiled = Profiled(tmp_path)
+    assert profiled.outer() == 4951
+    assert list(profiled.items()) == [0, 1, 2]
+    assert profiled.profiler.calls == 5  # outer, and each step of items
+    path = profiled.profiler.dump(units=3)
+    assert path.name.endswith("-kube-control-relation-changed-test-3units.prof")
+    assert profiled.profiler.dump() is None
+
+    for _ in range(2):
+        profiled.inner()
+        profiled.profiler.dump()
+    assert len(list(tmp_path.glob("*.prof"))) == 2
+
+    hooks, rows = core.profile_summary(tmp_path, top=50, sort="calls")
+    assert hooks == 2
+    assert any(function.endswith("(inner)") for function, *_ in rows)
+
+
+def test_profile_summary_cli(tmp_path, capsys):
+    profiled = Profiled(tmp_path)
+    profiled.outer()
+    profiled.profiler.dump()
+    core.main([str(tmp_path), "--top", "3"])
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == f"1 hook profiles in {tmp_path}"
+    assert len(out) == 5
+
+
+def test_refresh_at_staggers_units():
+    creds = {"issued_at": 0, "expires_at": 600}
+    times = [core.refresh_at(creds, f"kubernetes-worker/{n}") for n in range(50)]
+    assert all(300 <= t <= 400 for t in times)
+    assert len(set(times)) == 50
+    assert core.refresh_at(creds, "w/0") == core.refresh_at(creds, "w/0")
+    assert core.refresh_at({"client_token": "t"}, "w/0") is None
+
+
+def test_refresh_requested():
+    assert core.refresh_requested({"expires_at": 10}, "10")
+    assert not core.refresh_requested({"expires_at": 11}, "10")
+    assert not core.refresh_requested({"expires_at": 10}, None)
+    assert not core.refresh_requested({}, "10")
+    assert not core.refresh_requested({"expires_at": 10}, "soon")
+
+
+def test_signing_queue_expiring_first():
+    queue = core.SigningQueue()
+    expiry = {("a",): None, ("b",): 20, ("c",): 10}
+    queue.sync(expiry, lambda r: False, expiry.get)
+    assert queue.pending == [("c",), ("b",), ("a",)]
+
+
+def test_token_issuer():
+    issuer = core.TokenIssuer()
+    requests = [("w/0", "system:node:w0", "g"), ("w/1", "system:node:w1", "g")]
+    tokens = issuer.issue(requests + requests[:1])
+    assert list(tokens) == requests
+    secrets = {t for issued in tokens.values() for t in issued.values()}
+    assert len(secrets) == 6
+    assert all(
+        token.startswith(f"{user}::") and len(token) == len(user) + 66
+        for (_, user, _), issued in tokens.items()
+        for token in issued.values()
+    )
+
+    issuer.record(requests[0], tokens[requests[0]], issued_at=100)
+    state = json.loads(json.dumps(issuer.dump()))
+    assert tokens[requests[0]]["client_token"] not in json.dumps(state)
+    issuer = core.TokenIssuer(state)
+    assert issuer.verify(tokens[requests[0]]["proxy_token"]) == "system:node:w0"
+    assert issuer.verify(tokens[requests[1]]["proxy_token"]) is None
+    assert issuer.verify("system:node:w0::guess") is None
+
+    assert not issuer.stale(requests[0])
+    assert not issuer.stale(requests[1])
+    assert issuer.stale(("w/0", "system:node:w0", "system:masters"))
+    assert issuer.stale(("w/9", "system:node:w0", "g"))
+    issuer.forget("system:node:w0")
+    assert issuer.dump() == {}
+
+
+def test_token_issuer_merge():
+    requests = [("w/0", "system:node:w0", "g"), ("w/1", "system:node:w1", "g")]
+    ours, theirs = core.TokenIssuer(), core.TokenIssuer()
+    tokens = ours.issue(requests)
+    ours.record(requests[0], tokens[requests[0]], issued_at=100, expires_at=700)
+    theirs.record(requests[0], tokens[requests[0]], issued_at=50)
+    theirs.record(requests[1], tokens[requests[1]], issued_at=50)
+    ours.merge(theirs.dump())
+    assert ours.issued["system:node:w0"]["expires_at"] == 700
+    assert ours.issued["system:node:w1"]["issued_at"] == 50
+    assert ours.verify(tokens[requests[1]]["kubelet_token"]) == "system:node:w1"
+    ours.merge(None)
+    assert len(ours.dump()) == 2
+
+
+@pytest.mark.parametrize(
+    "key, value",
+    [
+        ("api-endpoints", ["https://a:6443"]),
+        ("domain", "cluster.local"),
+        ("enable-kube-dns", False),
+        ("port", 53),
+        ("creds", {"u": {"scope": "w/0"}}),
+    ],
+)
+def test_decode_field(key, value):
+    assert core.decode_field(key, core.encode_field(key, value)) == value
+
+
+def test_changed_cohorts_compares_key_and_revision():
+    changed, current = core.changed_cohorts({"k8s": "K1"}, {"k8s": 1}, {"k8s": 1})
+    assert changed == {"k8s": "K1"}
+    assert current == {"k8s": [1, "K1"]}
+    changed, _ = core.changed_cohorts({"k8s": "K1"}, {"k8s": 1}, current)
+    assert changed == {}
+    changed, _ = core.changed_cohorts({"k8s": "K2"}, {"k8s": 1}, current)
+    assert changed == {"k8s": "K2"}
+    changed, _ = core.changed_cohorts({"k8s": "K1"}, {}, {"k8s": "K1"})
+    assert changed == {"k8s": "K1"}
+
+
+def test_payload_keeps_creds_serialized():
+    creds = {"u": {"scope": "w/0", "client_token": "u::t"}}
+    raw = core.encode_payload({"creds": creds, "port": 53})
+    fields = core.decode_payload(raw)
+    assert fields["port"] == 53
+    assert core.extract_creds(fields["creds"], "u") == creds["u"]
+    assert core.encode_field("creds", fields["creds"]) == fields["creds"]
+    assert core.encode_payload(fields) == raw
+
+
+def test_databags_digest():
+    units = {"cp/0": {"port": "53"}, "cp/1": {"port": "53"}}
+    digest = core.databags_digest(units, {})
+    assert core.databags_digest(dict(reversed(units.items())), {}) == digest
+    assert core.databags_digest(units, {"cp": {}}) == digest
+    assert core.databags_digest({"cp/0": {"port": "53"}}, {}) != digest
+    assert core.databags_digest({}, units) != digest
+    units["cp/1"]["port"] = "5353"
+    assert core.databags_digest(units, {}) != digest
@@ -1,3 +1,6 @@
+import importlib
+import json
+
 import pytest
 from unittest.mock import MagicMock
 import provides
@@ -115,3 +118,237 @@ def test_set_label_failure(label):
     provider = provides.KubeControlProvider()
     with pytest.raises(DecodeError):
         provider.set_controller_labels([label])
+
+
+def test_set_cohort_keys(kv):
+    provider = provides.KubeControlProvider()
+    provider.relations = [MagicMock()]
+    published = provider.relations[0].to_publish
+    provider.set_cohort_keys({"kubelet": "a", "kubectl": "b"})
+    published.__setitem__.assert_any_call(
+        "cohort-revisions", {"kubelet": 1, "kubectl": 1}
+    )
+
+    provider.set_cohort_keys({"kubelet": "c", "kubectl": "b"})
+    published.__setitem__.assert_any_call(
+        "cohort-keys", {"kubelet": "c", "kubectl": "b"}
+    )
+    published.__setitem__.assert_any_call(
+        "cohort-revisions", {"kubelet": 2, "kubectl": 1}
+    )
+
+
+def test_import_does_not_open_kv():
+    unitdata = provides.unitdata
+    unitdata.kv.reset_mock()
+    importlib.reload(provides)
+    unitdata.kv.assert_not_called()
+
+
+def test_payload_budget():
+    provider = provides.KubeControlProvider()
+    provider.relations = [MagicMock()]
+    provider.refuse_over_budget = True
+    provider.payload_budget = 40
+    provider.set_cluster_tag("cluster")
+    assert provider.payload_stats["cluster-tag"]["total"] == len("cluster-tagcluster")
+    with pytest.raises(provider.PayloadBudgetError):
+        provider.set_api_endpoints(["https://10.0.0.1:6443", "https://10.0.0.2:6443"])
+    provider.relations[0].to_publish.__setitem__.assert_not_called()
+
+
+def test_app_databag():
+    provider = provides.KubeControlProvider()
+    provider.relations = [MagicMock()]
+    provider.app_databag = True
+    relation = provider.relations[0]
+    provides.hookenv.is_leader.return_value = True
+    provider.set_default_cni("test")
+    provider.set_cluster_tag("cluster")
+    relation.to_publish_app.__setitem__.assert_called_once_with("default-cni", "test")
+    relation.to_publish_app_raw.__setitem__.assert_called_once_with(
+        "cluster-tag", "cluster"
+    )
+    relation.to_publish.__setitem__.assert_not_called()
+
+    provides.hookenv.is_leader.return_value = False
+    provider.set_default_cni("other")
+    relation.to_publish_app.__setitem__.assert_called_once()
+    relation.to_publish.__setitem__.assert_not_called()
+    provides.hookenv.is_leader.reset_mock(return_value=True)
+
+
+def test_pending_auth_requests(kv, leader_data):
+    provider = provides.KubeControlProvider()
+    provider.relations = []
+    provider.sign_batch_size = 2
+    provider.all_joined_units = []
+    for n in range(3):
+        unit = MagicMock(unit_name=f"kubernetes-worker/{n}")
+        unit.received_raw = {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        provider.all_joined_units.append(unit)
+
+    assert provider.queue_depth == 3
+    for scope, request in provider.pending_auth_requests():
+        provider.sign_auth_request(scope, request["user"], "k", "p", "c")
+    assert provider.queue_depth == 1
+    assert provider.drain_estimate["hooks"] == 1
+
+    # the next hook picks up where this one stopped
+    provider = provides.KubeControlProvider()
+    provider.relations = []
+    provider.all_joined_units = [unit]
+    assert [u for u, _ in provider.pending_auth_requests()] == [unit.unit_name]
+
+
+def test_request_changes(kv):
+    def worker(n, user):
+        unit = MagicMock(unit_name=f"kubernetes-worker/{n}")
+        unit.received_raw = {"kubelet_user": user, "auth_group": "system:nodes"}
+        return unit
+
+    def hook(remote_unit, flag_set, *units):
+        provides.hookenv.remote_unit.return_value = remote_unit
+        provides.is_flag_set.return_value = flag_set
+        provides.set_flag.reset_mock()
+        provider = provides.KubeControlProvider()
+        provider.all_joined_units = list(units)
+        provider.manage_flags()
+        return provider
+
+    w0, w1, w2 = worker(0, "w0"), worker(1, "w1"), worker(2, None)
+    provider = hook(None, False, w0, w1, w2)
+    assert provider.request_changes() == {
+        "added": ["kubernetes-worker/0", "kubernetes-worker/1"],
+        "changed": [],
+        "removed": [],
+    }
+    provides.set_flag.assert_called_once_with("kube-control.requests.changed")
+
+    # while the flag is set, changes add up, w0 came and went
+    w1.received_raw["kubelet_user"] = "w1-renamed"
+    w2.received_raw["kubelet_user"] = "w2"
+    hook("kubernetes-worker/0", True, w1, w2)
+    hook("kubernetes-worker/1", True, w1, w2)
+    provider = hook("kubernetes-worker/2", True, w1, w2)
+    assert provider.request_changes() == {
+        "added": ["kubernetes-worker/1", "kubernetes-worker/2"],
+        "changed": [],
+        "removed": [],
+    }
+
+    # once cleared, only what changed after that counts
+    provider = hook("kubernetes-worker/1", False, w1, w2)
+    assert not any(provider.request_changes().values())
+    provides.set_flag.assert_not_called()
+
+    w0 = worker(0, "w0")
+    w1.received_raw["kubelet_user"] = "w1"
+    hook("kubernetes-worker/0", False, w0, w1, w2)
+    provider = hook("kubernetes-worker/1", True, w0, w1, w2)
+    assert provider.request_changes() == {
+        "added": ["kubernetes-worker/0"],
+        "changed": ["kubernetes-worker/1"],
+        "removed": [],
+    }
+
+
+def test_request_changes_digests_remote_unit(kv, monkeypatch):
+    units = [MagicMock(unit_name=f"kubernetes-worker/{n}") for n in range(3)]
+    for n, unit in enumerate(units):
+        unit.received_raw = {"kubelet_user": f"w{n}", "auth_group": "system:nodes"}
+    digested = []
+    digest = provides.request_digest
+    monkeypatch.setattr(
+        provides,
+        "request_digest",
+        lambda user, *args: digested.append(user) or digest(user, *args),
+    )
+    provides.is_flag_set.return_value = False
+    provides.hookenv.remote_unit.return_value = None
+    provider = provides.KubeControlProvider()
+    provider.all_joined_units = units
+    provider.manage_flags()
+    assert digested == ["w0", "w1", "w2"]
+
+    digested.clear()
+    units[2].received_raw["auth_refresh"] = "1"
+    provides.hookenv.remote_unit.return_value = "kubernetes-worker/2"
+    provider.manage_flags()
+    assert digested == ["w2"]
+    assert provider.request_changes()["changed"] == ["kubernetes-worker/2"]
+
+
+def test_issue_tokens(kv, leader_data):
+    def hook(*units):
+        provider = provides.KubeControlProvider()
+        provider.relations = []
+        provider.all_joined_units = list(units)
+        return provider
+
+    units = []
+    for n in range(2):
+        unit = MagicMock(unit_name=f"kubernetes-worker/{n}")
+        unit.received_raw = {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        units.append(unit)
+
+    provider = hook(*units)
+    signed = provider.issue_tokens(ttl=3600)
+    assert [unit for unit, _ in signed] == [
+        "kubernetes-worker/0",
+        "kubernetes-worker/1",
+    ]
+    creds = kv["creds"]
+    token = creds["system:node:w0"]["kubelet_token"]
+    assert provider.token_issuer.verify(token) == "system:node:w0"
+    assert token not in json.dumps(kv["kube-control.tokens"])
+    expiry = (
+        creds["system:node:w0"]["expires_at"] - creds["system:node:w0"]["issued_at"]
+    )
+    assert expiry == 3600
+
+    # repeated hooks issue nothing new
+    assert hook(*units).issue_tokens() == []
+    assert kv["creds"]["system:node:w0"]["kubelet_token"] == token
+
+    # a new group for the same user and scope is issued new tokens
+    units[0].received_raw["auth_group"] = "system:masters"
+    assert [unit for unit, _ in hook(*units).issue_tokens()] == ["kubernetes-worker/0"]
+    assert kv["creds"]["system:node:w0"]["kubelet_token"] != token
+
+
+def test_issued_tokens_shared_with_next_leader(kv, leader_data):
+    def hook(*units):
+        provider = provides.KubeControlProvider()
+        provider.relations = []
+        provider.all_joined_units = list(units)
+        return provider
+
+    units = []
+    for n in range(2):
+        unit = MagicMock(unit_name=f"kubernetes-worker/{n}")
+        unit.received_raw = {"kubelet_user": f"system:node:w{n}", "auth_group": "g"}
+        units.append(unit)
+
+    provides.hookenv.is_leader.return_value = False
+    try:
+        assert len(hook(*units).issue_tokens(ttl=3600)) == 2
+    finally:
+        provides.hookenv.is_leader.reset_mock(return_value=True)
+    assert leader_data == {}
+
+    kv.clear()
+    assert len(hook(*units).issue_tokens(ttl=3600)) == 2
+    shared = json.loads(leader_data["kube-control.tokens"])
+    assert shared == kv["kube-control.tokens"]
+
+    # a new leader has no creds or records of its own, but signs nothing again
+    kv.clear()
+    provider = hook(*units)
+    assert provider.issue_tokens(ttl=3600) == []
+    assert provider.queue_depth == 0
+
+    # and still refreshes them when they're expiring
+    expires_at = shared["system:node:w1"]["expires_at"]
+    units[1].received_raw["auth_refresh"] = str(expires_at)
+    assert [unit for unit, _ in hook(*units).issue_tokens()] == ["kubernetes-worker/1"]
@@ -1,11 +1,26 @@
+import json
+from unittest.mock import MagicMock
+
 import requires
+from core import extract_creds
 from models import Taint, Effect, Label
 import pytest
 
 
+def joined_units(*received):
+    """Mock control-plane units, each publishing the given data."""
+    units = []
+    for number, data in enumerate(received):
+        unit = MagicMock()
+        unit.unit_name = f"kubernetes-control-plane/{number}"
+        unit.received_raw = {key: json.dumps(value) for key, value in data.items()}
+        units.append(unit)
+    return units
+
+
 def test_get_default_cni():
     requirer = requires.KubeControlRequirer()
-    requirer.all_joined_units.received = {"default-cni": "test"}
+    requirer.all_joined_units = joined_units({"default-cni": "test"})
     assert requirer.get_default_cni() == "test"
 
 
@@ -43,7 +58,7 @@ def test_get_default_cni():
 )
 def test_get_taints(relation_field, expected):
     requirer = requires.KubeControlRequirer()
-    requirer.all_joined_units.received = {"taints": relation_field}
+    requirer.all_joined_units = joined_units({"taints": relation_field})
     assert requirer.get_controller_taints() == expected
 
 
@@ -73,5 +88,258 @@ def test_get_taints(relation_field, expected):
 )
 def test_get_labels(relation_field, expected):
     requirer = requires.KubeControlRequirer()
-    requirer.all_joined_units.received = {"labels": relation_field}
+    requirer.all_joined_units = joined_units({"labels": relation_field})
     assert requirer.get_controller_labels() == expected
+
+
+def test_changed_cohorts(kv):
+    requirer = requires.KubeControlRequirer()
+    requirer.all_joined_units = joined_units(
+        {
+            "cohort-keys": {"kubelet": "a", "kubectl": "b"},
+            "cohort-revisions": {"kubelet": 1, "kubectl": 1},
+        }
+    )
+    assert requirer.changed_cohorts() == {"kubelet": "a", "kubectl": "b"}
+    assert requirer.changed_cohorts() == {}
+
+    requirer.all_joined_units = joined_units(
+        {
+            "cohort-keys": {"kubelet": "c", "kubectl": "b"},
+            "cohort-revisions": {"kubelet": 2, "kubectl": 1},
+        }
+    )
+    assert requirer.changed_cohorts() == {"kubelet": "c"}
+
+    # a new leader counts revisions from scratch
+    requirer.all_joined_units = joined_units(
+        {
+            "cohort-keys": {"kubelet": "d", "kubectl": "b"},
+            "cohort-revisions": {"kubelet": 2, "kubectl": 1},
+        }
+    )
+    assert requirer.changed_cohorts() == {"kubelet": "d"}
+
+
+def test_changed_cohorts_without_revisions(kv):
+    requirer = requires.KubeControlRequirer()
+    requirer.all_joined_units = joined_units({"cohort-keys": {"kubelet": "a"}})
+    assert requirer.changed_cohorts() == {"kubelet": "a"}
+    requirer.all_joined_units = joined_units({"cohort-keys": {"kubelet": "b"}})
+    assert requirer.changed_cohorts() == {"kubelet": "b"}
+    assert requirer.changed_cohorts() == {}
+
+
+def test_get_auth_credentials(kv):
+    creds = {
+        "scope": {"client_token": "x", "kubelet_token": "x", "proxy_token": "x"},
+        "system:node:w0": {
+            "client_token": "c0",
+            "kubelet_token": "k0",
+            "proxy_token": "p0",
+            "scope": "kubernetes-worker/0",
+        },
+    }
+    requirer = requires.KubeControlRequirer()
+    requirer.all_joined_units = joined_units({"creds": creds})
+    assert requirer.get_auth_credentials("system:node:w0") == {
+        "user": "system:node:w0",
+        "kubelet_token": "k0",
+        "proxy_token": "p0",
+        "client_token": "c0",
+    }
+    assert requirer.get_auth_credentials("system:node:w1") is None
+
+
+@pytest.mark.parametrize(
+    "raw, user, expected",
+    [
+        ('{"a": {"scope": "b"}, "b": {"scope": "a"}}', "b", {"scope": "a"}),
+        ('{"a": {"scope": "b"}}', "scope", None),
+        ('{ "a" : {"scope": "x"} }', "a", {"scope": "x"}),
+        ('{"\\u00e9": {"scope": "x"}}', "é", {"scope": "x"}),
+        ("{}", "a", None),
+        ('{"a": {"scope": x}, "b": {}}', "a", None),
+    ],
+    ids=["second", "nested key", "whitespace", "escaped", "empty", "malformed"],
+)
+def test_extract_creds(raw, user, expected):
+    assert extract_creds(raw, user) == expected
+
+
+def test_get_auth_credentials_malformed(kv):
+    requirer = requires.KubeControlRequirer()
+    (unit,) = requirer.all_joined_units = joined_units({})
+    unit.received_raw = {"creds": '{"system:node:w0": {"client_token": c0}}'}
+    assert requirer.get_auth_credentials("system:node:w0") is None
+
+
+def test_creds_generation_handoff(kv):
+    creds = {
+        "system:node:w0": {
+            "client_token": "c0",
+            "kubelet_token": "k0",
+            "proxy_token": "p0",
+            "scope": "kubernetes-worker/0",
+        }
+    }
+    old_leader, new_leader = joined_units({}, {})
+    old_leader.received_raw = {"creds": json.dumps(creds), "creds-generation": "100"}
+    new_leader.received_raw = {}
+    requirer = requires.KubeControlRequirer()
+    requirer.all_joined_units = [new_leader, old_leader]
+    assert requirer.get_auth_credentials("system:node:w0")["client_token"] == "c0"
+
+    # old leader clears its creds before the new leader publishes
+    old_leader.received_raw = {"creds": "", "creds-generation": ""}
+    assert requirer._has_auth_credentials()
+    assert requirer.get_auth_credentials("system:node:w0")["client_token"] == "c0"
+
+    # the new leader's generation wins over stale creds
+    old_leader.received_raw = {"creds": json.dumps(creds), "creds-generation": "100"}
+    creds["system:node:w0"]["client_token"] = "c1"
+    new_leader.received_raw = {"creds": json.dumps(creds), "creds-generation": "200"}
+    assert requirer.get_auth_credentials("system:node:w0")["client_token"] == "c1"
+
+
+def test_creds_partial_handoff(kv):
+    def creds(*numbers, token):
+        return {
+            f"system:node:w{n}": {
+                "client_token": f"{token}{n}",
+                "kubelet_token": "k",
+                "proxy_token": "p",
+                "scope": f"kubernetes-worker/{n}",
+            }
+            for n in numbers
+        }
+
+    old_leader, new_leader = joined_units(
+        {"creds": creds(0, 1, token="old"), "creds-generation": 100}, {}
+    )
+    requirer = requires.KubeControlRequirer()
+    requirer.all_joined_units = [new_leader, old_leader]
+    assert requirer.get_auth_credentials("system:node:w1")["client_token"] == "old1"
+
+    # the new leader has signed w0 but not yet w1
+    new_leader.received_raw = {
+        "creds": json.dumps(creds(0, token="new")),
+        "creds-generation": "200",
+    }
+    assert requirer.get_auth_credentials("system:node:w0")["client_token"] == "new0"
+    assert requirer.get_auth_credentials("system:node:w1")["client_token"] == "old1"
+
+    new_leader.received_raw = dict(
+        new_leader.received_raw, creds=json.dumps(creds(0, 1, token="new"))
+    )
+    assert requirer.get_auth_credentials("system:node:w1")["client_token"] == "new1"
+
+
+def test_merge_prefers_leader():
+    requirer = requires.KubeControlRequirer()
+    units = joined_units(
+        {"default-cni": "old", "cluster-tag": "tag"},
+        {"default-cni": "new", "cluster-tag": "tag"},
+    )
+    for order in (units, units[::-1]):
+        requirer.all_joined_units = order
+        assert requirer.get_default_cni() == "old"
+
+    units[1].received_raw.update({"creds": "{}", "creds-generation": "100"})
+    for order in (units, units[::-1]):
+        requirer.all_joined_units = order
+        assert requirer.get_default_cni() == "new"
+        assert requirer.merge_conflicts == {
+            "default-cni": {
+                "kubernetes-control-plane/0": '"old"',
+                "kubernetes-control-plane/1": '"new"',
+            }
+        }
+
+
+def test_get_node_patch():
+    requirer = requires.KubeControlRequirer()
+    requirer.all_joined_units = joined_units(
+        {"taints": ["test.io/key:NoSchedule"], "labels": ["test.io/key=value"]}
+    )
+    node = {"metadata": {"labels": {"test.io/key": "value"}}, "spec": {}}
+    assert requirer.get_node_patch(node) == {
+        "spec": {"taints": [{"key": "test.io/key", "effect": "NoSchedule"}]}
+    }
+
+
+def test_payload_stats(kv):
+    requirer = requires.KubeControlRequirer()
+    requirer.all_joined_units = joined_units({"port": 53}, {"port": 53})
+    requires.atexit.reset_mock()
+    assert requirer.payload_stats == {"port": {"total": 12, "max": 6, "growth": 12}}
+    requirer.manage_flags()
+    # handlers later in the hook see the same growth
+    assert requirer.payload_stats["port"]["growth"] == 12
+    (save,), _ = requires.atexit.call_args
+    save()
+
+    requirer = requires.KubeControlRequirer()
+    requirer.all_joined_units = joined_units({"port": 5353}, {"port": 53})
+    assert requirer.payload_stats["port"]["growth"] == 2
+
+
+def test_last_known_good_snapshot(kv, tmp_path):
+    requirer = requires.KubeControlRequirer()
+    requirer.snapshot_path = tmp_path / "kube-control.json"
+    requirer.relations = [MagicMock(received_app_raw={}, received_app={})]
+    requirer.all_joined_units = joined_units(
+        {"port": 53, "domain": "local", "sdn-ip": "10.0.0.10", "enable-kube-dns": True}
+    )
+    requirer.all_joined_units[0].received = {"api-endpoints": ["https://10.0.0.1:6443"]}
+    requirer.manage_flags()
+    assert not requirer.is_stale
+
+    # a new hook, with the control-plane units gone
+    requirer = requires.KubeControlRequirer()
+    requirer.snapshot_path = tmp_path / "kube-control.json"
+    requirer.relations = [MagicMock(received_app_raw={}, received_app={})]
+    requirer.all_joined_units = []
+    requirer.is_joined = False
+    assert requirer.is_stale
+    assert requirer.dns_ready()
+    assert requirer.get_dns()["port"] == "53"
+    assert requirer.get_api_endpoints() == ["https://10.0.0.1:6443"]
+
+    requirer.relations = []
+    assert not requirer.is_stale
+
+
+def test_app_databag_first():
+    requirer = requires.KubeControlRequirer()
+    relation = MagicMock(
+        application_name="kubernetes-control-plane",
+        received_app_raw={"cluster-tag": "from-app", "has-xcp": "true"},
+        received_app={"api-endpoints": ["https://10.0.0.1:6443"]},
+    )
+    requirer.relations = [relation]
+    requirer.all_joined_units = joined_units({"cluster-tag": "unit"})
+    requirer.all_joined_units[0].received = {"api-endpoints": []}
+    assert requirer.get_cluster_tag() == "from-app"
+    assert requirer.has_xcp is True
+    assert requirer.get_api_endpoints() == ["https://10.0.0.1:6443"]
+
+
+def test_read_views_cached_until_data_replaced(kv):
+    requirer = requires.KubeControlRequirer()
+    requirer.relations = []
+    requirer.all_joined_units = joined_units({"port": 53, "domain": "local"})
+    requirer.all_joined_units[0].received = {
+        "api-endpoints": ["https://b", "https://a"]
+    }
+    dns = requirer.get_dns()
+    assert requirer.get_dns() is dns
+    assert dns.port == dns["port"] == "53"
+    assert requirer.get_api_endpoints() == ["https://a", "https://b"]
+    with pytest.raises(TypeError):
+        dns["port"] = "54"
+
+    requirer.all_joined_units = joined_units({"port": 54})
+    requirer.all_joined_units[0].received = {"api-endpoints": []}
+    assert requirer.get_dns().port == "54"
+    assert requirer.get_api_endpoints() == []